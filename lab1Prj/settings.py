@@ -25,9 +25,10 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = '###'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# DEBUG=0 runs the production profile
+DEBUG = os.environ.get('DEBUG', '1') == '1'
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = os.environ['ALLOWED_HOSTS'].split(',') if os.environ.get('ALLOWED_HOSTS') else []
 
 
 # Application definition
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'lab1p.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -60,7 +62,9 @@ ROOT_URLCONF = 'lab1Prj.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates timing its renders for lab1p.instrumentation
+        'BACKEND': 'lab1p.instrumentation.TimedDjangoTemplates',
+        'NAME': 'django',
         'DIRS': [BASE_DIR / 'templates']
         ,
         'APP_DIRS': True,
@@ -82,17 +86,67 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'lab1Prj.wsgi.application'
 
+# Serve the read-only pages with the async views, e.g. uvicorn lab1Prj.asgi:application with ASYNC_VIEWS=1
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '0') == '1'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
+# SQLite by default, DB_ENGINE=postgresql with DB_NAME, DB_USER, DB_PASSWORD, DB_HOST and DB_PORT
+# for several workers. Connections are kept open for DB_CONN_MAX_AGE seconds and checked before reuse.
+# With a local pgbouncer in transaction pooling mode (DB_PORT=6432) set DB_POOLER=pgbouncer, a
+# server side cursor can't outlive the transaction there.
+
+if os.environ.get('DB_ENGINE', 'sqlite') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'library'),
+            'USER': os.environ.get('DB_USER', 'library'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DB_POOLER') == 'pgbouncer',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                'timeout': 20,  # seconds a write waits for the lock before "database is locked"
+            },
+        }
+    }
+
+# Set on every new SQLite connection. With WAL readers don't block the writer and a commit
+# doesn't wait for fsync of the whole database, synchronous=NORMAL is safe in WAL mode.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+}
+
 
-DATABASES = {
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Cached pages are invalidated by bumping versions in the cache itself, so the site, run_jobs and
+# every other process must share it. Files under cache/ by default, redis for several hosts, e.g.
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache CACHE_LOCATION=redis://127.0.0.1:6379
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', str(BASE_DIR / 'cache')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
     }
 }
 
+PAGE_CACHE_TIMEOUT = 60 * 60 * 24  # pages are invalidated by model signals, this only drops unused entries
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -141,6 +195,7 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 MEDIA_URL = 'media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_ROOT = os.path.join(BASE_DIR,'staticfiles')
 
 STATICFILES_DIRS = [
@@ -155,7 +210,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = 'main'
 LOGOUT_REDIRECT_URL = 'main'
 
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# EMAIL_BACKEND=django.core.mail.backends.console.EmailBackend prints emails instead of sending them,
+# django.core.mail.backends.filebased.EmailBackend writes them to EMAIL_FILE_PATH
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = os.environ.get('EMAIL_FILE_PATH', BASE_DIR / 'sent_emails')
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_FROM = '####'
 EMAIL_HOST_USER = '####'
@@ -163,6 +221,25 @@ EMAIL_HOST_PASSWORD = '#####'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
+# outbox (python manage.py send_emails), the views only queue emails
+OUTBOX_EMAIL_BACKEND = EMAIL_BACKEND
+OUTBOX_BATCH_SIZE = 50  # emails sent over one connection
+OUTBOX_RATE_LIMIT = 5  # emails per second, 0 for no limit
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 60  # seconds before the first retry, doubled with every attempt
+OUTBOX_MAX_RETRY_DELAY = 60 * 60
+OUTBOX_CLAIM_TIMEOUT = 5 * 60  # seconds after which emails of a sender that died are sent by another one
+OUTBOX_POLL_INTERVAL = 5
+
 PASSWORD_RESET_TIMEOUT = 14400
 
+# query/latency instrumentation, totals are served at /lab1p/metrics/
+INSTRUMENTATION_N_PLUS_ONE_THRESHOLD = 10  # same query shape this many times in one request is logged
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+# background jobs (python manage.py run_jobs)
+JOBS_POLL_INTERVAL = 2  # seconds the worker sleeps when the queue is empty
+JOBS_LEASE_TIMEOUT = 5 * 60  # seconds without progress after which a running job is given to another worker
+JOBS_MAX_ATTEMPTS = 3  # a job whose workers died this many times fails
+
 
@@ -1,6 +1,7 @@
 
 from django.contrib import admin
-from .models import Author, Genre, Book, Collection, UserProfile, Comment
+from django.utils import timezone
+from .models import Author, Genre, Book, Collection, UserProfile, Comment, Job, LibraryStats, OutboxEmail
 
 
 # Register your models here.
@@ -9,7 +10,7 @@ class AuthorAdmin(admin.ModelAdmin):
 
 
 class BookAdmin(admin.ModelAdmin):
-    list_display = ('title', 'author')
+    list_display = ('title', 'author', 'comment_count')
 
 
 class CollectionAdmin(admin.ModelAdmin):
@@ -25,6 +26,31 @@ class CollectionAdmin(admin.ModelAdmin):
     )
 
 
+class CommentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'book', 'date_added')
+    list_select_related = ('book',)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'mode', 'status', 'user', 'progress', 'total', 'created', 'finished')
+    list_filter = ('kind', 'status')
+
+
+class LibraryStatsAdmin(admin.ModelAdmin):
+    list_display = ('name', 'value')
+
+
+@admin.action(description='Send again now')
+def retry_now(modeladmin, request, queryset):
+    queryset.exclude(status=OutboxEmail.SENT).update(status=OutboxEmail.PENDING, next_attempt=timezone.now())
+
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'status', 'attempts', 'next_attempt', 'created', 'sent')
+    list_filter = ('status',)
+    actions = [retry_now]
+
+
 admin.site.site_url = "/lab1p"
 
 admin.site.register(UserProfile)
@@ -32,4 +58,7 @@ admin.site.register(Author, AuthorAdmin)
 admin.site.register(Genre)
 admin.site.register(Book, BookAdmin)
 admin.site.register(Collection, CollectionAdmin)
-admin.site.register(Comment)
+admin.site.register(Comment, CommentAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(LibraryStats, LibraryStatsAdmin)
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
@@ -0,0 +1,237 @@
+import hashlib
+from datetime import datetime, timezone
+
+from django.db.models import Count
+from django.http import JsonResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET
+from django.views.decorators.vary import vary_on_cookie
+
+from .cache import get_versions, last_modified
+from .models import Author, Book, Collection, Comment, Genre
+from .pagination import paginate, AUTHOR_ORDERING, BOOK_ORDERING
+
+# Read-only JSON API, version 1.
+#
+#   ?fields=a,b      only these fields, id is always included
+#   ?after=, ?before=, ?size=   keyset pagination as on the html pages
+#
+# ETag and Last-Modified come from the cache namespaces the page cache already bumps
+# (see pagecache.py), so answering a conditional GET with 304 costs no database query.
+
+
+class Field:
+    def __init__(self, value, select=(), prefetch=(), annotate=None):
+        self.value = value
+        self.select = select
+        self.prefetch = prefetch
+        self.annotate = annotate or {}
+
+
+class Resource:
+    def __init__(self, name, model, ordering, fields, default):
+        self.name = name
+        self.model = model
+        self.ordering = ordering
+        self.fields = fields
+        self.default = default
+
+    def selected(self, request):
+        """ Names of the fields asked for with ?fields=, None if one of them is unknown."""
+        if 'fields' not in request.GET:
+            return self.default
+        names = [name.strip() for name in request.GET['fields'].split(',') if name.strip()]
+        if any(name not in self.fields for name in names):
+            return None
+        return ['id'] + [name for name in names if name != 'id']
+
+    def queryset(self, names, queryset=None):
+        # only the joins and prefetches the selected fields need
+        queryset = self.model.objects.all() if queryset is None else queryset
+        fields = [self.fields[name] for name in names]
+        select = [related for field in fields for related in field.select]
+        prefetch = [related for field in fields for related in field.prefetch]
+        annotate = {key: value for field in fields for key, value in field.annotate.items()}
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        if annotate:
+            queryset = queryset.annotate(**annotate)
+        return queryset
+
+    def serialize(self, obj, names):
+        return {name: self.fields[name].value(obj) for name in names}
+
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+
+BOOKS = Resource('books', Book, BOOK_ORDERING, {
+    'id': Field(lambda book: book.pk),
+    'title': Field(lambda book: book.title),
+    'isbn': Field(lambda book: book.isbn),
+    'information': Field(lambda book: book.Information),
+    'author': Field(lambda book: {'id': book.author_id, 'name': book.author.Name, 'surname': book.author.Surname},
+                    select=['author']),
+    'genres': Field(lambda book: [genre.Name for genre in book.genre.all()], prefetch=['genre']),
+    'comment_count': Field(lambda book: book.comment_count),
+}, default=['id', 'title', 'isbn', 'author', 'genres'])
+
+AUTHORS = Resource('authors', Author, AUTHOR_ORDERING, {
+    'id': Field(lambda author: author.pk),
+    'name': Field(lambda author: author.Name),
+    'surname': Field(lambda author: author.Surname),
+    'bio': Field(lambda author: author.Bio),
+    'books': Field(lambda author: [{'id': book.pk, 'title': book.title} for book in author.auth_books.all()],
+                   prefetch=['auth_books']),
+}, default=['id', 'name', 'surname', 'bio'])
+
+GENRES = Resource('genres', Genre, ('Name', 'id'), {
+    'id': Field(lambda genre: genre.pk),
+    'name': Field(lambda genre: genre.Name),
+    'books_count': Field(lambda genre: genre.books_count, annotate={'books_count': Count('books')}),
+}, default=['id', 'name', 'books_count'])
+
+COLLECTIONS = Resource('collections', Collection, ('Name', 'id'), {
+    'id': Field(lambda collection: collection.pk),
+    'name': Field(lambda collection: collection.Name),
+    'information': Field(lambda collection: collection.Information),
+    'date_created': Field(lambda collection: isoformat(collection.date_created)),
+    'books': Field(lambda collection: [book.pk for book in collection.books_for_collection.all()],
+                   prefetch=['books_for_collection']),
+}, default=['id', 'name', 'information', 'date_created', 'books'])
+
+COMMENTS = Resource('comments', Comment, ('date_added', 'id'), {
+    'id': Field(lambda comment: comment.pk),
+    'book': Field(lambda comment: comment.book_id),
+    'name': Field(lambda comment: comment.name),
+    'text': Field(lambda comment: comment.text),
+    'date_added': Field(lambda comment: isoformat(comment.date_added)),
+}, default=['id', 'name', 'text', 'date_added'])
+
+
+# which cache namespaces a response is built from, see pagecache.py
+
+def namespaces(request, resource, pk=None):
+    if resource is BOOKS:
+        if pk:
+            return [f'book:{pk}', 'genres']
+        # every comment changes a comment_count, only the lists showing it depend on them
+        return ['books', 'genres'] + (['comments'] if 'comment_count' in (resource.selected(request) or ()) else [])
+    if resource is AUTHORS:
+        return [f'author:{pk}'] if pk else ['authors', 'books']
+    if resource is GENRES:
+        return ['genres', 'books']
+    if resource is COLLECTIONS:
+        return [f'collections:{request.user.pk}', 'books']
+    return [f'book:{pk}']  # comments of a book
+
+
+def etag(resource):
+    def func(request, pk=None):
+        versions = get_versions(*namespaces(request, resource, pk))
+        key = f'v1:{request.get_full_path()}:{request.user.pk}:{versions}'
+        return hashlib.md5(key.encode()).hexdigest()
+    return func
+
+
+def modified(resource):
+    def func(request, pk=None):
+        return datetime.fromtimestamp(last_modified(*namespaces(request, resource, pk)), timezone.utc)
+    return func
+
+
+def api_view(resource):
+    """ GET only, conditional on the resource's ETag and Last-Modified, always revalidated by clients."""
+    def decorator(view):
+        view = condition(etag_func=etag(resource), last_modified_func=modified(resource))(view)
+        return require_GET(cache_control(private=True, no_cache=True)(view))
+    return decorator
+
+
+def bad_fields(resource):
+    return JsonResponse({'error': f'Unknown field, {resource.name} have: {", ".join(resource.fields)}'}, status=400)
+
+
+def page_url(request, **cursor):
+    query = request.GET.copy()
+    query.pop('after', None)
+    query.pop('before', None)
+    query.update(cursor)
+    return f'{request.path}?{query.urlencode()}'
+
+
+def list_response(request, resource, queryset=None):
+    names = resource.selected(request)
+    if names is None:
+        return bad_fields(resource)
+    page = paginate(request, resource.queryset(names, queryset), resource.ordering)
+    return JsonResponse({
+        'data': [resource.serialize(obj, names) for obj in page],
+        'next': page_url(request, after=page.next_cursor) if page.next_cursor else None,
+        'prev': page_url(request, before=page.prev_cursor) if page.prev_cursor else None,
+    })
+
+
+def detail_response(request, resource, pk):
+    names = resource.selected(request)
+    if names is None:
+        return bad_fields(resource)
+    obj = get_object_or_404(resource.queryset(names), pk=pk)
+    return JsonResponse({'data': resource.serialize(obj, names)})
+
+
+@api_view(BOOKS)
+def books(request):
+    return list_response(request, BOOKS)
+
+
+@api_view(BOOKS)
+def book(request, pk):
+    return detail_response(request, BOOKS, pk)
+
+
+@api_view(COMMENTS)
+def book_comments(request, pk):
+    get_object_or_404(Book.objects.only('id'), pk=pk)
+    return list_response(request, COMMENTS, Comment.objects.filter(book_id=pk))
+
+
+@api_view(AUTHORS)
+def authors(request):
+    return list_response(request, AUTHORS)
+
+
+@api_view(AUTHORS)
+def author(request, pk):
+    return detail_response(request, AUTHORS, pk)
+
+
+@api_view(GENRES)
+def genres(request):
+    return list_response(request, GENRES)
+
+
+# collections are private, the logged in user only sees their own
+
+@vary_on_cookie
+@api_view(COLLECTIONS)
+def collections(request):
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Log in to see your collections'}, status=403)
+    return list_response(request, COLLECTIONS, Collection.objects.filter(creator=request.user))
+
+
+@vary_on_cookie
+@api_view(COLLECTIONS)
+def collection(request, pk):
+    if not request.user.is_authenticated:
+        raise Http404
+    names = COLLECTIONS.selected(request)
+    if names is None:
+        return bad_fields(COLLECTIONS)
+    obj = get_object_or_404(COLLECTIONS.queryset(names, Collection.objects.filter(creator=request.user)), pk=pk)
+    return JsonResponse({'data': COLLECTIONS.serialize(obj, names)})
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class Lab1PConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'lab1p'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,139 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.shortcuts import render
+from django.utils import formats, timezone
+
+from . import views
+from .models import Author, Book, Comment
+from .pagecache import fragment_cached, page_cache, page_key
+from .facets import browse
+from .pagination import paginate, page_size, first_page, AUTHOR_ORDERING, BOOK_ORDERING, COMMENT_ORDERING, COMMENT_PAGE_SIZE
+from .recommend import recommended
+from .search import asearch_books
+from .stats import counters
+
+# Async versions of the read-only pages, used instead of the ones in views.py when
+# ASYNC_VIEWS is on. Rows are loaded with the async ORM, the pages with a cached fragment
+# load them only when the fragment isn't cached. Templates are rendered in a thread,
+# since they can still touch the session or the lazy request.user.
+
+arender = sync_to_async(render)
+apage_cache = sync_to_async(page_cache)
+abrowse = sync_to_async(browse)
+
+
+async def alist(queryset):
+    return [obj async for obj in queryset]
+
+
+async def aget_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'No {queryset.model._meta.verbose_name} found matching the query')
+
+
+async def main(request):
+    num_visits = await sync_to_async(request.session.get)('num_visits', 0)
+    request.session['num_visits'] = num_visits + 1
+
+    totals, latest_author_list = await asyncio.gather(
+        sync_to_async(counters)(),
+        alist(Author.objects.order_by('-Name')[:5]),
+    )
+
+    context = {
+        'num_authors': totals['authors'],
+        'latest_author_list': latest_author_list,
+        'num_books': totals['books'],
+        'num_genres': totals['genres'],
+        'num_users': totals['users'],
+        'num_visits': num_visits,
+    }
+    return await arender(request, 'templates/main.html', context)
+
+
+async def author_detail(request, author_pk):
+    context = await apage_cache(f'author:{author_pk}', 'genres', key=page_key(request))
+    author_query = aget_or_404(Author.objects.all(), pk=author_pk)
+    # left lazy when cached, the template still loads it if the fragment expires meanwhile
+    books = Book.objects.filter(author_id=author_pk).for_cards()
+    if await fragment_cached(request, 'author_page', context):
+        author = await author_query
+    else:
+        author, books = await asyncio.gather(author_query, alist(books))
+    context.update({'author': author, 'books': books})
+    return await arender(request, 'templates/author.html', context)
+
+
+async def authors(request):
+    page = paginate(request, Author.objects.all(), AUTHOR_ORDERING)
+    context = {'authors_obj': page, 'page': page, **await apage_cache('authors', key=page_key(request, page))}
+    if not await fragment_cached(request, 'authors_page', context):
+        await page.aload()
+    return await arender(request, 'templates/authors.html', context)
+
+
+async def books(request):
+    if request.method == 'POST':
+        return await sync_to_async(views.books)(request)
+    facets = await abrowse(request, page_size(request))
+    page = facets['page']
+    if page is None:
+        page = paginate(request, Book.objects.for_cards(), BOOK_ORDERING)
+    namespaces = ['books', 'genres'] + ([f'collections:{request.user.pk}'] if facets['owner'] else [])
+    key = page_key(request, page, facets)
+    context = {'books_obj': page, 'page': page, 'facets': facets, **await apage_cache(*namespaces, key=key)}
+    # a filtered page is loaded by the template, from the ids the facet index picked
+    if facets['page'] is None and not await fragment_cached(request, 'books_page', context, facets['owner']):
+        await page.aload()
+    return await arender(request, 'templates/books.html', context)
+
+
+async def book_detail(request, pk):
+    context = await apage_cache(f'book:{pk}', 'genres', 'recommendations', key=page_key(request))
+    queryset = Book.objects.for_detail()
+    comments = first_page(Comment.objects.filter(book_id=pk), COMMENT_ORDERING, COMMENT_PAGE_SIZE)
+    neighbours = []
+    if await fragment_cached(request, 'book_page', context):
+        book = await aget_or_404(queryset, pk=pk)
+    else:
+        book, _, neighbours = await asyncio.gather(aget_or_404(queryset.prefetch_related('genre'), pk=pk),
+                                                   comments.aload(), alist(recommended(pk)))
+    context.update({'object': book, 'book': book, 'comments': comments, 'recommended': neighbours})
+    return await arender(request, 'lab1p/book_detail.html', context)
+
+
+def comment_data(comment):
+    return {
+        'id': comment.pk,
+        'name': comment.name,
+        'text': comment.text,
+        # formatted like {{ comment.date_added }} in the page
+        'date_added': formats.localize(timezone.localtime(comment.date_added)),
+    }
+
+
+async def book_comments(request, pk):
+    """ The comments after ?after=<cursor>, for the "load more" button of the book page.
+    Served asynchronously under either setting of ASYNC_VIEWS."""
+    await aget_or_404(Book.objects.only('id'), pk=pk)
+    page = paginate(request, Comment.objects.filter(book_id=pk), COMMENT_ORDERING, COMMENT_PAGE_SIZE)
+    await page.aload()
+    return JsonResponse({
+        'comments': [comment_data(comment) for comment in page],
+        'next': page.next_cursor,
+    })
+
+
+async def search(request):
+    if request.method == 'POST':
+        searched = request.POST['searched']
+        context = {
+            'search': searched,
+            'books_names': await asearch_books(searched),
+        }
+        return await arender(request, 'templates/search_page.html', context)
+    return await arender(request, 'templates/search_page.html')
@@ -0,0 +1,170 @@
+import itertools
+import math
+import platform
+import random
+import time
+import tracemalloc
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from .exporter import stream_csv
+from .jobs import claim_next, run_job
+from .models import Author, Book, Comment, Genre, Job, UserProfile
+from .pagination import BOOK_ORDERING, encode_cursor
+from .seed import WORDS, word
+
+ENDPOINTS = ['books', 'books deep page', 'book detail', 'search', 'charts', 'charts data', 'import', 'export csv',
+             'export xlsx']
+
+# the benchmark clears and fills a cache of its own, never the one the site runs on
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'lab1p-benchmark'}}
+
+IMPORT_ROWS = 500
+
+
+class ImportSheet:
+    """ Form data with a new CSV sheet of IMPORT_ROWS books on every call, no ISBN is repeated."""
+
+    def __init__(self, rows=IMPORT_ROWS, seed=0):
+        self.rows = rows
+        self.rng = random.Random(seed)
+        # seeded books start at 978...
+        self.isbns = itertools.count(9790000000000)
+
+    def __call__(self):
+        rows = []
+        for i in range(self.rows):
+            isbn = next(self.isbns)
+            title = f'{self.rng.choice(WORDS).capitalize()} {self.rng.choice(WORDS)} {isbn}'
+            genres = self.rng.sample(WORDS, 2)
+            rows.append([i, word(self.rng, 2), word(self.rng, 3), 'Imported', i, title, str(isbn),
+                         genres[0].capitalize(), genres[1].capitalize(), ''])
+        sheet = SimpleUploadedFile('books.csv', ''.join(stream_csv(rows)).encode(), content_type='text/csv')
+        return {'file': sheet, 'mode': Job.ADD}
+
+
+def run_jobs():
+    # the import form only queues the sheet, the worker's part is timed with the request
+    while (job := claim_next()) is not None:
+        run_job(job)
+        job.input_file.delete(save=False)
+
+
+def endpoints():
+    """ name: (method, path, data, after) for the pages of urls.py, built on whatever data is in the database.
+    data may be a callable giving the data of every request, after is called before the timer stops."""
+    middle_book = Book.objects.order_by(*BOOK_ORDERING)[Book.objects.count() // 2:][:1].get()
+    paths = {
+        'books': ('get', reverse('books'), None, None),
+        'books deep page': ('get', f"{reverse('books')}?after={encode_cursor(middle_book, BOOK_ORDERING)}",
+                            None, None),
+        'book detail': ('get', reverse('book-detail', args=[middle_book.pk]), None, None),
+        'search': ('post', reverse('search'), {'searched': WORDS[0]}, None),
+        'charts': ('get', reverse('charts'), None, None),
+        'charts data': ('get', reverse('charts-data'), None, None),
+        'import': ('post', reverse('import'), ImportSheet(), run_jobs),
+        'export csv': ('get', f"{reverse('export')}?format=csv", None, None),
+        'export xlsx': ('get', f"{reverse('export')}?format=xlsx", None, None),
+    }
+    return {name: paths[name] for name in ENDPOINTS}
+
+
+def percentile(values, p):
+    # nearest rank, so p95 of 20 requests is the 19th slowest and not an interpolation
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def request(client, method, path, data, after=None):
+    response = getattr(client, method)(path, data() if callable(data) else data)
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    if after is not None:
+        after()
+    return response
+
+
+def measure(client, method, path, data, after, repeat, cold):
+    if not cold:
+        request(client, method, path, data, after)  # fills the page cache
+
+    timings, queries = [], []
+    for _ in range(repeat):
+        if cold:
+            cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = request(client, method, path, data, after)
+            timings.append(time.perf_counter() - start)
+        queries.append(len(captured))
+
+    # tracemalloc slows everything down, so memory is measured on a request of its own
+    if cold:
+        cache.clear()
+    tracemalloc.start()
+    try:
+        request(client, method, path, data, after)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'queries': max(queries),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_benchmark(repeat=20, user=None, cold=False, only=None):
+    """ Requests every endpoint repeat times through the test client, as user if one is given."""
+    client = Client()
+    if user is not None:
+        client.force_login(user)
+    results = {}
+    # the test client talks to 'testserver', which production settings don't allow
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], CACHES=CACHES):
+        cache.clear()
+        for name, (method, path, data, after) in endpoints().items():
+            if only and name not in only:
+                continue
+            results[name] = {'path': path, **measure(client, method, path, data, after, repeat, cold)}
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'repeat': repeat,
+            'cold_cache': cold,
+            'user': user.username if user is not None else None,
+            'rows': {model.__name__: model.objects.count()
+                     for model in (Author, Book, Genre, Comment, UserProfile)},
+        },
+        'endpoints': results,
+    }
+
+
+def compare(old, new):
+    """ Lines with the change of every number between two results of run_benchmark."""
+    lines = []
+    for name, result in new['endpoints'].items():
+        previous = old['endpoints'].get(name)
+        if previous is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'queries', 'peak_memory_kb'):
+            before, after = previous[key], result[key]
+            change = f' ({(after - before) / before:+.0%})' if before else ''
+            changes.append(f'{key} {before} -> {after}{change}')
+        lines.append(f'{name}: ' + ', '.join(changes))
+    return lines
@@ -0,0 +1,61 @@
+import time
+
+from django.core.cache import cache
+
+# Cached data is stored under keys that include a version number per namespace.
+# Bumping the version makes every old key unreachable at once, old entries just expire.
+
+
+def version_key(namespace):
+    return f'lab1p:{namespace}:version'
+
+
+def get_version(namespace):
+    # a fresh version is time based, so it never collides with keys left from before an eviction
+    return cache.get_or_set(version_key(namespace), time.time_ns(), None)
+
+
+def modified_key(namespace):
+    return f'lab1p:{namespace}:modified'
+
+
+def bump(namespace):
+    """ Returns the new version."""
+    try:
+        version = cache.incr(version_key(namespace))
+    except ValueError:
+        version = time.time_ns()
+        cache.set(version_key(namespace), version, None)
+    cache.set(modified_key(namespace), time.time(), None)
+    return version
+
+
+def versioned_key(namespace, *parts):
+    return ':'.join(['lab1p', namespace, str(get_version(namespace))] + [str(part) for part in parts])
+
+
+def get_versions(*namespaces):
+    # versions of several namespaces in one cache round trip
+    keys = {version_key(namespace): namespace for namespace in namespaces}
+    found = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return [found[version_key(namespace)] for namespace in namespaces]
+
+
+def last_modified(*namespaces):
+    """ Time of the latest bump of any of the namespaces, a namespace never bumped counts as changed now."""
+    keys = [modified_key(namespace) for namespace in namespaces]
+    found = cache.get_many(keys)
+    missing = {key: time.time() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return max(found.values())
+
+
+def bump_many(namespaces):
+    for namespace in set(namespaces):
+        bump(namespace)
@@ -0,0 +1,160 @@
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+import xlwt
+
+from .models import Book
+
+COLUMNS = ['id_author', 'Name', 'Surname', 'Bio', 'id_book', 'title', 'isbn', 'genre1', 'genre2', 'genre3']
+
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 64 * 1024  # bytes collected before a piece of the file is sent
+
+
+def export_rows(chunk_size=CHUNK_SIZE):
+    """ Yields one row per book in COLUMNS order.
+
+    Books are read with a server-side cursor in chunks, authors are joined and genres
+    are prefetched per chunk, so memory does not grow with the catalog."""
+    books = Book.objects.select_related('author').prefetch_related('genre').order_by('id')
+    for book in books.iterator(chunk_size=chunk_size):
+        author = book.author
+        row = [book.author_id, author.Name, author.Surname, author.Bio, book.id, book.title, book.isbn]
+        row.extend(genre.Name for genre in book.genre.all()[:3])
+        yield row
+
+
+class Echo:
+    # file-like object that hands back what is written instead of storing it
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    buffer = [writer.writerow(COLUMNS)]
+    size = 0
+    for row in rows:
+        line = writer.writerow(row)
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    yield ''.join(buffer)
+
+
+class StreamBuffer(io.RawIOBase):
+    # write-only, non seekable stream; zipfile then writes data descriptors instead of seeking back
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+XLSX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="xl/workbook.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Data" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+    '</Relationships>'
+)
+XLSX_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+XLSX_SHEET_END = '</sheetData></worksheet>'
+
+# characters that are not allowed in xml 1.0 documents
+ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def xlsx_row(row):
+    cells = []
+    for value in row:
+        if isinstance(value, int):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            text = escape(ILLEGAL_XML_CHARS.sub('', str(value)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def stream_xlsx(rows):
+    """ Writes a single sheet xlsx file and yields it piece by piece.
+
+    Cells are inline strings, so no shared strings table has to be kept in memory."""
+    stream = StreamBuffer()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', XLSX_RELS)
+        archive.writestr('xl/workbook.xml', XLSX_WORKBOOK)
+        archive.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((XLSX_SHEET_START + xlsx_row(COLUMNS)).encode())
+            for row in rows:
+                sheet.write(xlsx_row(row).encode())
+                if stream.size >= BUFFER_SIZE:
+                    yield stream.pop()
+            sheet.write(XLSX_SHEET_END.encode())
+    yield stream.pop()
+
+
+def write_xls(rows, fileobj):
+    # legacy format, the whole workbook is built in memory and stops at 65536 rows
+    wb = xlwt.Workbook(encoding='utf-8')
+    ws = wb.add_sheet('Data')
+    row_num = 0
+    font_style = xlwt.XFStyle()
+    font_style.font.bold = True
+
+    for col_num in range(len(COLUMNS)):
+        ws.write(row_num, col_num, COLUMNS[col_num], font_style)
+
+    font_style = xlwt.XFStyle()
+
+    for info in rows:
+        row_num += 1
+        for col_num in range(len(info)):
+            ws.write(row_num, col_num, str(info[col_num]), font_style)
+    wb.save(fileobj)
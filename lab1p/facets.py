@@ -0,0 +1,264 @@
+import heapq
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+
+from django.db import transaction
+from django.utils.functional import cached_property
+
+from .cache import bump, get_version
+from .models import Author, Book, Collection, Genre
+from .pagination import decode_cursor, encode_cursor, BOOK_ORDERING
+
+# Facets of the books page: genre, author and the user's own collections, with the number of
+# books each choice would show.
+#
+# Every worker process keeps the book ids of each genre as a bitmap, a Python int with bit n
+# set for book n, and the books of each author as a list. A filter is an AND of bitmaps and a
+# facet count is int.bit_count(), no join is run for them. The page of books is the first
+# rows after the cursor among the ids left, by (title, id) like the unfiltered page, and only
+# those rows are loaded from the database. The collections are per user, their book ids are
+# read with one query on the collection links.
+#
+# The index is loaded on first use and again when the 'facets' version was bumped by the
+# receivers in signals.py, seen at most CHECK_INTERVAL seconds later.
+
+NAMESPACE = 'facets'
+CHECK_INTERVAL = 1.0
+AUTHOR_FACETS = 20  # authors listed, the ones with most books
+FILTERS = ('genre', 'author', 'collection')
+
+
+def to_bitmap(ids, size):
+    bits = bytearray(size // 8 + 1)
+    for i in ids:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def to_ids(bitmap):
+    ids = []
+    for i, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')):
+        if byte:
+            ids.extend(i * 8 + bit for bit in range(8) if byte >> bit & 1)
+    return ids
+
+
+class Snapshot:
+    """ The index as loaded, never changed afterwards so requests can read it without a lock."""
+
+    def __init__(self, version=None):
+        # the 'facets' version read before the rows, the filtered pages are cached under it
+        self.version = version
+        rows = list(Book.objects.values_list('id', 'title', 'author_id'))
+        self.size = max((pk for pk, _, _ in rows), default=0) + 1
+        self.sort_keys = {pk: (title, pk) for pk, title, _ in rows}
+        self.author_of = {pk: author_id for pk, _, author_id in rows}
+        self.all = to_bitmap(self.sort_keys, self.size)
+
+        author_books = {}
+        for pk, _, author_id in rows:
+            author_books.setdefault(author_id, []).append(pk)
+        self.author_books = author_books
+        self.author_counts = Counter({author_id: len(ids) for author_id, ids in author_books.items()})
+
+        genre_books = {}
+        for genre_id, book_id in Book.genre.through.objects.values_list('genre_id', 'book_id'):
+            genre_books.setdefault(genre_id, []).append(book_id)
+        self.genres = {genre_id: to_bitmap(ids, self.size) for genre_id, ids in genre_books.items()}
+
+        self.genre_names = dict(Genre.objects.values_list('id', 'Name'))
+        self.author_names = {pk: f'{name} {surname}' for pk, name, surname in
+                             Author.objects.values_list('id', 'Name', 'Surname')}
+
+    def author_bitmap(self, author_id):
+        return to_bitmap(self.author_books.get(author_id, ()), self.size)
+
+
+class FacetIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.version = None
+        self.checked = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.snapshot is not None and now - self.checked < CHECK_INTERVAL:
+            return self.snapshot
+        with self.lock:
+            version = get_version(NAMESPACE)
+            if self.snapshot is None or version != self.version:
+                self.snapshot = Snapshot(version)
+                self.version = version
+            self.checked = now
+        return self.snapshot
+
+
+index = FacetIndex()
+
+
+class FacetPage:
+    """ A page of the filtered books, used like pagination.KeysetPage by the templates."""
+
+    def __init__(self, snapshot, bitmap, values, before, size):
+        self.snapshot = snapshot
+        self.bitmap = bitmap
+        self.values = values
+        self.before = before
+        self.size = size
+
+    @cached_property
+    def _page(self):
+        # like KeysetPage, one row more than the page tells whether there is a page after it
+        keys, size = self.snapshot.sort_keys, self.size
+        hits = to_ids(self.bitmap)
+        if self.values is not None and self.before:
+            cursor = tuple(self.values)
+            rows = heapq.nlargest(size + 1, (keys[pk] for pk in hits if keys[pk] < cursor))
+            return [pk for _, pk in rows[:size][::-1]], True, len(rows) > size
+        cursor = tuple(self.values) if self.values is not None else None
+        rows = heapq.nsmallest(size + 1, (keys[pk] for pk in hits if cursor is None or keys[pk] > cursor))
+        return [pk for _, pk in rows[:size]], len(rows) > size, self.values is not None
+
+    @cached_property
+    def items(self):
+        ids = self._page[0]
+        found = Book.objects.for_cards().in_bulk(ids)
+        return [found[pk] for pk in ids if pk in found]
+
+    @property
+    def has_next(self):
+        return self._page[1]
+
+    @property
+    def has_prev(self):
+        return self._page[2]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1], BOOK_ORDERING) if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0], BOOK_ORDERING) if self.has_prev and self.items else None
+
+
+def selected(request):
+    chosen = {}
+    for name in FILTERS:
+        try:
+            chosen[name] = int(request.GET[name])
+        except (KeyError, ValueError):
+            pass
+    if 'collection' in chosen and not request.user.is_authenticated:
+        del chosen['collection']
+    return chosen
+
+
+def facet_query(request, **change):
+    # the query string with one filter changed, the page cursor is dropped
+    query = request.GET.copy()
+    for name in ('after', 'before'):
+        query.pop(name, None)
+    for name, value in change.items():
+        if value is None:
+            query.pop(name, None)
+        else:
+            query[name] = value
+    return query.urlencode()
+
+
+def options(request, name, counts, names, chosen):
+    return [{
+        'id': pk,
+        'name': names.get(pk, pk),
+        'count': count,
+        'selected': chosen.get(name) == pk,
+        'query': facet_query(request, **{name: None if chosen.get(name) == pk else pk}),
+    } for pk, count in counts]
+
+
+def collection_data(user):
+    """ Names and book ids of the collections of user, the links are read with one query."""
+    if not user.is_authenticated:
+        return {}, {}
+    books = {}
+    for collection_id, book_id in Book.collections.through.objects.filter(
+            collection__creator=user).values_list('collection_id', 'book_id'):
+        books.setdefault(collection_id, []).append(book_id)
+    names = dict(Collection.objects.filter(creator=user).values_list('id', 'Name'))
+    return names, books
+
+
+def browse(request, size):
+    """ The facets of the books page, and the page of books when a filter is chosen (None otherwise)."""
+    snapshot = index.get()
+    chosen = selected(request)
+    collection_names, collection_books = collection_data(request.user)
+    # books added since the index was loaded aren't in it yet
+    collections = {pk: to_bitmap([i for i in ids if i in snapshot.sort_keys], snapshot.size)
+                   for pk, ids in collection_books.items()}
+
+    genre = snapshot.genres.get(chosen['genre'], 0) if 'genre' in chosen else snapshot.all
+    author = snapshot.author_bitmap(chosen['author']) if 'author' in chosen else snapshot.all
+    collection = collections.get(chosen['collection'], 0) if 'collection' in chosen else snapshot.all
+
+    # every facet counts the books its choices would show with the other filters kept
+    others = author & collection
+    genre_counts = [(pk, (others & bits).bit_count()) for pk, bits in snapshot.genres.items()]
+    genre_counts = sorted(((pk, count) for pk, count in genre_counts if count or pk == chosen.get('genre')),
+                          key=lambda item: (-item[1], snapshot.genre_names.get(item[0], '')))
+    if 'genre' in chosen or 'collection' in chosen:
+        author_counts = Counter(snapshot.author_of[pk] for pk in to_ids(genre & collection))
+    else:
+        author_counts = snapshot.author_counts
+    author_counts = author_counts.most_common(AUTHOR_FACETS)
+    if 'author' in chosen and chosen['author'] not in dict(author_counts):
+        author_counts.append((chosen['author'], (genre & collection & author).bit_count()))
+    others = genre & author
+    collection_counts = [(pk, (others & bits).bit_count()) for pk, bits in collections.items()]
+    collection_counts += [(pk, 0) for pk in collection_names if pk not in collections]
+    collection_counts.sort(key=lambda item: collection_names.get(item[0], ''))
+
+    page = None
+    if chosen:
+        cursor = request.GET.get('before') or request.GET.get('after')
+        values = decode_cursor(cursor, BOOK_ORDERING) if cursor else None
+        page = FacetPage(snapshot, genre & author & collection, values, bool(request.GET.get('before')), size)
+    return {
+        'page': page,
+        'chosen': chosen,
+        'genres': options(request, 'genre', genre_counts, snapshot.genre_names, chosen),
+        'authors': options(request, 'author', author_counts, snapshot.author_names, chosen),
+        'collections': options(request, 'collection', collection_counts, collection_names, chosen),
+        'query': urlencode(chosen),  # kept by the pagination links
+        'clear': facet_query(request, **{name: None for name in FILTERS}),
+        # a page of a collection is only cached for its owner
+        'owner': request.user.pk if 'collection' in chosen else '',
+        'version': snapshot.version,
+    }
+
+
+# the version is bumped once the transaction is committed, a process loading the index
+# before that would keep the rows as they were under the new version
+
+def changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump(NAMESPACE))
+
+
+def genre_links_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(lambda: bump(NAMESPACE))
+
+
+def bulk_changed(sender, **kwargs):
+    if sender in (Book, Author, Genre, Book.genre.through):
+        transaction.on_commit(lambda: bump(NAMESPACE))
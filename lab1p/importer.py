@@ -0,0 +1,418 @@
+import copy
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+
+from .library import send_changed
+from .models import Author, Book, Genre
+from .signals import bulk_created
+
+# column layout of the sheet, same as the one produced by export
+# id_author, Name, Surname, Bio, id_book, title, isbn, genre1, genre2, genre3
+GENRE_COLUMNS = range(7, 10)
+
+BATCH_SIZE = 1000
+DIFF_ROWS = 200  # changed rows listed in the diff, the counts cover all of them
+
+
+def cell(value):
+    # xls stores numbers as floats, so 9780000000000 comes back as 9780000000000.0
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def column(data, i):
+    return data[i] if i < len(data) else ''
+
+
+def row_genres(data):
+    return sorted({column(data, i) for i in GENRE_COLUMNS} - {''})
+
+
+def check_fields(obj, *names):
+    # lengths and blanks of the values from the sheet, what the database would refuse
+    obj.clean_fields(exclude=[field.name for field in obj._meta.fields if field.name not in names])
+
+
+def fingerprint(data):
+    """ Hash of what the row sets: author, title, isbn and genres."""
+    parts = [column(data, 1), column(data, 2), column(data, 5), column(data, 6)] + row_genres(data)
+    return hashlib.sha1('\x1f'.join(parts).encode()).hexdigest()
+
+
+class BulkImporter:
+    """ Imports authors, books and genres from a sheet.
+
+    Existing keys are loaded once, the sheet is resolved in memory and written with
+    bulk_create in batches, one transaction per batch. Errors are collected per row
+    in self.errors instead of stopping the import. When the database refuses a batch, say
+    a book inserted by someone else meanwhile, it is written again a row at a time so only
+    the rows at fault are left out."""
+
+    # what a batch changes besides the database, put back when the batch is rolled back
+    STATE = ('errors', 'authors', 'books_by_isbn', 'book_keys', 'genres', 'created_authors', 'created_books',
+             'created_genres')
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.errors = []
+        self.created_authors = 0
+        self.created_books = 0
+        self.created_genres = 0
+
+        self.authors = {(name, surname): pk for name, surname, pk in
+                        Author.objects.values_list('Name', 'Surname', 'id')}
+        self.books_by_isbn = {isbn: (pk, title, author_id) for pk, title, author_id, isbn in
+                              Book.objects.values_list('id', 'title', 'author_id', 'isbn')}
+        self.book_keys = {(title, author_id) for _, title, author_id in self.books_by_isbn.values()}
+        self.genres = dict(Genre.objects.values_list('Name', 'id'))
+
+    def run(self, rows, progress=None):
+        # progress is called with the number of rows done after every batch
+        batch = []
+        done = 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch)
+                done += len(batch)
+                batch = []
+                if progress:
+                    progress(done)
+        if batch:
+            self._import_batch(batch)
+            done += len(batch)
+            if progress:
+                progress(done)
+        return self.errors
+
+    def _import_batch(self, rows):
+        self._write_batch([[cell(value) for value in row] for row in rows])
+
+    def _write_batch(self, rows):
+        if self._write_atomic(rows) is None:
+            return
+        for row in rows:
+            error = self._write_atomic([row])
+            if error is not None:
+                self.errors.append(f"Error {error} for the book with id {column(row, 4)}. Data was ignored.")
+
+    def _write_atomic(self, rows):
+        # the error the database gave, with everything the rows changed undone
+        state = self._snapshot()
+        try:
+            with transaction.atomic():
+                self._write_rows(rows)
+        except DatabaseError as e:
+            for name, value in state.items():
+                setattr(self, name, value)
+            return e
+        return None
+
+    def _snapshot(self):
+        return {name: copy.copy(getattr(self, name)) for name in self.STATE}
+
+    def _write_rows(self, rows):
+        self._create_authors(rows)
+        self._create_genres(rows)
+        self._create_books(rows)
+
+    def _create_authors(self, rows):
+        new_authors = {}
+        for data in rows:
+            key = (data[1], data[2])
+            if key in self.authors or key in new_authors:
+                continue
+            author = Author(Name=data[1], Surname=data[2], Bio=data[3])
+            try:
+                author.clean()
+                check_fields(author, 'Name', 'Surname', 'Bio')
+            except ValidationError as e:
+                self.errors.append(f"Error {e} for the author with id {data[0]}. Data of this row was ignored. ")
+                continue
+            new_authors[key] = author
+
+        if new_authors:
+            Author.objects.bulk_create(new_authors.values(), batch_size=self.batch_size)
+            for name, surname, pk in Author.objects.filter(Name__in={name for name, _ in new_authors}).values_list(
+                    'Name', 'Surname', 'id'):
+                if (name, surname) in new_authors:
+                    self.authors[(name, surname)] = pk
+                    new_authors[(name, surname)].pk = pk
+            self.created_authors += len(new_authors)
+            bulk_created.send(sender=Author, objs=list(new_authors.values()))
+
+    def _create_genres(self, rows):
+        new_genres = {}
+        for data in rows:
+            for i in GENRE_COLUMNS:
+                name = data[i] if i < len(data) else ''
+                if name == '' or name in self.genres or name in new_genres:
+                    continue
+                try:
+                    genre = Genre.create(Name=name)
+                    check_fields(genre, 'Name')
+                except ValidationError as e:
+                    self.errors.append(f"Error {e} for the book with id {data[4]}")
+                    continue
+                new_genres[name] = genre
+
+        if new_genres:
+            Genre.objects.bulk_create(new_genres.values(), batch_size=self.batch_size)
+            for name, pk in Genre.objects.filter(Name__in=new_genres).values_list('Name', 'id'):
+                self.genres[name] = new_genres[name].pk = pk
+            self.created_genres += len(new_genres)
+            bulk_created.send(sender=Genre, objs=list(new_genres.values()))
+
+    def _create_books(self, rows):
+        new_books = {}
+        book_genres = []  # (isbn, genre name) pairs, resolved to ids once the books exist
+        for data in rows:
+            author_id = self.authors.get((data[1], data[2]))
+            if author_id is None:
+                continue
+            title, isbn = data[5], data[6]
+            genres = [data[i] for i in GENRE_COLUMNS if i < len(data) and data[i] in self.genres]
+
+            if isbn in new_books:
+                existing = (None, new_books[isbn].title, new_books[isbn].author_id)
+            else:
+                existing = self.books_by_isbn.get(isbn)
+            if existing is not None:
+                _, book_title, book_author = existing
+                if book_title == title and book_author == author_id:
+                    book_genres.extend((isbn, name) for name in genres)
+                else:
+                    self.errors.append(f"There is another book with the same isbn as the book with "
+                                       f"id {data[4]}. Data was ignored.")
+                continue
+
+            if (title, author_id) in self.book_keys:
+                self.errors.append(f"There is already a book with the the same name and author as book "
+                                   f"with id {data[4]}. Data was ignored.")
+                continue
+
+            try:
+                book = Book.create(title, Author(id=author_id), isbn)
+                check_fields(book, 'title', 'isbn')
+            except ValidationError as e:
+                self.errors.append(f"Error {e} for the book with id {data[4]}")
+                continue
+            book.import_fingerprint = fingerprint(data)
+            new_books[isbn] = book
+            self.book_keys.add((title, author_id))
+            book_genres.extend((isbn, name) for name in genres)
+
+        if new_books:
+            Book.objects.bulk_create(new_books.values(), batch_size=self.batch_size)
+            for pk, title, author_id, isbn in Book.objects.filter(isbn__in=new_books).values_list(
+                    'id', 'title', 'author_id', 'isbn'):
+                self.books_by_isbn[isbn] = (pk, title, author_id)
+                new_books[isbn].pk = pk
+            self.created_books += len(new_books)
+            bulk_created.send(sender=Book, objs=list(new_books.values()))
+
+        through = Book.genre.through
+        links = {(self.books_by_isbn[isbn][0], self.genres[name]) for isbn, name in book_genres}
+        if links:
+            objs = [through(book_id=book_id, genre_id=genre_id) for book_id, genre_id in links]
+            through.objects.bulk_create(objs, batch_size=self.batch_size, ignore_conflicts=True)
+            bulk_created.send(sender=through, objs=objs)
+
+
+class SyncImporter(BulkImporter):
+    """ Makes the books of the sheet match it, rows are matched to books by isbn.
+
+    Every book keeps the fingerprint of the row that last wrote it, a row with the same
+    fingerprint is skipped without a query. The other rows create their book, or update its
+    title and author and add and remove genres; when all the genre columns of a row are
+    filled the book may have more genres than the sheet holds, then none are removed.
+    Authors and genres are created, never changed. With dry_run nothing is written and
+    self.diff tells what the import would change."""
+
+    STATE = BulkImporter.STATE + ('book_isbns', 'author_names', 'placeholder', 'diff')
+
+    def __init__(self, batch_size=BATCH_SIZE, dry_run=False):
+        super().__init__(batch_size)
+        self.dry_run = dry_run
+        self.fingerprints = dict(Book.objects.exclude(import_fingerprint='').values_list('isbn', 'import_fingerprint'))
+        self.book_isbns = {(title, author_id): isbn for isbn, (_, title, author_id) in self.books_by_isbn.items()}
+        self.seen = set()
+        self.author_names = {}
+        self.placeholder = 0  # ids of the authors and genres a dry run would create
+        self.diff = {'skipped': 0, 'unchanged': 0, 'created': 0, 'updated': 0, 'authors': 0, 'genres': 0,
+                     'genres_added': 0, 'genres_removed': 0, 'rows': []}
+
+    def _snapshot(self):
+        state = super()._snapshot()
+        state['diff']['rows'] = list(self.diff['rows'])
+        return state
+
+    def _import_batch(self, rows):
+        changed = []
+        for row in rows:
+            data = [cell(value) for value in row]
+            isbn = column(data, 6)
+            if isbn and isbn in self.seen:
+                self.errors.append(f"The isbn of the book with id {column(data, 4)} is repeated in the sheet. "
+                                   f"Data was ignored.")
+                continue
+            self.seen.add(isbn)
+            if self.fingerprints.get(isbn) == fingerprint(data):
+                self.diff['skipped'] += 1
+            else:
+                changed.append(data)
+        if changed:
+            self._write_batch(changed)
+
+    def _write_rows(self, rows):
+        changed = [(data, fingerprint(data)) for data in rows]
+        if self.dry_run:
+            self._plan_authors([data for data, _ in changed])
+            self._plan_genres([data for data, _ in changed])
+        else:
+            self._create_authors([data for data, _ in changed])
+            self._create_genres([data for data, _ in changed])
+        self._sync_books(changed)
+
+    def _new_id(self):
+        self.placeholder -= 1
+        return self.placeholder
+
+    def _plan_authors(self, rows):
+        for data in rows:
+            key = (data[1], data[2])
+            if key in self.authors:
+                continue
+            try:
+                author = Author(Name=data[1], Surname=data[2], Bio=data[3])
+                author.clean()
+                check_fields(author, 'Name', 'Surname', 'Bio')
+            except ValidationError as e:
+                self.errors.append(f"Error {e} for the author with id {data[0]}. Data of this row was ignored. ")
+                continue
+            self.authors[key] = self._new_id()
+            self.created_authors += 1
+
+    def _plan_genres(self, rows):
+        for data in rows:
+            for name in row_genres(data):
+                if name in self.genres:
+                    continue
+                try:
+                    check_fields(Genre.create(Name=name), 'Name')
+                except ValidationError as e:
+                    self.errors.append(f"Error {e} for the book with id {data[4]}")
+                    continue
+                self.genres[name] = self._new_id()
+                self.created_genres += 1
+
+    def _sync_books(self, changed):
+        if len(self.author_names) != len(self.authors):
+            self.author_names = {pk: f'{name} {surname}' for (name, surname), pk in self.authors.items()}
+        author_names = self.author_names
+        genre_names = {pk: name for name, pk in self.genres.items()}
+        book_ids = [self.books_by_isbn[data[6]][0] for data, _ in changed if data[6] in self.books_by_isbn]
+        current = {}
+        for book_id, genre_id in Book.genre.through.objects.filter(book_id__in=book_ids).values_list(
+                'book_id', 'genre_id'):
+            current.setdefault(book_id, set()).add(genre_id)
+
+        new_books, saved, marked = {}, [], []
+        added, removed = [], {}  # (book, genre) links, {genre: books}
+        for data, row_fingerprint in changed:
+            author_id = self.authors.get((data[1], data[2]))
+            if author_id is None:
+                continue
+            title, isbn = data[5], data[6]
+            names = row_genres(data)
+            genres = {self.genres[name] for name in names if name in self.genres}
+            owner = self.book_isbns.get((title, author_id))
+            if owner is not None and owner != isbn:
+                self.errors.append(f"There is already a book with the the same name and author as book "
+                                   f"with id {data[4]}. Data was ignored.")
+                continue
+            try:
+                book = Book.create(title, Author(id=author_id), isbn)
+                check_fields(book, 'title', 'isbn')
+            except ValidationError as e:
+                self.errors.append(f"Error {e} for the book with id {data[4]}")
+                continue
+            book.import_fingerprint = row_fingerprint
+
+            existing = self.books_by_isbn.get(isbn)
+            if existing is None:
+                new_books[isbn] = (book, genres)
+                self.book_isbns[(title, author_id)] = isbn
+                self._record('created', {'isbn': isbn, 'title': title, 'author': author_names[author_id],
+                                         'genres_added': sorted(genre_names[pk] for pk in genres)})
+                continue
+
+            book.pk, old_title, old_author = existing
+            have = current.get(book.pk, set())
+            gone = set() if len(names) >= len(GENRE_COLUMNS) else have - genres
+            fields = {}
+            if old_title != title:
+                fields['title'] = [old_title, title]
+            if old_author != author_id:
+                fields['author'] = [author_names.get(old_author, old_author), author_names[author_id]]
+            if not fields and genres <= have and not gone:
+                # the book already is what the row says, only its fingerprint is stored
+                self.diff['unchanged'] += 1
+                marked.append(book)
+                continue
+
+            if fields:
+                del self.book_isbns[(old_title, old_author)]
+                self.book_isbns[(title, author_id)] = isbn
+                self.books_by_isbn[isbn] = (book.pk, title, author_id)
+                saved.append(book)
+            else:
+                marked.append(book)
+            added += [(book.pk, genre) for genre in genres - have]
+            for genre in gone:
+                removed.setdefault(genre, set()).add(book.pk)
+            self._record('updated', {'isbn': isbn, 'title': title, 'fields': fields,
+                                     'genres_added': sorted(genre_names[pk] for pk in genres - have),
+                                     'genres_removed': sorted(genre_names.get(pk, pk) for pk in gone)})
+
+        self.diff['genres_added'] += len(added) + sum(len(genres) for _, genres in new_books.values())
+        self.diff['genres_removed'] += sum(len(books) for books in removed.values())
+        self.diff['authors'], self.diff['genres'] = self.created_authors, self.created_genres
+        if not self.dry_run:
+            self._write(new_books, saved, marked, added, removed)
+
+    def _record(self, action, change):
+        self.diff[action] += 1
+        if len(self.diff['rows']) < DIFF_ROWS:
+            self.diff['rows'].append({'action': action, **change})
+
+    def _write(self, new_books, saved, marked, added, removed):
+        if new_books:
+            books = [book for book, _ in new_books.values()]
+            Book.objects.bulk_create(books, batch_size=self.batch_size)
+            for pk, title, author_id, isbn in Book.objects.filter(isbn__in=new_books).values_list(
+                    'id', 'title', 'author_id', 'isbn'):
+                self.books_by_isbn[isbn] = (pk, title, author_id)
+                new_books[isbn][0].pk = pk
+            self.created_books += len(books)
+            bulk_created.send(sender=Book, objs=books)
+            added += [(book.pk, genre) for book, genres in new_books.values() for genre in genres]
+
+        # few rows change between syncs, a save per book runs the receivers as an edit on the site would
+        for book in saved:
+            book.save(update_fields=['title', 'author', 'title_normalized', 'import_fingerprint'])
+        Book.objects.bulk_update(marked, ['import_fingerprint'], batch_size=self.batch_size)
+
+        through = Book.genre.through
+        if added:
+            objs = [through(book_id=book_id, genre_id=genre_id) for book_id, genre_id in added]
+            through.objects.bulk_create(objs, batch_size=self.batch_size, ignore_conflicts=True)
+            bulk_created.send(sender=through, objs=objs)
+        for genre_id, book_ids in removed.items():
+            through.objects.filter(genre_id=genre_id, book_id__in=book_ids).delete()
+            send_changed(through, Genre(id=genre_id), True, Book, 'remove', book_ids)
@@ -0,0 +1,198 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger('lab1p.instrumentation')
+
+# the request being measured in the current thread/task, None outside of a request
+current = contextvars.ContextVar('lab1p_request_metrics', default=None)
+
+PLACEHOLDERS = re.compile(r'(%s|\?)(\s*,\s*(%s|\?))+')
+NUMBERS = re.compile(r'\b\d+\b')
+STRINGS = re.compile(r"'(?:[^']|'')*'")
+
+
+def sql_shape(sql):
+    # the same query with other parameters gives the same shape, IN lists of any length included
+    shape = STRINGS.sub('?', sql)
+    shape = NUMBERS.sub('?', shape)
+    return PLACEHOLDERS.sub('?', shape)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper hook, see https://docs.djangoproject.com/en/4.1/topics/db/instrumentation/
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+            self.shapes[sql_shape(sql)] += 1
+
+
+class MetricsRegistry:
+    """ Totals per view since the process started, read by the metrics endpoint."""
+
+    FIELDS = ('requests', 'queries', 'sql_seconds', 'template_seconds', 'duration_seconds',
+              'response_bytes', 'n_plus_one_suspects')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, view, **values):
+        with self.lock:
+            totals = self.views[view]
+            totals['requests'] += 1
+            for field, value in values.items():
+                totals[field] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {view: dict(totals) for view, totals in self.views.items()}
+
+
+registry = MetricsRegistry()
+
+
+class TimedTemplate(Template):
+    # the backend template is rendered once per render()/render_to_string(), not for includes
+    def render(self, context=None, request=None):
+        metrics = current.get()
+        if metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """ The Django template backend with its templates timed for the request being measured,
+    set as the BACKEND in TEMPLATES."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+def measured_execute(execute, sql, params, many, context):
+    # installed on every connection, measures only while a request is being measured. Async views
+    # run their queries in another thread, the context variable is copied there by sync_to_async.
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def add_query_timer(sender=None, connection=None, **kwargs):
+    if measured_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(measured_execute)
+
+
+def install_query_timer():
+    connection_created.connect(add_query_timer, dispatch_uid='instrumentation_query_timer')
+    for connection in connections.all():
+        add_query_timer(connection=connection)
+
+
+class InstrumentationMiddleware:
+    """ Counts queries, SQL time, template time and response size per view.
+
+    Totals go to the registry for the metrics endpoint, the numbers of the current
+    request are sent back in a Server-Timing header. A query shape that repeats at
+    least INSTRUMENTATION_N_PLUS_ONE_THRESHOLD times in one request is logged as
+    an N+1 suspect. Works in front of both sync and async views."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'INSTRUMENTATION_N_PLUS_ONE_THRESHOLD', 10)
+        install_query_timer()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    def finish(self, request, response, metrics, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        suspects = [(shape, count) for shape, count in metrics.shapes.items() if count >= self.threshold]
+        for shape, count in suspects:
+            logger.warning('Possible N+1 in %s: %d x %s', view, count, shape)
+
+        size = 0 if response.streaming else len(response.content)
+        registry.record(view, queries=metrics.queries, sql_seconds=metrics.sql_time,
+                        template_seconds=metrics.template_time, duration_seconds=duration,
+                        response_bytes=size, n_plus_one_suspects=len(suspects))
+
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={metrics.sql_time * 1000:.1f};desc="{metrics.queries} queries"',
+            f'tpl;dur={metrics.template_time * 1000:.1f}',
+            f'total;dur={duration * 1000:.1f}',
+        ])
+        return response
+
+
+METRIC_HELP = {
+    'requests': ('counter', 'Requests handled'),
+    'queries': ('counter', 'SQL queries executed'),
+    'sql_seconds': ('counter', 'Time spent in SQL'),
+    'template_seconds': ('counter', 'Time spent rendering templates'),
+    'duration_seconds': ('counter', 'Time spent in the view including middleware below this one'),
+    'response_bytes': ('counter', 'Bytes of non streaming responses'),
+    'n_plus_one_suspects': ('counter', 'Repeated query shapes over the N+1 threshold'),
+}
+
+
+def prometheus_text(snapshot):
+    lines = []
+    for field, (kind, help_text) in METRIC_HELP.items():
+        name = f'lab1p_view_{field}_total'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for view, totals in sorted(snapshot.items()):
+            label = view.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append(f'{name}{{view="{label}"}} {totals[field]}')
+    return '\n'.join(lines) + '\n'
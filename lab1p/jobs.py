@@ -0,0 +1,158 @@
+import os
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models import F, Q
+from django.utils import timezone
+from tablib import Dataset
+
+from .exporter import export_rows, stream_csv, stream_xlsx, write_xls
+from .importer import BulkImporter, SyncImporter
+from .models import Book, Job
+
+IMPORT_FORMATS = ('xlsx', 'xls', 'csv')
+EXPORT_FORMATS = ('xlsx', 'xls', 'csv')
+
+# jobs started from this session, lets anonymous users follow their own jobs
+SESSION_KEY = 'jobs'
+
+
+def enqueue_import(request, upload, mode=Job.ADD):
+    extension = os.path.splitext(upload.name)[1].lower().lstrip('.')
+    job = Job(kind=Job.IMPORT, format=extension if extension in IMPORT_FORMATS else 'xlsx',
+              mode=mode if mode in dict(Job.MODE_CHOICES) else Job.ADD)
+    job.user = request.user if request.user.is_authenticated else None
+    job.input_file.save(os.path.basename(upload.name), upload, save=False)
+    job.save()
+    remember(request, job)
+    return job
+
+
+def enqueue_export(request, export_format):
+    job = Job(kind=Job.EXPORT, format=export_format if export_format in EXPORT_FORMATS else 'xlsx')
+    job.user = request.user if request.user.is_authenticated else None
+    job.save()
+    remember(request, job)
+    return job
+
+
+def remember(request, job):
+    request.session[SESSION_KEY] = request.session.get(SESSION_KEY, [])[-19:] + [job.pk]
+
+
+def can_access(request, job):
+    if request.user.is_staff:
+        return True
+    if job.user_id is not None:
+        return job.user_id == request.user.id
+    return job.pk in request.session.get(SESSION_KEY, [])
+
+
+def jobs_for(request, kind):
+    jobs = Job.objects.filter(kind=kind)
+    if request.user.is_authenticated:
+        return jobs.filter(user=request.user)[:10]
+    return jobs.filter(pk__in=request.session.get(SESSION_KEY, []))[:10]
+
+
+def lease_end():
+    return timezone.now() + timedelta(seconds=settings.JOBS_LEASE_TIMEOUT)
+
+
+def claim_next():
+    """ Takes the oldest pending job, or a running one whose lease ran out, for JOBS_LEASE_TIMEOUT seconds.
+
+    A job is taken by whoever changes it first, so several workers can share the queue.
+    If a worker dies, its job is claimed again once the lease runs out, up to JOBS_MAX_ATTEMPTS times."""
+    now = timezone.now()
+    due = Job.objects.filter(Q(status=Job.PENDING) | Q(status=Job.RUNNING, lease_expires__lte=now))
+    for pk, status, lease, attempts in due.order_by('created').values_list(
+            'id', 'status', 'lease_expires', 'attempts')[:10]:
+        claim = Job.objects.filter(pk=pk, status=status, lease_expires=lease)
+        if attempts >= settings.JOBS_MAX_ATTEMPTS:
+            claim.update(status=Job.FAILED, finished=now, lease_expires=None,
+                         errors=[f'The job was stopped {attempts} times before it finished'])
+            continue
+        if claim.update(status=Job.RUNNING, started=now, lease_expires=lease_end(), progress=0,
+                        attempts=F('attempts') + 1):
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def leased(job):
+    # the job while this worker holds it, every claim counts another attempt
+    return Job.objects.filter(pk=job.pk, status=Job.RUNNING, attempts=job.attempts)
+
+
+def set_progress(job, done):
+    # every step the job makes renews its lease
+    job.progress, job.lease_expires = done, lease_end()
+    leased(job).update(progress=done, lease_expires=job.lease_expires)
+
+
+def run_job(job):
+    """ Runs a claimed job and stores its result, unless the lease ran out and another worker has the job now.
+    Returns whether the result was stored."""
+    try:
+        if job.kind == Job.IMPORT:
+            run_import(job)
+        else:
+            run_export(job)
+        job.status = Job.DONE
+    except Exception as e:
+        job.status = Job.FAILED
+        job.errors = job.errors + [f'Error {e}']
+    job.finished = timezone.now()
+    job.lease_expires = None
+    stored = leased(job).update(status=job.status, errors=job.errors, diff=job.diff, total=job.total,
+                                progress=job.progress, result_file=job.result_file.name,
+                                finished=job.finished, lease_expires=None)
+    if not stored and job.result_file:
+        job.result_file.delete(save=False)
+    return bool(stored)
+
+
+def load_sheet(data, sheet_format):
+    if sheet_format == 'csv':
+        data = data.decode('utf-8-sig')
+    return Dataset().load(data, format=sheet_format)
+
+
+def run_import(job):
+    with job.input_file.open('rb') as upload:
+        imported_data = load_sheet(upload.read(), job.format)
+
+    job.total = len(imported_data)
+    Job.objects.filter(pk=job.pk).update(total=job.total)
+    if job.mode == Job.ADD:
+        importer = BulkImporter()
+    else:
+        importer = SyncImporter(dry_run=job.mode == Job.DRY_RUN)
+    job.errors = importer.run(imported_data, progress=lambda done: set_progress(job, done))
+    job.diff = getattr(importer, 'diff', {})
+
+
+def run_export(job):
+    job.total = Book.objects.count()
+    Job.objects.filter(pk=job.pk).update(total=job.total)
+
+    def rows():
+        for done, row in enumerate(export_rows(), start=1):
+            if done % 1000 == 0:
+                set_progress(job, done)
+            yield row
+        set_progress(job, job.total)
+
+    with tempfile.TemporaryFile() as result:
+        if job.format == 'csv':
+            for chunk in stream_csv(rows()):
+                result.write(chunk.encode('utf-8'))
+        elif job.format == 'xlsx':
+            for chunk in stream_xlsx(rows()):
+                result.write(chunk)
+        else:
+            write_xls(rows(), result)
+        result.seek(0)
+        job.result_file.save(f'Data_{job.pk}.{job.format}', File(result), save=False)
@@ -0,0 +1,181 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.signals import m2m_changed
+
+from .cache import get_versions
+from .models import Book, Collection, UserProfile
+
+# Likes and collection membership of one user, changed in batches.
+#
+# An operation is {"op": "like" | "unlike", "book": id}
+#             or {"op": "add" | "remove", "book": id, "collection": id}
+# Every through table gets at most one insert and one delete per batch. m2m_changed is
+# sent as the related managers would, so the receivers keeping caches fresh still run.
+
+MAX_OPERATIONS = 500
+SNAPSHOT_BOOKS = 5  # books shown per collection and liked books shown on the profile page
+LIKE_OPS = ('like', 'unlike')
+COLLECTION_OPS = ('add', 'remove')
+
+
+class BatchError(Exception):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def is_id(value):
+    # true and false are ints to Python, not ids
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse(user, operations):
+    """ Checks the operations and returns the wanted state, {book: liked} and {(collection, book): member}.
+
+    When an operation is repeated in the batch the last one wins."""
+    if not isinstance(operations, list) or not operations:
+        raise BatchError(['operations must be a non-empty list'])
+    if len(operations) > MAX_OPERATIONS:
+        raise BatchError([f'At most {MAX_OPERATIONS} operations can be sent at once'])
+
+    errors = []
+    likes, members = {}, {}
+    for i, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in LIKE_OPS + COLLECTION_OPS:
+            errors.append(f'{i}: op must be one of {", ".join(LIKE_OPS + COLLECTION_OPS)}')
+            continue
+        book, collection = operation.get('book'), operation.get('collection')
+        if not is_id(book) or (operation['op'] in COLLECTION_OPS and not is_id(collection)):
+            errors.append(f'{i}: book and collection must be ids')
+        elif operation['op'] in LIKE_OPS:
+            likes[book] = operation['op'] == 'like'
+        else:
+            members[(collection, book)] = operation['op'] == 'add'
+
+    book_ids = set(likes) | {book for _, book in members}
+    found = set(Book.objects.filter(id__in=book_ids).values_list('id', flat=True))
+    errors += [f'Book {book} does not exist' for book in sorted(book_ids - found)]
+    collection_ids = {collection for collection, _ in members}
+    own = set(Collection.objects.filter(id__in=collection_ids, creator=user).values_list('id', flat=True))
+    errors += [f'Collection {collection} is not yours' for collection in sorted(collection_ids - own)]
+    if errors:
+        raise BatchError(errors)
+    return likes, members
+
+
+def send_changed(through, instance, reverse, model, action, pk_set):
+    if pk_set:
+        using = router.db_for_write(through, instance=instance)
+        for when in ('pre', 'post'):
+            m2m_changed.send(sender=through, instance=instance, action=f'{when}_{action}', reverse=reverse,
+                             model=model, pk_set=pk_set, using=using)
+
+
+def apply_likes(profile, likes):
+    through = UserProfile.books.through
+    rows = dict(through.objects.filter(userprofile=profile, book_id__in=list(likes)).values_list('book_id', 'id'))
+    added = {book for book, liked in likes.items() if liked and book not in rows}
+    removed = {book for book, liked in likes.items() if not liked and book in rows}
+
+    # ignore_conflicts, a row inserted by a concurrent request since the select is not an error
+    through.objects.bulk_create([through(userprofile=profile, book_id=book) for book in added], ignore_conflicts=True)
+    through.objects.filter(id__in=[rows[book] for book in removed]).delete()
+    send_changed(through, profile, False, Book, 'add', added)
+    send_changed(through, profile, False, Book, 'remove', removed)
+    return {'added': sorted(added), 'removed': sorted(removed)}
+
+
+def apply_members(members):
+    through = Book.collections.through
+    collection_ids = {collection for collection, _ in members}
+    book_ids = {book for _, book in members}
+    rows = {(collection, book): pk for pk, collection, book in through.objects.filter(
+        collection_id__in=collection_ids, book_id__in=book_ids).values_list('id', 'collection_id', 'book_id')}
+    added = [key for key, member in members.items() if member and key not in rows]
+    removed = [key for key, member in members.items() if not member and key in rows]
+
+    through.objects.bulk_create([through(collection_id=collection, book_id=book) for collection, book in added],
+                                ignore_conflicts=True)
+    through.objects.filter(id__in=[rows[key] for key in removed]).delete()
+
+    changes = {}
+    for collection, book in added:
+        changes.setdefault(collection, {'added': [], 'removed': []})['added'].append(book)
+    for collection, book in removed:
+        changes.setdefault(collection, {'added': [], 'removed': []})['removed'].append(book)
+    collections = Collection.objects.in_bulk(list(changes))
+    for collection, change in changes.items():
+        send_changed(through, collections[collection], True, Book, 'add', set(change['added']))
+        send_changed(through, collections[collection], True, Book, 'remove', set(change['removed']))
+    return {collection: {key: sorted(books) for key, books in change.items()} for collection, change in changes.items()}
+
+
+def apply_batch(user, operations):
+    """ Applies the operations for user and returns only what changed:
+    {"likes": {"added": [...], "removed": [...]}, "collections": {id: {"added": [...], "removed": [...]}}}"""
+    likes, members = parse(user, operations)
+    with transaction.atomic():
+        result = {'likes': {'added': [], 'removed': []}, 'collections': {}}
+        if likes:
+            result['likes'] = apply_likes(user.profile, likes)
+        if members:
+            result['collections'] = apply_members(members)
+    return result
+
+
+# Everything the profile pages show about a user's library, in a fixed number of queries
+# and cached per user. The key is built from the versions of 'collections:<user id>',
+# 'profile:<user id>' and 'books' (see pagecache.py), so a change of the collections,
+# the likes, the status or any book makes a new snapshot.
+
+def snapshot_namespaces(user_id):
+    return [f'collections:{user_id}', f'profile:{user_id}', 'books']
+
+
+def book_data(book):
+    return {'id': book.pk, 'title': book.title,
+            'author': {'id': book.author_id, 'name': str(book.author)}}
+
+
+def build_snapshot(user):
+    profile = UserProfile.objects.get(user=user)
+    collections = list(Collection.objects.filter(creator=user).annotate(
+        books_count=Count('books_for_collection')).order_by('Name', 'id'))
+
+    # the first books of every collection in one query, a LIMIT per collection in a subquery
+    through = Book.collections.through
+    first = through.objects.filter(collection_id=OuterRef('collection_id')).order_by(
+        'book__title', 'book_id').values('id')[:SNAPSHOT_BOOKS]
+    rows = through.objects.filter(collection__creator=user, id__in=Subquery(first)).select_related(
+        'book__author').order_by('book__title', 'book_id')
+    books = {}
+    for row in rows:
+        books.setdefault(row.collection_id, []).append(book_data(row.book))
+
+    liked = profile.books.select_related('author').order_by('title', 'id')
+    return {
+        'status': profile.status,
+        'bio': profile.bio,
+        'collections': [{
+            'id': collection.pk,
+            'name': collection.Name,
+            'information': collection.Information,
+            'books_count': collection.books_count,
+            'books': books.get(collection.pk, []),
+        } for collection in collections],
+        'liked_count': liked.count(),
+        'liked': [book_data(book) for book in liked[:SNAPSHOT_BOOKS]],
+    }
+
+
+def snapshot(user):
+    """ The cached library snapshot of user, built again when one of its namespaces is bumped."""
+    versions = '-'.join(str(version) for version in get_versions(*snapshot_namespaces(user.pk)))
+    key = f'lab1p:library:{user.pk}:{versions}'
+    data = cache.get(key)
+    if data is None:
+        data = build_snapshot(user)
+        cache.set(key, data, settings.PAGE_CACHE_TIMEOUT)
+    return data
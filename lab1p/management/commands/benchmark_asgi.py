@@ -0,0 +1,127 @@
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lab1p.benchmark import percentile
+from lab1p.models import Author, Book
+
+
+def default_paths():
+    book = Book.objects.order_by('id').first()
+    author = Author.objects.order_by('id').first()
+    if book is None or author is None:
+        raise CommandError('The database is empty, run seed_library first')
+    return ['/lab1p/', '/lab1p/books/', '/lab1p/authors/', f'/lab1p/{author.pk}/', f'/lab1p/book/{book.pk}/',
+            '/lab1p/search/']
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {name.lower(): value.strip() for name, _, value in (line.partition(':') for line in lines[1:] if line)}
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return status
+
+
+async def client(port, host, paths, deadline, timings, statuses):
+    # one keep-alive connection sending requests one after another, like a browser tab would
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+            await writer.drain()
+            status = await read_response(reader)
+            timings.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def load(port, host, paths, concurrency, duration):
+    timings, statuses = [], {}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, host, paths[i % len(paths):] + paths[:i % len(paths)], deadline,
+                                  timings, statuses) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        'requests_per_second': round(len(timings) / elapsed, 1),
+        'p50_ms': round(percentile(timings, 50) * 1000, 2),
+        'p95_ms': round(percentile(timings, 95) * 1000, 2),
+        'statuses': statuses,
+    }
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise CommandError('uvicorn exited, see its output above')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f'uvicorn did not start listening on port {port}')
+
+
+class Command(BaseCommand):
+    help = ('Starts uvicorn with the sync and then with the async views (ASYNC_VIEWS) and measures '
+            'requests per second and latency of the read-only pages under concurrent keep-alive '
+            'connections. Uses the configured database, seed it first with seed_library.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per mode')
+        parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--host', default='localhost', help='Host header, must be in ALLOWED_HOSTS')
+        parser.add_argument('--path', action='append', dest='paths', help='Page to request, can be repeated')
+        parser.add_argument('--mode', action='append', dest='modes', choices=['sync', 'async'])
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if importlib.util.find_spec('uvicorn') is None:
+            raise CommandError('uvicorn is not installed, pip install uvicorn')
+        paths = options['paths'] or default_paths()
+        results = {}
+        for mode in options['modes'] or ['sync', 'async']:
+            env = {**os.environ, 'ASYNC_VIEWS': '1' if mode == 'async' else '0'}
+            process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'lab1Prj.asgi:application',
+                                        '--port', str(options['port']), '--workers', str(options['workers']),
+                                        '--log-level', 'warning', '--no-access-log'], env=env)
+            try:
+                wait_for_port(options['port'], process)
+                # the first requests fill the page cache and the template cache
+                asyncio.run(load(options['port'], options['host'], paths, len(paths), 1))
+                results[mode] = asyncio.run(load(options['port'], options['host'], paths,
+                                                 options['concurrency'], options['duration']))
+            finally:
+                process.terminate()
+                process.wait()
+            result = results[mode]
+            self.stdout.write(f'{mode:5} {result["requests_per_second"]:>8} req/s  p50 {result["p50_ms"]:>8} ms  '
+                              f'p95 {result["p95_ms"]:>8} ms  {result["statuses"]}')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'paths': paths, 'concurrency': options['concurrency'], 'results': results}, f, indent=2)
@@ -0,0 +1,69 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from lab1p.benchmark import CACHES, ENDPOINTS, compare, run_benchmark
+from lab1p.models import Book
+from lab1p.seed import Seeder
+
+
+class Command(BaseCommand):
+    help = ('Requests the main pages through the Django test client and reports p50/p95 latency, '
+            'query counts and peak memory per endpoint. By default a test database is created and '
+            'seeded, so results of two versions of the code can be compared.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--cold', action='store_true', help='Clear the benchmark cache before every request')
+        parser.add_argument('--anonymous', action='store_true', help='Do not log in as a seeded user')
+        parser.add_argument('--endpoint', action='append', dest='only', choices=ENDPOINTS,
+                            help='Only this endpoint, can be repeated')
+        parser.add_argument('--current-db', action='store_true',
+                            help='Use the data already in the configured database instead of seeding a test one, '
+                                 'the import endpoint is left out unless named by --endpoint')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            if old_name is not None:
+                # the refresh after seeding bumps the namespaces of the benchmark cache, not of the site's
+                with override_settings(CACHES=CACHES):
+                    Seeder(seed=options['seed'], stdout=self.stdout).run(books=options['books'],
+                                                                         users=options['users'])
+            if not Book.objects.exists():
+                raise CommandError('There are no books to request')
+            user = None if options['anonymous'] else User.objects.filter(profile__isnull=False).order_by(
+                'id').first()
+            only = options['only']
+            if old_name is None and not only:
+                # the import adds its books to the database, only when asked for by --endpoint import
+                only = [name for name in ENDPOINTS if name != 'import']
+            results = run_benchmark(options['repeat'], user, options['cold'], only)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, result in results['endpoints'].items():
+            self.stdout.write(f'{name:16} {result["status"]}  p50 {result["p50_ms"]:>9} ms  '
+                              f'p95 {result["p95_ms"]:>9} ms  {result["queries"]:>3} queries  '
+                              f'{result["peak_memory_kb"]:>9} KiB')
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                for line in compare(json.load(f), results):
+                    self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
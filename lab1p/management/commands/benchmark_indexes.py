@@ -0,0 +1,101 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from lab1p.models import Author, Book, Collection, Comment
+from lab1p.pagination import after, AUTHOR_ORDERING, BOOK_ORDERING, COMMENT_ORDERING
+from lab1p.seed import Seeder
+
+# lookup indexes added by migration 0030, dropped for the "before" run
+NEW_INDEXES = [index.name for model in (Author, Book, Comment) for index in model._meta.indexes]
+
+
+def hot_queries():
+    """ The query shapes views.py runs most, built on whatever data is in the database."""
+    middle_book = Book.objects.order_by('id')[Book.objects.count() // 2:][:1].get()
+    author = middle_book.author
+    collection = Collection.objects.order_by('id').first()
+    comments = Comment.objects.filter(book=middle_book).order_by(*COMMENT_ORDERING)
+    middle_comment = comments[comments.count() // 2:][:1].first()
+    queries = {
+        'books page 1': Book.objects.for_cards().order_by(*BOOK_ORDERING)[:24],
+        'authors page 1': Author.objects.order_by(*AUTHOR_ORDERING)[:24],
+        'main latest authors': Author.objects.order_by('-Name')[:5],
+        'author detail books': Book.objects.filter(author=author).for_cards(),
+        'book comments': comments[:20],
+    }
+    keysets = [('books', Book.objects.for_cards(), BOOK_ORDERING, [middle_book.title, middle_book.id], 24),
+               ('authors', Author.objects.all(), AUTHOR_ORDERING, [author.Name, author.Surname, author.id], 24)]
+    if middle_comment is not None:
+        keysets.append(('book comments', comments, COMMENT_ORDERING,
+                        [middle_comment.date_added, middle_comment.id], 20))
+    for name, queryset, ordering, values, size in keysets:
+        queries[f'{name} deep page'] = queryset.filter(after(ordering, values)).order_by(*ordering)[:size]
+        # the leading a >= x bound of the keyset filter is kept for the plans it changes
+        queries[f'{name} deep page, no seek bound'] = queryset.filter(
+            after(ordering, values, seek=False)).order_by(*ordering)[:size]
+    if collection is not None:
+        queries['user collections'] = Collection.objects.filter(creator_id=collection.creator_id)
+        queries['collection by name'] = Collection.objects.filter(creator_id=collection.creator_id,
+                                                                  Name=collection.Name)
+    return queries
+
+
+def measure(queries, repeat):
+    results = {}
+    for name, queryset in queries.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(queryset.all())
+            timings.append(time.perf_counter() - start)
+        results[name] = {
+            'plan': queryset.explain(),
+            'best_ms': round(min(timings) * 1000, 3),
+        }
+    return results
+
+
+def analyze():
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+class Command(BaseCommand):
+    help = ('Shows query plans and timings of the hot queries with and without the lookup indexes. '
+            'Runs in a transaction that is rolled back, seeded rows and dropped indexes included.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Generate this many books first, e.g. 1000000')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--json', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['seed']:
+                # the index, counters and cache live partly outside the transaction, so they are left alone
+                Seeder(stdout=self.stdout).run(books=options['seed'], refresh=False)
+            if not Book.objects.exists():
+                raise CommandError('There are no books to query, use --seed')
+            analyze()
+            queries = hot_queries()
+            results = {'after': measure(queries, options['repeat'])}
+
+            with connection.cursor() as cursor:
+                for name in NEW_INDEXES:
+                    cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+            analyze()
+            results['before'] = measure(queries, options['repeat'])
+            transaction.set_rollback(True)
+
+        for name in queries:
+            before, after_ = results['before'][name], results['after'][name]
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f'  before {before["best_ms"]} ms: {before["plan"]}')
+            self.stdout.write(f'  after  {after_["best_ms"]} ms: {after_["plan"]}')
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,104 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction, OperationalError
+from django.test.utils import override_settings
+
+from lab1p.benchmark import percentile
+
+TABLE = 'lab1p_write_benchmark'
+
+CREATE_SQL = {
+    'sqlite': f'CREATE TABLE {TABLE} (id integer PRIMARY KEY AUTOINCREMENT, worker integer, payload text)',
+    'postgresql': f'CREATE TABLE {TABLE} (id serial PRIMARY KEY, worker integer, payload text)',
+}
+
+
+def writer(number, writes, timings, errors):
+    try:
+        for i in range(writes):
+            start = time.perf_counter()
+            try:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(f'INSERT INTO {TABLE} (worker, payload) VALUES (%s, %s)', [number, 'x' * 200])
+                timings.append(time.perf_counter() - start)
+            except OperationalError:  # database is locked
+                errors.append(i)
+    finally:
+        connection.close()
+
+
+def reader(stop, reads):
+    try:
+        while not stop.is_set():
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT count(*), max(id) FROM {TABLE}')
+                cursor.fetchone()
+            reads.append(1)
+    finally:
+        connection.close()
+
+
+def run(workers, writes, readers):
+    timings, errors, reads = [], [], []
+    stop = threading.Event()
+    threads = [threading.Thread(target=writer, args=(number, writes, timings, errors)) for number in range(workers)]
+    reading = [threading.Thread(target=reader, args=(stop, reads)) for _ in range(readers)]
+    start = time.perf_counter()
+    for thread in threads + reading:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in reading:
+        thread.join()
+    return {
+        'writes_per_second': round(len(timings) / elapsed, 1),
+        'reads_per_second': round(len(reads) / elapsed, 1),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3) if timings else None,
+        'p95_ms': round(percentile(timings, 95) * 1000, 3) if timings else None,
+        'failed': len(errors),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Measures concurrent write throughput of the configured database: every worker thread commits '
+            'small transactions into a scratch table while reader threads query it. On SQLite the run is '
+            'repeated with the rollback journal and with WAL. The scratch table is dropped afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--writes', type=int, default=200, help='Transactions per worker')
+        parser.add_argument('--readers', type=int, default=2)
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in CREATE_SQL:
+            self.stderr.write(f'No benchmark for {vendor}')
+            return
+
+        # journal_mode is a property of the database file, so every mode runs with its own pragmas
+        profiles = {connection.settings_dict['ENGINE']: {}}
+        if vendor == 'sqlite':
+            profiles = {
+                'sqlite, rollback journal': {**settings.SQLITE_PRAGMAS, 'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+                'sqlite, WAL': settings.SQLITE_PRAGMAS,
+            }
+
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_SQL[vendor])
+        try:
+            for name, pragmas in profiles.items():
+                with override_settings(SQLITE_PRAGMAS=pragmas):
+                    connections.close_all()
+                    result = run(options['workers'], options['writes'], options['readers'])
+                    connections.close_all()
+                self.stdout.write(f'{name}: {result["writes_per_second"]} writes/s, '
+                                  f'{result["reads_per_second"]} reads/s, p50 {result["p50_ms"]} ms, '
+                                  f'p95 {result["p95_ms"]} ms, {result["failed"]} failed')
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE {TABLE}')
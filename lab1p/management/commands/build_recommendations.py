@@ -0,0 +1,25 @@
+import importlib.util
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lab1p import recommend
+
+
+class Command(BaseCommand):
+    help = ('Computes "readers also liked" for every book from the likes and the collections and '
+            'replaces the stored ones. Needs NumPy and SciPy, run it after seeding or on a schedule.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=recommend.TOP_K, help='Neighbours kept per book')
+        parser.add_argument('--min-common', type=int, default=recommend.MIN_COMMON,
+                            help='Likes or collections two books must share')
+        parser.add_argument('--block', type=int, default=recommend.BLOCK, help='Books per matrix product')
+
+    def handle(self, *args, **options):
+        for module in ('numpy', 'scipy'):
+            if importlib.util.find_spec(module) is None:
+                raise CommandError(f'{module} is not installed, pip install numpy scipy')
+        started = time.perf_counter()
+        stored = recommend.build(options['top_k'], options['min_common'], options['block'], stdout=self.stdout)
+        self.stdout.write(f'{stored} neighbours stored in {time.perf_counter() - started:.1f} s')
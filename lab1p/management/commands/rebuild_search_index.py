@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from lab1p import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full text search index of books from scratch'
+
+    def handle(self, *args, **options):
+        if search.backend() is None:
+            self.stdout.write('The database backend has no full text index, search uses LIKE queries')
+            return
+        count = search.rebuild_index()
+        self.stdout.write(f'Indexed {count} books')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from lab1p import stats
+from lab1p.cache import bump_many
+
+
+class Command(BaseCommand):
+    help = 'Recounts the totals shown on the main page and the comment counts of the books, fixes the ones that drifted'
+
+    def handle(self, *args, **options):
+        drift = stats.reconcile()
+        fixed = stats.recount_comments()
+        if not drift and not fixed:
+            self.stdout.write('All counters are correct')
+        for name, (stored, actual) in drift.items():
+            self.stdout.write(f'{name}: {stored} -> {actual}')
+        if fixed:
+            # the detail page of every fixed book shows its count too
+            bump_many(['comments'] + [f'book:{pk}' for pk in fixed])
+            self.stdout.write(f'Comment count fixed for {len(fixed)} books')
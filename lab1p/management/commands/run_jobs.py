@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from lab1p.jobs import claim_next, run_job
+
+
+class Command(BaseCommand):
+    help = 'Runs queued import/export jobs. Jobs are kept in the database, no broker is needed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the jobs that are queued now and exit')
+        parser.add_argument('--sleep', type=float, default=settings.JOBS_POLL_INTERVAL,
+                            help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        if isinstance(caches['default'], LocMemCache):
+            # the versions bumped by the imports would stay in this process
+            self.stderr.write(self.style.WARNING(
+                'The default cache is local memory, pages of the site will not see the changes of these jobs. '
+                'Set CACHE_BACKEND to a shared backend.'))
+        while True:
+            job = claim_next()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write(f'Running {job}')
+            if run_job(job):
+                self.stdout.write(f'Finished {job}')
+            else:
+                self.stderr.write(f'The lease of {job} ran out and another worker took it, the result is dropped')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from lab1p.seed import PASSWORD, Seeder
+
+
+class Command(BaseCommand):
+    help = ('Fills the database with generated authors, books, genres, users, collections and comments. '
+            'The same --seed always generates the same library.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000)
+        parser.add_argument('--authors', type=int, help='Defaults to a tenth of the books')
+        parser.add_argument('--genres', type=int, default=50)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--collections', type=int, default=2, help='Collections per user besides "To read"')
+        parser.add_argument('--likes', type=int, default=10, help='Liked books per user')
+        parser.add_argument('--comments', type=int, help='Defaults to half of the books')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        seeder = Seeder(seed=options['seed'], batch_size=options['batch_size'], stdout=self.stdout)
+        seeder.run(books=options['books'], authors=options['authors'], genres=options['genres'],
+                   comments=options['comments'], users=options['users'], collections=options['collections'],
+                   likes=options['likes'])
+        if options['users']:
+            self.stdout.write(f'Seeded users log in with the password "{PASSWORD}"')
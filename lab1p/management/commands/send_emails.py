@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lab1p.outbox import claim_batch, send_batch
+
+
+class Command(BaseCommand):
+    help = 'Sends the queued emails in batches over one connection, retrying the ones that failed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send the emails that are due now and exit')
+        parser.add_argument('--sleep', type=float, default=settings.OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when nothing is due')
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        while True:
+            emails = claim_batch(options['batch_size'])
+            if not emails:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            sent = send_batch(emails)
+            self.stdout.write(f'Sent {sent} of {len(emails)} emails')
@@ -0,0 +1,44 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lab1p.importer import SyncImporter
+from lab1p.jobs import IMPORT_FORMATS, load_sheet
+
+
+class Command(BaseCommand):
+    help = ('Makes the books match a catalog sheet laid out like the export (xls, xlsx or csv): rows that '
+            'changed since the last sync are created or updated, the others are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--dry-run', action='store_true', help='Print the changes without writing them')
+        parser.add_argument('--diff', help='Write the changes as JSON to this file')
+
+    def handle(self, *args, **options):
+        sheet_format = os.path.splitext(options['path'])[1].lower().lstrip('.')
+        if sheet_format not in IMPORT_FORMATS:
+            raise CommandError(f'The sheet must be one of {", ".join(IMPORT_FORMATS)}')
+        with open(options['path'], 'rb') as f:
+            rows = load_sheet(f.read(), sheet_format)
+
+        started = time.perf_counter()
+        importer = SyncImporter(dry_run=options['dry_run'])
+        errors = importer.run(rows)
+        diff = importer.diff
+        for row in diff['rows']:
+            fields = ' '.join(f'{name}: {old} -> {new}' for name, (old, new) in row.get('fields', {}).items())
+            genres = ' '.join([f'+{name}' for name in row['genres_added']] +
+                              [f'-{name}' for name in row.get('genres_removed', [])])
+            self.stdout.write(f'{row["action"]:8} {row["isbn"]} {row["title"]} {fields} {genres}'.rstrip())
+        for error in errors:
+            self.stderr.write(error)
+        self.stdout.write(f'{"Dry run, " if options["dry_run"] else ""}{len(rows)} rows in '
+                          f'{time.perf_counter() - started:.1f} s: {diff["created"]} created, {diff["updated"]} '
+                          f'updated, {diff["skipped"] + diff["unchanged"]} unchanged, {diff["authors"]} new authors, '
+                          f'{diff["genres"]} new genres, genre links +{diff["genres_added"]} -{diff["genres_removed"]}')
+        if options['diff']:
+            with open(options['diff'], 'w') as f:
+                json.dump({'diff': diff, 'errors': errors}, f, indent=2)
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+# The index as it was made when this migration was written, search.py changes with the code.
+
+TABLE = 'lab1p_booksearch'
+
+DOCUMENTS_SQL = {
+    'sqlite': (
+        "SELECT b.id, b.title, a.\"Name\" || ' ' || a.\"Surname\", "
+        "COALESCE((SELECT group_concat(g.\"Name\", ' ') FROM lab1p_book_genre bg "
+        "JOIN lab1p_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), ''), b.\"Information\" "
+        "FROM lab1p_book b JOIN lab1p_author a ON a.id = b.author_id"
+    ),
+    'postgresql': (
+        "SELECT b.id, b.title, a.\"Name\" || ' ' || a.\"Surname\", "
+        "COALESCE((SELECT string_agg(g.\"Name\", ' ') FROM lab1p_book_genre bg "
+        "JOIN lab1p_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), ''), b.\"Information\" "
+        "FROM lab1p_book b JOIN lab1p_author a ON a.id = b.author_id"
+    ),
+}
+
+INSERT_SQL = {
+    'sqlite': f"INSERT INTO {TABLE} (rowid, title, author, genres, information) {{select}}",
+    'postgresql': (
+        f"INSERT INTO {TABLE} (book_id, document) "
+        f"SELECT id, setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', author), 'B') || "
+        f"setweight(to_tsvector('simple', genres), 'C') || setweight(to_tsvector('simple', information), 'D') "
+        f"FROM ({{select}}) AS documents (id, title, author, genres, information)"
+    ),
+}
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+            f"title, author, genres, information, tokenize='unicode61 remove_diacritics 2')")
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE TABLE {TABLE} ("
+            f"book_id bigint PRIMARY KEY REFERENCES lab1p_book (id) ON DELETE CASCADE, "
+            f"document tsvector NOT NULL)")
+        schema_editor.execute(f"CREATE INDEX {TABLE}_document ON {TABLE} USING GIN (document)")
+    if vendor in DOCUMENTS_SQL:
+        schema_editor.execute(INSERT_SQL[vendor].format(select=DOCUMENTS_SQL[vendor]))
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab1p', '0027_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_stats(apps, schema_editor):
+    LibraryStats = apps.get_model('lab1p', 'LibraryStats')
+    counted = {
+        'books': apps.get_model('lab1p', 'Book'),
+        'authors': apps.get_model('lab1p', 'Author'),
+        'genres': apps.get_model('lab1p', 'Genre'),
+        'users': apps.get_model(settings.AUTH_USER_MODEL),
+    }
+    LibraryStats.objects.bulk_create(
+        [LibraryStats(name=name, value=model.objects.count()) for name, model in counted.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lab1p', '0028_book_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LibraryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'library stats',
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:56
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_comments(apps, schema_editor):
+    Book = apps.get_model('lab1p', 'Book')
+    Comment = apps.get_model('lab1p', 'Comment')
+    counts = Comment.objects.filter(book_id=OuterRef('pk')).order_by().values('book_id').annotate(
+        count=Count('id')).values('count')
+    Book.objects.update(comment_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab1p', '0031_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
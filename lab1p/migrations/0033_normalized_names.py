@@ -0,0 +1,123 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:02
+
+import re
+import unicodedata
+
+from django.db import migrations
+import lab1p.models
+
+# The search keys and the index as they were made when this migration was written, text.py
+# and search.py change with the code.
+
+CYRILLIC = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'ie', 'ж': 'zh', 'з': 'z',
+    'и': 'y', 'і': 'i', 'ї': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ь': '', 'ю': 'iu', 'я': 'ia', 'ё': 'e', 'ъ': '', 'ы': 'y', 'э': 'e',
+}
+CYRILLIC_INITIAL = {'є': 'ye', 'ї': 'yi', 'й': 'y', 'ю': 'yu', 'я': 'ya'}
+APOSTROPHES = re.compile("['’ʼ`´]")
+WORD = re.compile(r'\w+')
+BATCH_SIZE = 500
+
+
+def transliterate(word):
+    letters = []
+    for i, char in enumerate(word):
+        if i == 0 and char in CYRILLIC_INITIAL:
+            letters.append(CYRILLIC_INITIAL[char])
+        elif char == 'г' and i > 0 and word[i - 1] == 'з':
+            letters.append('gh')
+        else:
+            letters.append(CYRILLIC.get(char, char))
+    return ''.join(letters)
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFC', APOSTROPHES.sub('', text.casefold()))
+    text = WORD.sub(lambda match: transliterate(match.group()), text)
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return ' '.join(WORD.findall(text))
+
+
+TABLE = 'lab1p_booksearch'
+
+DOCUMENTS_SQL = {
+    'sqlite': (
+        "SELECT b.id, b.title_normalized, a.name_normalized, "
+        "COALESCE((SELECT group_concat(g.name_normalized, ' ') FROM lab1p_book_genre bg "
+        "JOIN lab1p_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), ''), b.\"Information\" "
+        "FROM lab1p_book b JOIN lab1p_author a ON a.id = b.author_id"
+    ),
+    'postgresql': (
+        "SELECT b.id, b.title_normalized, a.name_normalized, "
+        "COALESCE((SELECT string_agg(g.name_normalized, ' ') FROM lab1p_book_genre bg "
+        "JOIN lab1p_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), ''), b.\"Information\" "
+        "FROM lab1p_book b JOIN lab1p_author a ON a.id = b.author_id"
+    ),
+}
+
+INSERT_SQL = {
+    'sqlite': f"INSERT INTO {TABLE} (rowid, title, author, genres, information) {{select}}",
+    'postgresql': (
+        f"INSERT INTO {TABLE} (book_id, document) "
+        f"SELECT id, setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', author), 'B') || "
+        f"setweight(to_tsvector('simple', genres), 'C') || setweight(to_tsvector('simple', information), 'D') "
+        f"FROM ({{select}}) AS documents (id, title, author, genres, information)"
+    ),
+}
+
+
+def fill_normalized(apps, schema_editor):
+    for model, field, sources in (('Author', 'name_normalized', ('Name', 'Surname')),
+                                  ('Book', 'title_normalized', ('title',)),
+                                  ('Genre', 'name_normalized', ('Name',))):
+        Model = apps.get_model('lab1p', model)
+        # a batch at a time, a large catalog doesn't fit in memory at once
+        batch = []
+        for obj in Model.objects.only(*sources).iterator(chunk_size=BATCH_SIZE):
+            setattr(obj, field, normalize(' '.join(getattr(obj, source) for source in sources))[:255])
+            batch.append(obj)
+            if len(batch) == BATCH_SIZE:
+                Model.objects.bulk_update(batch, [field])
+                batch = []
+        if batch:
+            Model.objects.bulk_update(batch, [field])
+
+
+def rebuild_index(apps, schema_editor):
+    # the search index is built from the normalized columns now
+    vendor = schema_editor.connection.vendor
+    if vendor in DOCUMENTS_SQL:
+        schema_editor.execute(f"DELETE FROM {TABLE}")
+        schema_editor.execute(INSERT_SQL[vendor].format(select=DOCUMENTS_SQL[vendor]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab1p', '0032_book_comment_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='name_normalized',
+            field=lab1p.models.NormalizedField(db_index=True, default='', editable=False, max_length=255, sources=('Name', 'Surname')),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='title_normalized',
+            field=lab1p.models.NormalizedField(db_index=True, default='', editable=False, max_length=255, sources=('title',)),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='name_normalized',
+            field=lab1p.models.NormalizedField(db_index=True, default='', editable=False, max_length=255, sources=('Name',)),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_normalized, migrations.RunPython.noop),
+        migrations.RunPython(rebuild_index, migrations.RunPython.noop),
+    ]
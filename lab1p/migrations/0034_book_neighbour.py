@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab1p', '0033_normalized_names'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookNeighbour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='lab1p.book')),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lab1p.book')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['book', 'rank'], name='neighbour_book_rank_idx')],
+            },
+        ),
+    ]
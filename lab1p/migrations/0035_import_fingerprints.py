@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab1p', '0034_book_neighbour'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='import_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='diff',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='mode',
+            field=models.CharField(choices=[('add', 'Add new books'), ('sync', 'Sync changes'), ('dry_run', 'Show changes only')], default='add', max_length=10),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:52
+
+from django.db import migrations
+import lab1p.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab1p', '0037_job_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='author',
+            name='name_normalized',
+            field=lab1p.models.NormalizedField(editable=False, max_length=255, sources=('Name', 'Surname')),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='title_normalized',
+            field=lab1p.models.NormalizedField(editable=False, max_length=255, sources=('title',)),
+        ),
+        migrations.AlterField(
+            model_name='genre',
+            name='name_normalized',
+            field=lab1p.models.NormalizedField(editable=False, max_length=255, sources=('Name',)),
+        ),
+    ]
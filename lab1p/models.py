@@ -1,15 +1,44 @@
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .text import normalize
+
+
+class NormalizedField(models.CharField):
+    """ The search key (see text.py) of the source fields, set on every save and bulk_create.
+
+    QuerySet.update() doesn't set it, update the source fields through save()."""
+
+    def __init__(self, *args, sources=(), **kwargs):
+        self.sources = tuple(sources)
+        kwargs.setdefault('max_length', 255)
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['sources'] = self.sources
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = normalize(' '.join(str(getattr(model_instance, source)) for source in self.sources))
+        value = value[:self.max_length]
+        setattr(model_instance, self.attname, value)
+        return value
+
 
 class Author(models.Model):
     Name = models.CharField(max_length=30, blank=False)
     Surname = models.CharField(max_length=30, blank=False)
     Bio = models.CharField(max_length=200, default='No bio', blank=True)
+    name_normalized = NormalizedField(sources=('Name', 'Surname'))
 
     def __str__(self):
         return f'{self.Name} {self.Surname}'
@@ -27,6 +56,7 @@ class Author(models.Model):
     class Meta:
         unique_together = ("Name", "Surname")
         ordering = ['Name', 'Surname']
+        # (Name, Surname) is unique, so its index already serves the (Name, Surname, id) keyset of the authors page
 
     def get_absolute_url(self):
         return reverse('author-detail', args=[str(self.id)])
@@ -40,6 +70,7 @@ def validate_genre(value):
 
 class Genre(models.Model):
     Name = models.CharField(max_length=30, unique=True)
+    name_normalized = NormalizedField(sources=('Name',))
 
     def __str__(self):
         return self.Name
@@ -117,17 +148,36 @@ def validate_name(value):
     if value == '':
         raise ValidationError("Title cannot be blank")
 
+class BookQuerySet(models.QuerySet):
+    def for_cards(self):
+        # everything a book card shows: author joined, genres prefetched and the genre count
+        # as a subquery, so the main query stays a plain scan over books
+        genre_count = Book.genre.through.objects.filter(book_id=OuterRef('pk')).order_by().values(
+            'book_id').annotate(count=Count('id')).values('count')
+        return self.select_related('author').prefetch_related('genre').annotate(
+            num_genres=Coalesce(Subquery(genre_count), 0))
 
+    def for_detail(self):
+        # genres and the first comments are read by the template, so nothing is loaded for them
+        # when the page is cached
+        return self.select_related('author')
 
 
 class Book(models.Model):
     # must add validators [**options]
     title = models.CharField(max_length=50, blank=False)
+    title_normalized = NormalizedField(sources=('title',))
     author = models.ForeignKey(Author, on_delete=models.CASCADE, related_name='auth_books')
     isbn = models.CharField('ISBN', max_length=13, unique=True, validators=[validate_isbn])
     genre = models.ManyToManyField(Genre, related_name='books', blank=True)
     Information = models.TextField(blank=True, max_length=1000, default='No info')
     collections = models.ManyToManyField(Collection, blank=True, related_name='books_for_collection')
+    # kept up to date by the comment signals, see stats.py
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    # hash of the sheet row that last wrote the book, rows that didn't change are skipped by the sync import
+    import_fingerprint = models.CharField(max_length=40, blank=True, editable=False)
+
+    objects = BookQuerySet.as_manager()
 
     def clean(self):
         validate_isbn(self.isbn)
@@ -144,11 +194,32 @@ class Book(models.Model):
 
     class Meta:
         unique_together = ("title", "author")
+        indexes = [
+            # book listings, keyset pagination on (title, id)
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('book-detail', args=[str(self.id)])
 
 
+class BookNeighbour(models.Model):
+    # "readers also liked", written by python manage.py build_recommendations (recommend.py)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='neighbours')
+    neighbour = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            # the neighbours of a book, best first
+            models.Index(fields=['book', 'rank'], name='neighbour_book_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.book_id} -> {self.neighbour_id} ({self.score:.3f})'
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     status = models.CharField(max_length=250, default='', blank=True)
@@ -177,6 +248,12 @@ class Comment(models.Model):
     text = models.TextField(max_length=255)
     date_added = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # comments of a book in the order they were written
+            models.Index(fields=['book', 'date_added', 'id'], name='comment_book_date_idx'),
+        ]
+
     def clean(self):
         for char in self.name:
             if not (char.isalpha() or char == ' ' or char == '-'):
@@ -184,3 +261,110 @@ class Comment(models.Model):
 
     def __str__(self):
         return '%s - %s' % (self.book.title, self.name)
+
+
+class Job(models.Model):
+    IMPORT = 'import'
+    EXPORT = 'export'
+    KIND_CHOICES = [
+        (IMPORT, _('Import')),
+        (EXPORT, _('Export')),
+    ]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    ]
+
+    # how an import treats books that already exist, see importer.py
+    ADD = 'add'
+    SYNC = 'sync'
+    DRY_RUN = 'dry_run'
+    MODE_CHOICES = [
+        (ADD, _('Add new books')),
+        (SYNC, _('Sync changes')),
+        (DRY_RUN, _('Show changes only')),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    mode = models.CharField(max_length=10, choices=MODE_CHOICES, default=ADD)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='jobs', null=True, blank=True)
+    format = models.CharField(max_length=10, default='xls')
+    input_file = models.FileField(upload_to='jobs/input/', blank=True)
+    result_file = models.FileField(upload_to='jobs/result/', blank=True)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    errors = models.JSONField(default=list, blank=True)
+    # counts and changed rows of a sync import
+    diff = models.JSONField(default=dict, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # a running job whose lease ran out is claimed again, its worker is taken for dead
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [models.Index(fields=['status', 'created'])]
+
+    def __str__(self):
+        return f'{self.kind} #{self.pk} - {self.status}'
+
+    @property
+    def percent(self):
+        if not self.total:
+            return 100 if self.status == self.DONE else 0
+        return min(100, self.progress * 100 // self.total)
+
+
+class LibraryStats(models.Model):
+    # running totals shown on the main page, kept up to date by the receivers in signals.py
+    name = models.CharField(max_length=30, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'library stats'
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class OutboxEmail(models.Model):
+    # emails are queued here by the views and sent in batches by python manage.py send_emails
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, _('Pending')),
+        (SENDING, _('Sending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # when the email may be tried next, for an email being sent when its claim runs out
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    def __str__(self):
+        return f'{self.subject} to {", ".join(self.to)} - {self.status}'
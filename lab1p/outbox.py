@@ -0,0 +1,90 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+# Views queue emails with queue_email() and return at once, python manage.py send_emails
+# sends them in batches over one SMTP connection. A failed email is tried again after
+# OUTBOX_RETRY_DELAY seconds, doubled with every attempt, up to OUTBOX_MAX_ATTEMPTS.
+
+
+def queue_email(subject, body, to, from_email=None):
+    return OutboxEmail.objects.create(subject=subject, body=body, to=list(to), from_email=from_email or '')
+
+
+def claim_batch(size):
+    """ Takes up to size emails that are due, for OUTBOX_CLAIM_TIMEOUT seconds.
+
+    An email is taken by whoever changes it first, so several senders can share the outbox.
+    If a sender dies while sending, its emails are due again once the claim runs out. That
+    counts as an attempt, an email that keeps stopping its senders fails after OUTBOX_MAX_ATTEMPTS."""
+    now = timezone.now()
+    due = OutboxEmail.objects.filter(Q(status=OutboxEmail.PENDING) | Q(status=OutboxEmail.SENDING),
+                                     next_attempt__lte=now)
+    claimed = []
+    for pk, status, next_attempt, attempts in due.order_by('next_attempt').values_list(
+            'id', 'status', 'next_attempt', 'attempts')[:size]:
+        claim = OutboxEmail.objects.filter(pk=pk, next_attempt=next_attempt)
+        if status == OutboxEmail.SENDING:
+            attempts += 1
+            if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                claim.update(status=OutboxEmail.FAILED, attempts=attempts,
+                             last_error='The sender stopped before the email was sent')
+                continue
+        if claim.update(status=OutboxEmail.SENDING, attempts=attempts,
+                        next_attempt=now + timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT)):
+            claimed.append(pk)
+    return list(OutboxEmail.objects.filter(pk__in=claimed).order_by('next_attempt', 'id'))
+
+
+def retry_later(email, error):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmail.FAILED
+    else:
+        email.status = OutboxEmail.PENDING
+        delay = min(settings.OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY)
+        email.next_attempt = timezone.now() + timedelta(seconds=delay)
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+
+
+def send_batch(emails, connection=None):
+    """ Sends the emails over one connection, at most OUTBOX_RATE_LIMIT per second.
+    Returns the number of emails sent."""
+    connection = connection or get_connection(settings.OUTBOX_EMAIL_BACKEND)
+    try:
+        connection.open()
+    except Exception as error:
+        # the server can't be reached, none of the emails were tried
+        for email in emails:
+            retry_later(email, error)
+        return 0
+
+    interval = 1 / settings.OUTBOX_RATE_LIMIT if settings.OUTBOX_RATE_LIMIT else 0
+    sent = 0
+    try:
+        for email in emails:
+            started = time.monotonic()
+            message = EmailMessage(email.subject, email.body, email.from_email or None, email.to,
+                                   connection=connection)
+            try:
+                # one message per call, so a rejected address only fails its own email
+                connection.send_messages([message])
+            except Exception as error:
+                retry_later(email, error)
+            else:
+                email.status = OutboxEmail.SENT
+                email.attempts += 1
+                email.sent = timezone.now()
+                email.save(update_fields=['status', 'attempts', 'sent'])
+                sent += 1
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+    finally:
+        connection.close()
+    return sent
@@ -0,0 +1,168 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+from django.utils.translation import get_language
+
+from .cache import bump_many, get_versions
+from .models import Author, Book, Collection, Comment, Genre, UserProfile
+
+# Cached page fragments and the versions their keys are built from:
+#   books list      'books', 'genres', and the facet snapshot version when filtered
+#   authors list    'authors'
+#   author detail   'author:<id>', 'genres'
+#   book detail     'book:<id>', 'genres', 'recommendations'
+# and the ETags of the json api (api.py), which also uses
+#   collections     'collections:<user id>'
+#   comment counts  'comments'
+# and the library snapshots of the profile pages (library.py)
+#   library         'collections:<user id>', 'profile:<user id>', 'books'
+# The receivers below bump only the versions a change can show up in, once the transaction
+# is committed. A page rendered before that would be cached with the old rows under the new version.
+
+
+def page_cache(*namespaces, key=''):
+    """ Context for a {% cache page_cache_timeout <name> page_cache_version ... page_cache_key %} fragment,
+    key is the page_key of the request."""
+    return {
+        'page_cache_version': '-'.join(str(version) for version in get_versions(*namespaces)),
+        'page_cache_timeout': settings.PAGE_CACHE_TIMEOUT,
+        'page_cache_key': key,
+    }
+
+
+def page_key(request, page=None, facets=None):
+    """ The page a request is for: the path, and the page and filters as the view parsed them.
+    Parameters the view ignores or drops, a tampered cursor included, don't make another entry.
+    A filtered page also has the version of the facet snapshot its rows were picked from."""
+    parts = [request.path]
+    if page is not None:
+        parts.append(page.size)
+        if page.values is not None:
+            parts += ['before' if page.before else 'after', *page.values]
+    if facets and facets['chosen']:
+        parts += [f'{name}={pk}' for name, pk in sorted(facets['chosen'].items())]
+        parts.append(f"facets={facets['version']}")
+    return ':'.join(str(part) for part in parts)
+
+
+async def fragment_cached(request, name, context, *extra):
+    """ Whether the {% cache %} fragment of the page is already cached, the async views load
+    the rows only when it isn't. The key is made from the same values the templates vary on,
+    extra are the ones the template has after page_cache_key."""
+    authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+    vary_on = [context['page_cache_version'], get_language(), authenticated, context['page_cache_key'], *extra]
+    return await cache.ahas_key(make_template_fragment_key(name, vary_on))
+
+
+def bump_on_commit(namespaces):
+    transaction.on_commit(lambda: bump_many(namespaces))
+
+
+def book_namespaces(book_ids):
+    namespaces = ['books']
+    for book_id, author_id in Book.objects.filter(id__in=list(book_ids)).values_list('id', 'author_id'):
+        namespaces += [f'book:{book_id}', f'author:{author_id}']
+    return namespaces
+
+
+def remember_book_author(sender, instance, raw=False, **kwargs):
+    # a book moved to another author also changes the page of the old author
+    if instance.pk and not raw:
+        instance.page_cache_old_author = Book.objects.filter(pk=instance.pk).values_list(
+            'author_id', flat=True).first()
+
+
+def book_changed(sender, instance, **kwargs):
+    namespaces = ['books', f'book:{instance.pk}', f'author:{instance.author_id}']
+    old_author = getattr(instance, 'page_cache_old_author', None)
+    if old_author is not None:
+        namespaces.append(f'author:{old_author}')
+    bump_on_commit(namespaces)
+
+
+def author_changed(sender, instance, **kwargs):
+    namespaces = ['authors', 'books', f'author:{instance.pk}']
+    namespaces += [f'book:{pk}' for pk in instance.auth_books.values_list('id', flat=True)]
+    bump_on_commit(namespaces)
+
+
+def genre_changed(sender, **kwargs):
+    bump_on_commit(['genres'])
+
+
+def comment_changed(sender, instance, **kwargs):
+    # 'comments' is for the book list of the api when it shows comment_count
+    bump_on_commit([f'book:{instance.book_id}', 'comments'])
+
+
+def book_genre_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # the links are gone after the clear, so the books are collected before it
+        instance.page_cache_book_ids = list(instance.books.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_on_commit(['books', f'book:{instance.pk}', f'author:{instance.author_id}'])
+    elif action == 'post_clear':
+        bump_on_commit(book_namespaces(getattr(instance, 'page_cache_book_ids', [])))
+    else:
+        bump_on_commit(book_namespaces(pk_set))
+
+
+def collection_changed(sender, instance, **kwargs):
+    bump_on_commit([f'collections:{instance.creator_id}'])
+
+
+def collection_namespaces(collection_ids):
+    creators = Collection.objects.filter(id__in=list(collection_ids)).values_list('creator_id', flat=True)
+    return [f'collections:{creator_id}' for creator_id in set(creators)]
+
+
+def book_collections_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        instance.page_cache_collection_ids = list(instance.collections.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        bump_on_commit([f'collections:{instance.creator_id}'])
+    elif action == 'post_clear':
+        bump_on_commit(collection_namespaces(getattr(instance, 'page_cache_collection_ids', [])))
+    else:
+        bump_on_commit(collection_namespaces(pk_set))
+
+
+def profile_changed(sender, instance, **kwargs):
+    bump_on_commit([f'profile:{instance.user_id}'])
+
+
+def profile_namespaces(profile_ids):
+    users = UserProfile.objects.filter(id__in=list(profile_ids)).values_list('user_id', flat=True)
+    return [f'profile:{user_id}' for user_id in users]
+
+
+def book_likes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance.page_cache_profile_ids = list(instance.profile_f_books.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_on_commit([f'profile:{instance.user_id}'])
+    elif action == 'post_clear':
+        bump_on_commit(profile_namespaces(getattr(instance, 'page_cache_profile_ids', [])))
+    else:
+        bump_on_commit(profile_namespaces(pk_set))
+
+
+def bulk_changed(sender, objs, **kwargs):
+    if sender is Book:
+        bump_on_commit(['books'] + [f'author:{obj.author_id}' for obj in objs])
+    elif sender is Book.genre.through:
+        bump_on_commit(book_namespaces({obj.book_id for obj in objs}))
+    elif sender is Author:
+        bump_on_commit(['authors'])
+    elif sender is Genre:
+        bump_on_commit(['genres'])
+    elif sender is Comment:
+        bump_on_commit([f'book:{obj.book_id}' for obj in objs] + ['comments'])
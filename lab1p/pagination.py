@@ -0,0 +1,155 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+COMMENT_PAGE_SIZE = 20
+
+BOOK_ORDERING = ('title', 'id')
+AUTHOR_ORDERING = ('Name', 'Surname', 'id')
+COMMENT_ORDERING = ('date_added', 'id')
+
+# type of the ordering fields in a cursor, the ones not listed are strings
+CURSOR_TYPES = {'id': int, 'date_added': datetime}
+MAX_ID = 2 ** 63 - 1
+
+
+class KeysetPage:
+    """ One page of a keyset paginated queryset.
+
+    A page remembers the sort key of its first and last row. The next page is the rows
+    after the last key, the previous page the rows before the first key, so every page
+    is a range scan on an index instead of an OFFSET.
+
+    Rows are loaded on first use, so a page whose html is already cached costs no query."""
+
+    def __init__(self, queryset, fields, values, before, size):
+        self.queryset = queryset
+        self.fields = fields
+        self.values = values
+        self.before = before
+        self.size = size
+
+    def _rows(self):
+        # one row more than the page, it tells whether there is a page after this one
+        if self.values is not None and self.before:
+            descending = [f'-{field}' for field in self.fields]
+            return self.queryset.filter(after(self.fields, self.values, reverse=True)).order_by(
+                *descending)[:self.size + 1]
+        queryset = self.queryset
+        if self.values is not None:
+            queryset = queryset.filter(after(self.fields, self.values))
+        return queryset.order_by(*self.fields)[:self.size + 1]
+
+    def _split(self, items):
+        size = self.size
+        if self.values is not None and self.before:
+            return items[:size][::-1], True, len(items) > size
+        return items[:size], len(items) > size, self.values is not None
+
+    @cached_property
+    def _page(self):
+        return self._split(list(self._rows()))
+
+    async def aload(self):
+        """ Loads the rows with the async ORM, for async views."""
+        self._page = self._split([obj async for obj in self._rows()])
+
+    @property
+    def items(self):
+        return self._page[0]
+
+    @property
+    def has_next(self):
+        return self._page[1]
+
+    @property
+    def has_prev(self):
+        return self._page[2]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1], self.fields) if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0], self.fields) if self.has_prev and self.items else None
+
+
+def encode_cursor(obj, fields):
+    # dates keep their microseconds, a rounded value would repeat rows on the next page
+    values = [getattr(obj, field) for field in fields]
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(fields):
+        return None
+    try:
+        return [cursor_value(field, value) for field, value in zip(fields, values)]
+    except (ValueError, TypeError):
+        # a cursor edited by hand, the first page is shown
+        return None
+
+
+def cursor_value(field, value):
+    kind = CURSOR_TYPES.get(field, str)
+    if kind is datetime:
+        return datetime.fromisoformat(value)
+    if kind is int:
+        if isinstance(value, bool) or not isinstance(value, int) or not -MAX_ID <= value <= MAX_ID:
+            raise ValueError(f'{field} must be an id')
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    return value
+
+
+def after(fields, values, reverse=False, seek=True):
+    # (a, b, c) > (x, y, z)  is  a > x  or  a = x and b > y  or  a = x and b = y and c > z
+    lookup = 'lt' if reverse else 'gt'
+    condition = Q()
+    for i, field in enumerate(fields):
+        equal = {fields[j]: values[j] for j in range(i)}
+        condition |= Q(**equal, **{f'{field}__{lookup}': values[i]})
+    if not seek:
+        return condition
+    # the redundant a >= x gives the planner a range to seek to in the (a, b, c) index, it can't get one from the OR.
+    # benchmark_indexes shows the plans without it: the books scan every author and sort, the authors and the
+    # comments of a book walk the index from the start
+    return Q(**{f'{fields[0]}__{lookup}e': values[0]}) & condition
+
+
+def page_size(request, default=PAGE_SIZE):
+    try:
+        size = int(request.GET.get('size', default))
+    except ValueError:
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def paginate(request, queryset, fields, size=PAGE_SIZE):
+    """ Returns the page asked for with ?after=<cursor> or ?before=<cursor>, the first page otherwise."""
+    before = request.GET.get('before')
+    cursor = before or request.GET.get('after')
+    values = decode_cursor(cursor, fields) if cursor else None
+    return KeysetPage(queryset, fields, values, bool(before), page_size(request, size))
+
+
+def first_page(queryset, fields, size=PAGE_SIZE):
+    return KeysetPage(queryset, fields, None, False, size)
@@ -0,0 +1,111 @@
+import array
+
+from django.db import transaction
+
+from .cache import bump
+from .models import Book, BookNeighbour, UserProfile
+
+# "Readers also liked" of the book page: the books most often liked by the same users or put
+# in the same collections, computed offline by python manage.py build_recommendations and
+# stored in BookNeighbour, so the page reads them with one lookup on (book, rank).
+#
+# Every user's likes and every collection is a basket. X is the sparse baskets x books matrix
+# (scipy CSR) and X.T @ X counts for every pair of books the baskets they share. A count is
+# scaled to cosine similarity, count / sqrt(baskets of a * baskets of b), so the most liked
+# books don't top every list, and the top_k best of every book are kept. The product is
+# computed for block books at a time, memory is bounded by the block and not by the square
+# of the number of books.
+#
+# NumPy and SciPy are needed by the command only.
+
+NAMESPACE = 'recommendations'
+TOP_K = 10
+MIN_COMMON = 1  # baskets two books must share to be neighbours
+BLOCK = 10000  # books per product
+CHUNK = 10000  # rows read from the database at a time
+
+
+def read_baskets(chunk_size=CHUNK):
+    """ (baskets, books), the basket and the book of every like and every collection link."""
+    baskets, books = array.array('q'), array.array('q')
+    likes = UserProfile.books.through.objects.values_list('userprofile_id', 'book_id')
+    for basket, book in likes.iterator(chunk_size=chunk_size):
+        baskets.append(basket)
+        books.append(book)
+    # collections are numbered after the like lists
+    offset = max(baskets, default=0) + 1
+    links = Book.collections.through.objects.values_list('collection_id', 'book_id')
+    for basket, book in links.iterator(chunk_size=chunk_size):
+        baskets.append(basket + offset)
+        books.append(book)
+    return baskets, books
+
+
+def basket_matrix(baskets, books):
+    """ The ids of the books and the baskets x books matrix, 1 where the basket has the book."""
+    import numpy as np
+    from scipy import sparse
+
+    _, rows = np.unique(np.frombuffer(baskets, dtype=np.int64), return_inverse=True)
+    book_ids, columns = np.unique(np.frombuffer(books, dtype=np.int64), return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                               shape=(rows.max(initial=-1) + 1, len(book_ids)))
+    # a book is in a basket once, whatever the through tables hold
+    matrix.data[:] = 1
+    return book_ids, matrix
+
+
+def neighbours(book_ids, matrix, top_k=TOP_K, min_common=MIN_COMMON, block=BLOCK):
+    """ Yields (books, neighbours, ranks, scores) arrays, a block of books at a time."""
+    import numpy as np
+
+    norms = np.sqrt(np.asarray(matrix.sum(axis=0), dtype=np.float64).ravel())
+    by_book = matrix.T.tocsr()
+    for start in range(0, len(book_ids), block):
+        common = (by_book[start:start + block] @ matrix).tocoo()
+        rows, columns = common.row.astype(np.int64) + start, common.col.astype(np.int64)
+        keep = (rows != columns) & (common.data >= min_common)
+        rows, columns, counts = rows[keep], columns[keep], common.data[keep].astype(np.float64)
+        scores = counts / (norms[rows] * norms[columns])
+
+        # every book's neighbours best first, then the first top_k of each
+        order = np.lexsort((book_ids[columns], -scores, rows))
+        rows, columns, scores = rows[order], columns[order], scores[order]
+        ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = ranks < top_k
+        yield book_ids[rows[keep]], book_ids[columns[keep]], ranks[keep] + 1, scores[keep]
+
+
+def build(top_k=TOP_K, min_common=MIN_COMMON, block=BLOCK, batch_size=CHUNK, stdout=None):
+    """ Computes the neighbours of every book again and replaces the stored ones.
+    Returns the number of rows stored."""
+    def log(message):
+        if stdout:
+            stdout.write(message)
+
+    # everything is read and computed first, the transaction only swaps the stored rows
+    baskets, books = read_baskets()
+    log(f'{len(books)} likes and collection links')
+    book_ids, matrix = basket_matrix(baskets, books)
+    del baskets, books
+    log(f'{matrix.shape[0]} baskets, {len(book_ids)} books')
+    blocks = list(neighbours(book_ids, matrix, top_k, min_common, block))
+    del matrix
+    stored = sum(len(rows[0]) for rows in blocks)
+    log(f'{stored} neighbours computed')
+
+    with transaction.atomic():
+        BookNeighbour.objects.all().delete()
+        for rows in blocks:
+            BookNeighbour.objects.bulk_create(
+                (BookNeighbour(book_id=book, neighbour_id=neighbour, rank=rank, score=score)
+                 for book, neighbour, rank, score in zip(*(column.tolist() for column in rows))),
+                batch_size=batch_size)
+        transaction.on_commit(lambda: bump(NAMESPACE))
+    log(f'{stored} neighbours stored')
+    return stored
+
+
+def recommended(book_id):
+    """ The stored neighbours of the book, best first, with their authors."""
+    return BookNeighbour.objects.filter(book_id=book_id).select_related('neighbour__author').order_by('rank')
@@ -0,0 +1,165 @@
+import re
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.db.models import Q
+
+from .models import Book
+from .text import normalize
+
+# Full text index over books. On SQLite it is an FTS5 virtual table with the book id as rowid,
+# on PostgreSQL a table with a weighted tsvector and a GIN index. Both are created by
+# migration 0028 and kept in sync by the receivers in signals.py.
+# Title, author and genres are indexed by their normalized columns (text.py), so a query
+# matches them regardless of case, accents, apostrophes and Cyrillic or Latin spelling.
+# Other backends fall back to prefix lookups on the normalized columns.
+
+TABLE = 'lab1p_booksearch'
+CHUNK_SIZE = 500
+RESULT_LIMIT = 100
+
+# column weights, same order as the indexed columns
+WEIGHTS = (10.0, 5.0, 3.0, 1.0)
+
+WORD = re.compile(r'\w+')
+
+
+def backend():
+    return connection.vendor if connection.vendor in ('sqlite', 'postgresql') else None
+
+
+# one row per book: id, title, author, genres, information
+DOCUMENTS_SQL = {
+    'sqlite': (
+        "SELECT b.id, b.title_normalized, a.name_normalized, "
+        "COALESCE((SELECT group_concat(g.name_normalized, ' ') FROM lab1p_book_genre bg "
+        "JOIN lab1p_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), ''), b.\"Information\" "
+        "FROM lab1p_book b JOIN lab1p_author a ON a.id = b.author_id"
+    ),
+    'postgresql': (
+        "SELECT b.id, b.title_normalized, a.name_normalized, "
+        "COALESCE((SELECT string_agg(g.name_normalized, ' ') FROM lab1p_book_genre bg "
+        "JOIN lab1p_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), ''), b.\"Information\" "
+        "FROM lab1p_book b JOIN lab1p_author a ON a.id = b.author_id"
+    ),
+}
+
+INSERT_SQL = {
+    'sqlite': f"INSERT INTO {TABLE} (rowid, title, author, genres, information) ",
+    'postgresql': (
+        f"INSERT INTO {TABLE} (book_id, document) "
+        f"SELECT id, setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', author), 'B') || "
+        f"setweight(to_tsvector('simple', genres), 'C') || setweight(to_tsvector('simple', information), 'D') "
+        f"FROM "
+    ),
+}
+
+
+def insert_documents(cursor, vendor, where='', params=()):
+    select = DOCUMENTS_SQL[vendor] + where
+    if vendor == 'sqlite':
+        cursor.execute(INSERT_SQL[vendor] + select, params)
+    else:
+        cursor.execute(INSERT_SQL[vendor] + f"({select}) AS documents (id, title, author, genres, information)",
+                       params)
+
+
+def index_books(book_ids):
+    vendor = backend()
+    if vendor is None:
+        return
+    book_ids = list(book_ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(book_ids), CHUNK_SIZE):
+            chunk = book_ids[start:start + CHUNK_SIZE]
+            delete_rows(cursor, vendor, chunk)
+            insert_documents(cursor, vendor, f" WHERE b.id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+
+
+def remove_books(book_ids):
+    vendor = backend()
+    if vendor is None:
+        return
+    book_ids = list(book_ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(book_ids), CHUNK_SIZE):
+            delete_rows(cursor, vendor, book_ids[start:start + CHUNK_SIZE])
+
+
+def delete_rows(cursor, vendor, book_ids):
+    if not book_ids:
+        return
+    column = 'rowid' if vendor == 'sqlite' else 'book_id'
+    cursor.execute(f"DELETE FROM {TABLE} WHERE {column} IN ({', '.join(['%s'] * len(book_ids))})", book_ids)
+
+
+def rebuild_index(schema_editor=None):
+    # the whole index is refilled with a single INSERT ... SELECT
+    conn = schema_editor.connection if schema_editor else connection
+    vendor = conn.vendor
+    if vendor not in DOCUMENTS_SQL:
+        return 0
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+        insert_documents(cursor, vendor)
+        cursor.execute(f"SELECT COUNT(*) FROM {TABLE}")
+        return cursor.fetchone()[0]
+
+
+def ranked_ids(query, limit=RESULT_LIMIT):
+    # every word of the query has to match, either whole or as the start of a longer word.
+    # The normalized words find titles, authors and genres, the words as typed the information
+    words = WORD.findall(query)
+    keys = normalize(query).split()
+    vendor = backend()
+    if vendor is None:
+        return None
+    if not keys:
+        return []
+    groups = [keys] if words == keys else [keys, words]
+    with connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            match = ' OR '.join('(' + ' AND '.join(f'"{word}"*' for word in group) + ')' for group in groups)
+            weights = ', '.join(str(weight) for weight in WEIGHTS)
+            cursor.execute(
+                f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s ORDER BY bm25({TABLE}, {weights}) LIMIT %s",
+                [match, limit])
+        else:
+            match = ' | '.join('(' + ' & '.join(f'{word}:*' for word in group) + ')' for group in groups)
+            cursor.execute(
+                f"SELECT book_id FROM {TABLE}, to_tsquery('simple', %s) query WHERE document @@ query "
+                f"ORDER BY ts_rank(document, query) DESC LIMIT %s",
+                [match, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def starts_with(field, key):
+    return Q(**{f'{field}__startswith': key})
+
+
+def like_matches(query, limit):
+    # backends without a full text index, prefix lookups on the normalized columns
+    key = normalize(query)
+    if not key:
+        return Book.objects.none()
+    return Book.objects.for_cards().filter(
+        starts_with('title_normalized', key) | starts_with('author__name_normalized', key) |
+        Q(genre__name_normalized=key)).distinct()[:limit]
+
+
+def search_books(query, limit=RESULT_LIMIT):
+    """ Books matching the query, best match first."""
+    ids = ranked_ids(query, limit)
+    if ids is None:
+        return list(like_matches(query, limit))
+    found = Book.objects.for_cards().in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
+
+
+async def asearch_books(query, limit=RESULT_LIMIT):
+    """ search_books for async views."""
+    ids = await sync_to_async(ranked_ids)(query, limit)
+    if ids is None:
+        return [book async for book in like_matches(query, limit)]
+    found = await Book.objects.for_cards().ain_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
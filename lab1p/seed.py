@@ -0,0 +1,170 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import search, stats
+from .cache import bump_many
+from .models import Author, Book, Collection, Comment, Genre, UserProfile
+
+BATCH_SIZE = 5000
+PASSWORD = 'library-seed'
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ne', 'to', 'vy', 'sha', 'dro', 'len', 'bor', 'ia', 'ko', 'chu', 'an', 'el']
+WORDS = ['forest', 'song', 'river', 'night', 'stone', 'garden', 'winter', 'letter', 'city', 'shadow', 'light',
+         'road', 'house', 'sea', 'fire', 'dream', 'time', 'star', 'field', 'storm']
+
+
+def word(rng, parts=3):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(parts)).capitalize()
+
+
+class Seeder:
+    """ Fills the database with generated data, the same seed always gives the same rows.
+
+    Rows are written with bulk_create and no signals, the search index, the counters
+    and the page cache are refreshed once at the end."""
+
+    def __init__(self, seed=0, batch_size=BATCH_SIZE, stdout=None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.stdout = stdout
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    def bulk(self, model, objs):
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                model.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch)
+
+    def new_ids(self, model, start):
+        return list(model.objects.filter(id__gt=start).order_by('id').values_list('id', flat=True))
+
+    def last_id(self, model):
+        return model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def run(self, books=1000, authors=None, genres=50, comments=None, users=0, collections=2, likes=10,
+            refresh=True):
+        """ collections and likes are per user, every user also gets the 'To read' collection."""
+        authors = authors or max(1, books // 10)
+        comments = books // 2 if comments is None else comments
+        with transaction.atomic():
+            self.seed_genres(genres)
+            self.seed_authors(authors)
+            self.seed_books(books)
+            self.seed_users(users, collections, likes)
+            self.seed_comments(comments)
+        if refresh:
+            self.refresh()
+
+    def seed_genres(self, count):
+        start = self.last_id(Genre)
+        existing = set(Genre.objects.values_list('Name', flat=True))
+        names = []
+        while len(names) < count:
+            name = f'{word(self.rng, 2)} {word(self.rng, 2)}'
+            if name not in existing:
+                existing.add(name)
+                names.append(name)
+        self.bulk(Genre, (Genre(Name=name) for name in names))
+        self.genre_ids = self.new_ids(Genre, start) or list(Genre.objects.values_list('id', flat=True))
+        self.log(f'{count} genres')
+
+    def seed_authors(self, count):
+        start = self.last_id(Author)
+        existing = set(Author.objects.values_list('Name', 'Surname'))
+        keys = []
+        while len(keys) < count:
+            key = (word(self.rng, 2), word(self.rng, 3))
+            if key not in existing:
+                existing.add(key)
+                keys.append(key)
+        self.bulk(Author, (Author(Name=name, Surname=surname, Bio='Generated') for name, surname in keys))
+        self.author_ids = self.new_ids(Author, start)
+        self.log(f'{count} authors')
+
+    def seed_books(self, count):
+        start = self.last_id(Book)
+        isbn_start = 9780000000000 + start
+        rng = self.rng
+
+        def books():
+            for i in range(count):
+                title = f'{rng.choice(WORDS).capitalize()} {rng.choice(WORDS)} {start + i}'
+                yield Book(title=title, author_id=rng.choice(self.author_ids), isbn=str(isbn_start + i))
+
+        self.bulk(Book, books())
+        self.book_ids = self.new_ids(Book, start)
+
+        through = Book.genre.through
+
+        def links():
+            for book_id in self.book_ids:
+                for genre_id in rng.sample(self.genre_ids, min(len(self.genre_ids), rng.randint(1, 4))):
+                    yield through(book_id=book_id, genre_id=genre_id)
+
+        self.bulk(through, links())
+        self.log(f'{count} books')
+
+    def seed_users(self, count, collections, likes):
+        self.user_ids = []
+        if not count:
+            return
+        rng = self.rng
+        start = self.last_id(User)
+        # hashing is slow on purpose, all seeded users share one hash of PASSWORD
+        password = make_password(PASSWORD)
+        self.bulk(User, (User(username=f'reader{start + i}', email=f'reader{start + i}@example.com',
+                              password=password) for i in range(1, count + 1)))
+        self.user_ids = self.new_ids(User, start)
+
+        # what the post_save receivers of User would have created
+        profile_start = self.last_id(UserProfile)
+        self.bulk(UserProfile, (UserProfile(user_id=user_id) for user_id in self.user_ids))
+        profile_ids = self.new_ids(UserProfile, profile_start)
+
+        collection_start = self.last_id(Collection)
+
+        def user_collections():
+            for user_id in self.user_ids:
+                yield Collection(creator_id=user_id)
+                names = {'To read'}
+                while len(names) < collections + 1:
+                    names.add(f'{rng.choice(WORDS).capitalize()} {rng.choice(WORDS)}')
+                for name in sorted(names - {'To read'}):
+                    yield Collection(creator_id=user_id, Name=name)
+
+        self.bulk(Collection, user_collections())
+        collection_ids = self.new_ids(Collection, collection_start)
+
+        sample = min(len(self.book_ids), likes)
+        liked = UserProfile.books.through
+        self.bulk(liked, (liked(userprofile_id=profile_id, book_id=book_id)
+                          for profile_id in profile_ids for book_id in rng.sample(self.book_ids, sample)))
+        in_collection = Book.collections.through
+        self.bulk(in_collection, (in_collection(collection_id=collection_id, book_id=book_id)
+                                  for collection_id in collection_ids
+                                  for book_id in rng.sample(self.book_ids, min(len(self.book_ids), 5))))
+        self.log(f'{count} users, {len(collection_ids)} collections')
+
+    def seed_comments(self, count):
+        rng = self.rng
+        users = self.user_ids + [None]
+        self.bulk(Comment, (Comment(book_id=rng.choice(self.book_ids), user_id=rng.choice(users),
+                                    name=word(rng, 2), text=' '.join(rng.choice(WORDS) for _ in range(8)))
+                            for _ in range(count)))
+        self.log(f'{count} comments')
+
+    def refresh(self):
+        search.rebuild_index()
+        stats.reconcile()
+        stats.recount_comments()
+        bump_many(['books', 'authors', 'genres', 'comments', 'charts', 'typeahead', 'facets'])
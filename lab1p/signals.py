@@ -0,0 +1,137 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import Signal
+
+from . import charts, facets, pagecache, search, stats, typeahead
+from .models import Author, Book, Collection, Comment, Genre, UserProfile
+
+# bulk_create does not send post_save, so the importer sends this after every bulk insert
+# with sender=model class (or m2m through model) and objs=list of created objects
+bulk_created = Signal()
+
+
+# database connections
+
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for name, value in settings.SQLITE_PRAGMAS.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+
+
+connection_created.connect(set_sqlite_pragmas, dispatch_uid='sqlite_pragmas')
+
+
+# charts
+
+for model in (Author, Book, Genre):
+    post_save.connect(charts.invalidate, sender=model, dispatch_uid=f'charts_save_{model.__name__}')
+    post_delete.connect(charts.invalidate, sender=model, dispatch_uid=f'charts_delete_{model.__name__}')
+m2m_changed.connect(charts.invalidate, sender=Book.genre.through, dispatch_uid='charts_book_genre')
+bulk_created.connect(charts.invalidate, dispatch_uid='charts_bulk')
+
+
+# search index
+
+def index_book(sender, instance, **kwargs):
+    search.index_books([instance.pk])
+
+
+def unindex_book(sender, instance, **kwargs):
+    search.remove_books([instance.pk])
+
+
+def index_author_books(sender, instance, created, **kwargs):
+    if not created:
+        search.index_books(instance.auth_books.values_list('id', flat=True))
+
+
+def index_genre_books(sender, instance, created, **kwargs):
+    if not created:
+        search.index_books(instance.books.values_list('id', flat=True))
+
+
+def remember_genre_books(sender, instance, **kwargs):
+    # the book-genre rows are gone after the delete, so the books are collected before it
+    instance.search_book_ids = list(instance.books.values_list('id', flat=True))
+
+
+def index_deleted_genre_books(sender, instance, **kwargs):
+    search.index_books(getattr(instance, 'search_book_ids', []))
+
+
+def index_genre_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        remember_genre_books(sender, instance)
+    elif action == 'post_clear' and reverse:
+        index_deleted_genre_books(sender, instance)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        search.index_books(pk_set if reverse else [instance.pk])
+
+
+def index_bulk(sender, objs, **kwargs):
+    if sender is Book:
+        search.index_books(obj.pk for obj in objs)
+    elif sender is Book.genre.through:
+        search.index_books({obj.book_id for obj in objs})
+
+
+post_save.connect(index_book, sender=Book, dispatch_uid='search_save_book')
+post_delete.connect(unindex_book, sender=Book, dispatch_uid='search_delete_book')
+post_save.connect(index_author_books, sender=Author, dispatch_uid='search_save_author')
+post_save.connect(index_genre_books, sender=Genre, dispatch_uid='search_save_genre')
+pre_delete.connect(remember_genre_books, sender=Genre, dispatch_uid='search_pre_delete_genre')
+post_delete.connect(index_deleted_genre_books, sender=Genre, dispatch_uid='search_delete_genre')
+m2m_changed.connect(index_genre_change, sender=Book.genre.through, dispatch_uid='search_book_genre')
+bulk_created.connect(index_bulk, dispatch_uid='search_bulk')
+
+
+# typeahead prefix index
+
+for model in (Author, Book, Genre):
+    post_save.connect(typeahead.object_saved, sender=model, dispatch_uid=f'typeahead_save_{model.__name__}')
+    post_delete.connect(typeahead.object_deleted, sender=model, dispatch_uid=f'typeahead_delete_{model.__name__}')
+bulk_created.connect(typeahead.bulk_saved, dispatch_uid='typeahead_bulk')
+
+
+# facet index of the books page
+
+for model in (Author, Book, Genre):
+    post_save.connect(facets.changed, sender=model, dispatch_uid=f'facets_save_{model.__name__}')
+    post_delete.connect(facets.changed, sender=model, dispatch_uid=f'facets_delete_{model.__name__}')
+m2m_changed.connect(facets.genre_links_changed, sender=Book.genre.through, dispatch_uid='facets_book_genre')
+bulk_created.connect(facets.bulk_changed, dispatch_uid='facets_bulk')
+
+
+# main page counters
+
+for model in (Author, Book, Genre, get_user_model()):
+    post_save.connect(stats.count_created, sender=model, dispatch_uid=f'stats_save_{model.__name__}')
+    post_delete.connect(stats.count_deleted, sender=model, dispatch_uid=f'stats_delete_{model.__name__}')
+bulk_created.connect(stats.count_bulk, dispatch_uid='stats_bulk')
+post_save.connect(stats.comment_created, sender=Comment, dispatch_uid='stats_save_comment')
+post_delete.connect(stats.comment_deleted, sender=Comment, dispatch_uid='stats_delete_comment')
+
+
+# cached page fragments
+
+pre_save.connect(pagecache.remember_book_author, sender=Book, dispatch_uid='pagecache_pre_save_book')
+post_save.connect(pagecache.book_changed, sender=Book, dispatch_uid='pagecache_save_book')
+post_delete.connect(pagecache.book_changed, sender=Book, dispatch_uid='pagecache_delete_book')
+post_save.connect(pagecache.author_changed, sender=Author, dispatch_uid='pagecache_save_author')
+post_delete.connect(pagecache.author_changed, sender=Author, dispatch_uid='pagecache_delete_author')
+post_save.connect(pagecache.genre_changed, sender=Genre, dispatch_uid='pagecache_save_genre')
+post_delete.connect(pagecache.genre_changed, sender=Genre, dispatch_uid='pagecache_delete_genre')
+post_save.connect(pagecache.comment_changed, sender=Comment, dispatch_uid='pagecache_save_comment')
+post_delete.connect(pagecache.comment_changed, sender=Comment, dispatch_uid='pagecache_delete_comment')
+m2m_changed.connect(pagecache.book_genre_changed, sender=Book.genre.through, dispatch_uid='pagecache_book_genre')
+post_save.connect(pagecache.collection_changed, sender=Collection, dispatch_uid='pagecache_save_collection')
+post_delete.connect(pagecache.collection_changed, sender=Collection, dispatch_uid='pagecache_delete_collection')
+m2m_changed.connect(pagecache.book_collections_changed, sender=Book.collections.through,
+                    dispatch_uid='pagecache_book_collections')
+post_save.connect(pagecache.profile_changed, sender=UserProfile, dispatch_uid='pagecache_save_profile')
+m2m_changed.connect(pagecache.book_likes_changed, sender=UserProfile.books.through,
+                    dispatch_uid='pagecache_book_likes')
+bulk_created.connect(pagecache.bulk_changed, dispatch_uid='pagecache_bulk')
@@ -0,0 +1,100 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Author, Book, Comment, Genre, LibraryStats
+
+
+def counted_models():
+    return {
+        'books': Book,
+        'authors': Author,
+        'genres': Genre,
+        'users': get_user_model(),
+    }
+
+
+def counters():
+    values = dict(LibraryStats.objects.values_list('name', 'value'))
+    if len(values) < len(counted_models()):
+        reconcile()
+        values = dict(LibraryStats.objects.values_list('name', 'value'))
+    return values
+
+
+def change(name, delta):
+    LibraryStats.objects.filter(name=name).update(value=F('value') + delta)
+
+
+def reconcile():
+    """ Recounts every counter and returns {name: (stored, actual)} for the ones that drifted."""
+    drift = {}
+    stored = dict(LibraryStats.objects.values_list('name', 'value'))
+    for name, model in counted_models().items():
+        actual = model.objects.count()
+        if stored.get(name) != actual:
+            drift[name] = (stored.get(name), actual)
+            LibraryStats.objects.update_or_create(name=name, defaults={'value': actual})
+    return drift
+
+
+def counter_name(model):
+    for name, counted in counted_models().items():
+        if counted is model:
+            return name
+    return None
+
+
+def count_created(sender, created, **kwargs):
+    if created:
+        change(counter_name(sender), 1)
+
+
+def count_deleted(sender, **kwargs):
+    change(counter_name(sender), -1)
+
+
+def count_bulk(sender, objs, **kwargs):
+    if sender is Comment:
+        count_bulk_comments(objs)
+        return
+    name = counter_name(sender)
+    if name is not None:
+        change(name, len(objs))
+
+
+# Book.comment_count, changed in the transaction that writes the comment
+
+def change_comment_count(book_id, delta):
+    books = Book.objects.filter(pk=book_id)
+    if delta < 0:
+        books = books.filter(comment_count__gte=-delta)
+    books.update(comment_count=F('comment_count') + delta)
+
+
+def comment_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_comment_count(instance.book_id, 1)
+
+
+def comment_deleted(sender, instance, **kwargs):
+    change_comment_count(instance.book_id, -1)
+
+
+def count_bulk_comments(objs):
+    added = {}
+    for comment in objs:
+        added[comment.book_id] = added.get(comment.book_id, 0) + 1
+    for book_id, delta in added.items():
+        change_comment_count(book_id, delta)
+
+
+def recount_comments():
+    """ Sets comment_count of every book whose count drifted, returns the ids of the fixed books."""
+    actual = Coalesce(Subquery(Comment.objects.filter(book_id=OuterRef('pk')).order_by().values(
+        'book_id').annotate(count=Count('id')).values('count')), 0)
+    drifted = list(Book.objects.annotate(actual=actual).exclude(comment_count=F('actual')).values_list(
+        'pk', flat=True))
+    if drifted:
+        Book.objects.filter(pk__in=drifted).update(comment_count=actual)
+    return drifted
@@ -1,3 +1,993 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+from datetime import timedelta
+from unittest.mock import patch
 
-# Create your tests here.
+import openpyxl
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.management import call_command
+
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+from lab1Prj.urls import urlpatterns as project_urlpatterns
+
+from . import async_views, charts, facets, recommend, stats, typeahead
+from .cache import get_version, get_versions
+from .exporter import COLUMNS
+from .facets import to_ids
+from .importer import BulkImporter, SyncImporter
+from .instrumentation import InstrumentationMiddleware, registry, sql_shape
+from .jobs import claim_next, run_job, set_progress
+from .library import apply_batch, snapshot
+from .models import Author, Book, BookNeighbour, Collection, Comment, Genre, Job, LibraryStats, OutboxEmail
+from .outbox import claim_batch, queue_email, send_batch
+from .pagination import BOOK_ORDERING, COMMENT_ORDERING, decode_cursor, encode_cursor
+from .recommend import recommended
+from .search import search_books
+from .signals import bulk_created
+from .text import normalize
+
+
+def raw_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'lab1p-tests'}})
+class LibraryTestCase(TestCase):
+    """ Runs on a cache of its own, emptied before every test, with the in-memory indexes dropped."""
+
+    def setUp(self):
+        cache.clear()
+        facets.index.snapshot = None
+        typeahead.index.entries = None
+
+
+class CursorTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(Name='Lesya', Surname='Ukrainka')
+        cls.genre = Genre.objects.create(Name='Drama')
+        cls.books = [Book.objects.create(title=f'Book {i:02}', author=cls.author, isbn=str(9780000000000 + i))
+                     for i in range(30)]
+        for book in cls.books:
+            book.genre.add(cls.genre)
+        cls.comments = [Comment.objects.create(book=cls.books[0], name='Reader', text=f'Comment {i}')
+                        for i in range(25)]
+
+    def test_cursor_round_trip(self):
+        book = self.books[3]
+        self.assertEqual(decode_cursor(encode_cursor(book, BOOK_ORDERING), BOOK_ORDERING), [book.title, book.pk])
+        comment = self.comments[3]
+        values = decode_cursor(encode_cursor(comment, COMMENT_ORDERING), COMMENT_ORDERING)
+        self.assertEqual(values, [comment.date_added, comment.pk])
+
+    def test_tampered_cursor_is_dropped(self):
+        for values in ([{}, []], ['Book 01', True], ['Book 01', '5'], [1, 2], ['Book 01', 2 ** 70], 'Book'):
+            self.assertIsNone(decode_cursor(raw_cursor(values), BOOK_ORDERING), values)
+        self.assertIsNone(decode_cursor(raw_cursor(['yesterday', 1]), COMMENT_ORDERING))
+        self.assertIsNone(decode_cursor('not base64 at all!', BOOK_ORDERING))
+
+    def test_tampered_cursor_shows_the_first_page(self):
+        cursor = raw_cursor([{}, []])
+        urls = [reverse('books'), reverse('authors'), reverse('api-books'),
+                reverse('book-comments', args=[self.books[0].pk]),
+                f"{reverse('books')}?genre={self.genre.pk}&"]
+        for url in urls:
+            for direction in ('after', 'before'):
+                separator = '' if url.endswith('&') else '?'
+                response = self.client.get(f'{url}{separator}{direction}={cursor}')
+                self.assertEqual(response.status_code, 200, f'{url} {direction}')
+
+        response = self.client.get(reverse('api-books'), {'after': cursor})
+        self.assertEqual(response.json()['data'][0]['title'], 'Book 00')
+
+
+class PageCacheTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.books = [Book.objects.create(title=f'Book {i:02}', author=author, isbn=str(9780000000000 + i))
+                     for i in range(30)]
+
+    def fragments(self, name):
+        return [key for key in cache._cache if f'template.cache.{name}.' in key]
+
+    def test_query_strings_the_page_ignores_share_one_entry(self):
+        url = reverse('books')
+        for query in ('', '?utm=1', '?utm=2', f'?after={raw_cursor([{}, []])}', '?size=abc', '?genre=x'):
+            self.assertEqual(self.client.get(url + query).status_code, 200, query)
+        self.assertEqual(len(self.fragments('books_page')), 1)
+
+        next_page = self.client.get(url).context['page'].next_cursor
+        self.client.get(url, {'after': next_page})
+        self.client.get(url, {'after': next_page, 'utm': '3'})
+        self.client.get(url, {'size': 10})
+        self.assertEqual(len(self.fragments('books_page')), 3)
+
+    def test_versions_are_bumped_after_the_commit(self):
+        book = self.books[0]
+        namespaces = ['books', f'book:{book.pk}', 'comments']
+        versions = get_versions(*namespaces)
+        with self.captureOnCommitCallbacks() as callbacks:
+            book.title = 'Moses'
+            book.save()
+            Comment.objects.create(book=book, name='Reader', text='Good')
+            self.assertEqual(get_versions(*namespaces), versions)
+        for callback in callbacks:
+            callback()
+        self.assertTrue(all(new > old for new, old in zip(get_versions(*namespaces), versions)))
+
+
+class ApiTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.book = Book.objects.create(title='Zakhar Berkut', author=author, isbn='9780000000001')
+
+    def test_comment_count_list_is_revalidated_after_a_comment(self):
+        url = f"{reverse('api-books')}?fields=comment_count"
+        response = self.client.get(url)
+        self.assertEqual(response.json()['data'][0]['comment_count'], 0)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(book=self.book, name='Reader', text='Good')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'][0]['comment_count'], 1)
+
+    def test_list_without_comment_count_keeps_its_etag(self):
+        url = reverse('api-books')
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(book=self.book, name='Reader', text='Good')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+def sheet_row(pk, name, surname, title, isbn, *genres):
+    return [pk, name, surname, 'Bio', pk, title, isbn] + list(genres) + [''] * (3 - len(genres))
+
+
+class ExportTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(Name='Lesya', Surname='Ukrainka', Bio='Poet & playwright <1871>')
+        cls.genres = [Genre.objects.create(Name=name) for name in ('Drama', 'Poetry', 'Lyrics', 'Epic')]
+        cls.books = [Book.objects.create(title=f'Book {i:02}', author=cls.author, isbn=str(9780000000000 + i))
+                     for i in range(5)]
+        cls.books[0].genre.add(*cls.genres)
+        cls.books[1].title = 'Forest\x0b Song'
+        cls.books[1].save()
+
+    def test_streamed_xlsx_opens_as_a_workbook(self):
+        with patch('lab1p.exporter.BUFFER_SIZE', 1):
+            response = self.client.get(reverse('export'), {'format': 'xlsx'})
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        sheet = openpyxl.load_workbook(io.BytesIO(b''.join(chunks)), read_only=True).active
+        rows = list(sheet.iter_rows(values_only=True))
+        self.assertEqual(list(rows[0]), COLUMNS)
+        self.assertEqual(len(rows), 6)
+        first = rows[1]
+        self.assertEqual(first[:7], (self.author.pk, 'Lesya', 'Ukrainka', 'Poet & playwright <1871>',
+                                     self.books[0].pk, 'Book 00', '9780000000000'))
+        self.assertEqual(len([genre for genre in first[7:] if genre]), 3)
+        self.assertEqual(rows[2][5], 'Forest Song')
+
+    def test_streamed_csv_has_a_row_per_book(self):
+        response = self.client.get(reverse('export'), {'format': 'csv'})
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], COLUMNS)
+        self.assertEqual([row[5] for row in rows[1:]], ['Book 00', 'Forest\x0b Song', 'Book 02', 'Book 03', 'Book 04'])
+
+
+class SearchTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.franko = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.drama = Genre.objects.create(Name='Drama')
+        cls.moses = Book.objects.create(title='Moses', author=cls.franko, isbn='9780000000001',
+                                        Information='A poem about the prophet')
+        cls.stolen = Book.objects.create(title='Stolen Happiness', author=cls.franko, isbn='9780000000002',
+                                         Information='A play in five acts about Moses the farmhand')
+        cls.stolen.genre.add(cls.drama)
+
+    def titles(self, query):
+        return [book.title for book in search_books(query)]
+
+    def test_title_match_ranks_above_information(self):
+        self.assertEqual(self.titles('moses'), ['Moses', 'Stolen Happiness'])
+
+    def test_every_word_matches_whole_or_as_a_prefix(self):
+        self.assertEqual(self.titles('stol happ'), ['Stolen Happiness'])
+        self.assertEqual(self.titles('franko drama'), ['Stolen Happiness'])
+        self.assertEqual(self.titles('moses drama'), ['Stolen Happiness'])
+        self.assertEqual(self.titles('prophet drama'), [])
+        self.assertEqual(self.titles('"*'), [])
+
+    def test_index_follows_the_books(self):
+        self.franko.Surname = 'Kotsiubynsky'
+        self.franko.save()
+        self.assertEqual(self.titles('franko'), [])
+        self.assertEqual(len(self.titles('kotsiubynsky')), 2)
+        self.stolen.genre.remove(self.drama)
+        self.assertEqual(self.titles('drama'), [])
+        self.moses.delete()
+        self.assertEqual(self.titles('moses'), ['Stolen Happiness'])
+
+    def test_search_page_lists_the_hits(self):
+        response = self.client.post(reverse('search'), {'searched': 'happiness'})
+        self.assertEqual([book.pk for book in response.context['books_names']], [self.stolen.pk])
+        self.assertContains(response, 'Stolen Happiness')
+
+
+class NormalizedSearchTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(Name='Тарас', Surname='Шевченко')
+        cls.genre = Genre.objects.create(Name='Поезія')
+        cls.book = Book.objects.create(title='Пам’ять', author=cls.author, isbn='9780000000001')
+        cls.book.genre.add(cls.genre)
+        cls.zola = Book.objects.create(title='Thérèse Raquin', author=Author.objects.create(
+            Name='Émile', Surname='Zola'), isbn='9780000000002')
+
+    def test_normalize(self):
+        for text in ('Пам’ять', "пам'ять", 'PAMIAT'):
+            self.assertEqual(normalize(text), 'pamiat', text)
+        self.assertEqual(normalize('Émile  Zola!'), 'emile zola')
+        self.assertEqual(normalize('Їжак Юрій Згода'), 'yizhak yurii zghoda')
+
+    def test_names_are_normalized_on_save(self):
+        self.assertEqual(self.author.name_normalized, 'taras shevchenko')
+        self.assertEqual(self.genre.name_normalized, 'poeziia')
+        self.assertEqual(self.book.title_normalized, 'pamiat')
+
+    def test_search_ignores_case_accents_apostrophes_and_script(self):
+        for query in ('shevchenko', 'ШЕВЧЕНКО', "пам'ять", 'pamiat', 'poeziia'):
+            self.assertEqual(search_books(query), [self.book], query)
+        self.assertEqual(search_books('emile'), [self.zola])
+        self.assertEqual(search_books('Therese'), [self.zola])
+
+    def test_backends_without_full_text_index_use_the_normalized_columns(self):
+        with patch('lab1p.search.backend', return_value=None):
+            self.assertEqual(search_books('Taras Shevch'), [self.book])
+            self.assertEqual(search_books('Пам’ят'), [self.book])
+            self.assertEqual(search_books('poeziia'), [self.book])
+            self.assertEqual(search_books('poez'), [])
+
+
+class ImporterTests(LibraryTestCase):
+    def test_rows_refused_by_the_database_are_left_out_alone(self):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        importer = BulkImporter()
+        # inserted by someone else after the importer loaded the keys
+        Book.objects.create(title='Moses', author=author, isbn='9780000000009')
+        errors = importer.run([sheet_row(1, 'Ivan', 'Franko', 'Zakhar Berkut', '9780000000001', 'Novel'),
+                               sheet_row(2, 'Ivan', 'Franko', 'Moses', '9780000000002', 'Poem'),
+                               sheet_row(3, 'Ivan', 'Franko', 'Stolen Happiness', '9780000000003', 'Drama')])
+        self.assertEqual(len(errors), 1)
+        self.assertIn('id 2', errors[0])
+        self.assertEqual(set(Book.objects.values_list('isbn', flat=True)),
+                         {'9780000000009', '9780000000001', '9780000000003'})
+        self.assertEqual(set(Genre.objects.values_list('Name', flat=True)), {'Novel', 'Drama'})
+        self.assertEqual(importer.created_books, 2)
+
+    def test_values_too_long_for_a_column_are_reported_per_row(self):
+        errors = BulkImporter().run([sheet_row(1, 'Ivan', 'Franko', 'T' * 300, '9780000000001'),
+                                     sheet_row(2, 'Ivan', 'Franko', 'Zakhar Berkut', '9780000000002')])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(list(Book.objects.values_list('title', flat=True)), ['Zakhar Berkut'])
+
+
+class SyncImporterTests(LibraryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rows = [sheet_row(1, 'Ivan', 'Franko', 'Zakhar Berkut', '9780000000001', 'Novel'),
+                     sheet_row(2, 'Ivan', 'Franko', 'Moses', '9780000000002', 'Poem', 'Drama')]
+        SyncImporter().run(self.rows)
+
+    def test_unchanged_rows_are_skipped_without_writing(self):
+        importer = SyncImporter()
+        with self.assertNumQueries(0):
+            importer.run(self.rows)
+        self.assertEqual(importer.diff['skipped'], 2)
+
+    def test_changed_rows_are_updated(self):
+        rows = [sheet_row(1, 'Ivan', 'Franko', 'Zakhar Berkut (1883)', '9780000000001', 'Novel'),
+                sheet_row(2, 'Ivan', 'Franko', 'Moses', '9780000000002', 'Poem'),
+                sheet_row(3, 'Lesya', 'Ukrainka', 'Forest Song', '9780000000003', 'Drama')]
+        importer = SyncImporter()
+        self.assertEqual(importer.run(rows), [])
+        diff = importer.diff
+        self.assertEqual((diff['created'], diff['updated'], diff['authors']), (1, 2, 1))
+        self.assertEqual(Book.objects.get(isbn='9780000000001').title, 'Zakhar Berkut (1883)')
+        self.assertEqual(list(Book.objects.get(isbn='9780000000002').genre.values_list('Name', flat=True)),
+                         ['Poem'])
+        self.assertEqual(Book.objects.get(isbn='9780000000003').author.Surname, 'Ukrainka')
+        self.assertEqual(SyncImporter().run(rows), [])
+
+    def test_dry_run_writes_nothing(self):
+        rows = [sheet_row(1, 'Ivan', 'Franko', 'Zakhar Berkut (1883)', '9780000000001', 'Novel'),
+                sheet_row(3, 'Lesya', 'Ukrainka', 'Forest Song', '9780000000003', 'Fairy tale')]
+        importer = SyncImporter(dry_run=True)
+        importer.run(rows)
+        self.assertEqual((importer.diff['created'], importer.diff['updated']), (1, 1))
+        self.assertEqual(importer.diff['rows'][0]['fields'], {'title': ['Zakhar Berkut', 'Zakhar Berkut (1883)']})
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertFalse(Author.objects.filter(Surname='Ukrainka').exists())
+        self.assertFalse(Genre.objects.filter(Name='Fairy tale').exists())
+        self.assertEqual(Book.objects.get(isbn='9780000000001').title, 'Zakhar Berkut')
+
+
+class LibraryBatchTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='library-test')
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.book = Book.objects.create(title='Moses', author=author, isbn='9780000000001')
+        cls.collection = Collection.objects.create(creator=cls.user, Name='Favourites')
+
+    def post(self, operations):
+        return self.client.post(reverse('library-batch'), json.dumps({'operations': operations}),
+                                content_type='application/json')
+
+    def test_booleans_are_not_ids(self):
+        self.client.force_login(self.user)
+        for operation in ({'op': 'like', 'book': True},
+                          {'op': 'add', 'book': self.book.pk, 'collection': True},
+                          {'op': 'add', 'book': False, 'collection': self.collection.pk}):
+            response = self.post([operation])
+            self.assertEqual(response.status_code, 400, operation)
+        self.assertFalse(self.user.profile.books.exists())
+        self.assertFalse(self.collection.books_for_collection.exists())
+
+    def test_operations_are_applied(self):
+        self.client.force_login(self.user)
+        response = self.post([{'op': 'like', 'book': self.book.pk},
+                              {'op': 'add', 'book': self.book.pk, 'collection': self.collection.pk}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(self.user.profile.books.all()), [self.book])
+        self.assertEqual(list(self.collection.books_for_collection.all()), [self.book])
+
+
+class QueryCountTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='library-test')
+        cls.author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.genres = [Genre.objects.create(Name=name) for name in ('Drama', 'Poetry')]
+        cls.collection = Collection.objects.create(creator=cls.user, Name='Classics')
+        cls.add_books(range(3))
+
+    @classmethod
+    def add_books(cls, numbers):
+        for i in numbers:
+            book = Book.objects.create(title=f'Book {i:02}', author=cls.author, isbn=str(9780000000000 + i))
+            book.genre.add(*cls.genres)
+            book.collections.add(cls.collection)
+            cls.user.profile.books.add(book)
+            Comment.objects.create(book=book, user=cls.user, name='Reader', text='Comment')
+
+    def test_list_pages_make_the_same_queries_for_any_number_of_books(self):
+        self.client.force_login(self.user)
+        urls = [reverse('main'), reverse('books'), f"{reverse('books')}?genre={self.genres[0].pk}",
+                reverse('authors'), reverse('author_detail', args=[self.author.pk]), reverse('my-added'),
+                reverse('books-for-collection', args=[self.collection.pk]), reverse('user-detail')]
+        counts = {}
+        for url in urls:
+            self.setUp()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200, url)
+            counts[url] = len(queries)
+
+        self.add_books(range(3, 13))
+        for url in urls:
+            self.setUp()
+            with self.assertNumQueries(counts[url]):
+                self.client.get(url)
+
+
+class InstrumentationTests(LibraryTestCase):
+    def test_sql_shape(self):
+        self.assertEqual(sql_shape("SELECT * FROM book WHERE id IN (%s, %s, %s) AND title = 'It''s' LIMIT 21"),
+                         'SELECT * FROM book WHERE id IN (?) AND title = ? LIMIT ?')
+
+    def test_request_is_measured(self):
+        Author.objects.create(Name='Ivan', Surname='Franko')
+        before = registry.snapshot().get('authors', {}).get('requests', 0)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('authors'))
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+        totals = registry.snapshot()['authors']
+        self.assertEqual(totals['requests'], before + 1)
+        self.assertGreater(totals['template_seconds'], 0)
+        self.assertGreater(totals['response_bytes'], 0)
+
+    def test_repeated_query_is_logged_as_n_plus_one(self):
+        def view(request):
+            for i in range(3):
+                Book.objects.filter(pk=i).exists()
+            return HttpResponse()
+
+        with self.settings(INSTRUMENTATION_N_PLUS_ONE_THRESHOLD=3):
+            middleware = InstrumentationMiddleware(view)
+        with self.assertLogs('lab1p.instrumentation', 'WARNING') as logs:
+            response = middleware(RequestFactory().get('/'))
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        self.assertIn('Possible N+1 in unresolved: 3 x SELECT', logs.output[0])
+
+    def test_metrics_are_only_shown_to_staff_and_allowed_addresses(self):
+        self.client.get(reverse('authors'))
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'lab1p_view_requests_total{view="authors"}')
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 404)
+        self.client.force_login(User.objects.create_user('admin', password='library-test', is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+
+class StatsTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.book = Book.objects.create(title='Moses', author=cls.author, isbn='9780000000001')
+
+    def test_counters_follow_the_rows(self):
+        self.assertEqual(stats.counters(), {'books': 1, 'authors': 1, 'genres': 0, 'users': 0})
+        Author.objects.create(Name='Lesya', Surname='Ukrainka')
+        genres = Genre.objects.bulk_create([Genre(Name='Drama'), Genre(Name='Poetry')])
+        bulk_created.send(sender=Genre, objs=genres)
+        self.book.delete()
+        User.objects.create_user('reader')
+        self.assertEqual(stats.counters(), {'books': 0, 'authors': 2, 'genres': 2, 'users': 1})
+        self.assertEqual(self.client.get(reverse('main')).context['num_authors'], 2)
+
+    def test_comment_count_follows_the_comments(self):
+        comment = Comment.objects.create(book=self.book, name='Reader', text='Good')
+        comments = Comment.objects.bulk_create([Comment(book=self.book, name='Reader', text='Fine')] * 2)
+        bulk_created.send(sender=Comment, objs=comments)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.comment_count, 3)
+        comment.delete()
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.comment_count, 2)
+
+    def test_reconcile_fixes_drifted_counters(self):
+        stats.counters()
+        LibraryStats.objects.filter(name='books').update(value=7)
+        Comment.objects.create(book=self.book, name='Reader', text='Good')
+        Book.objects.filter(pk=self.book.pk).update(comment_count=5)
+        version = get_version(f'book:{self.book.pk}')
+        out = io.StringIO()
+        call_command('reconcile_stats', stdout=out)
+        self.assertEqual(out.getvalue(), 'books: 7 -> 1\nComment count fixed for 1 books\n')
+        self.assertEqual(stats.counters()['books'], 1)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.comment_count, 1)
+        self.assertGreater(get_version(f'book:{self.book.pk}'), version)
+
+        out = io.StringIO()
+        call_command('reconcile_stats', stdout=out)
+        self.assertEqual(out.getvalue(), 'All counters are correct\n')
+
+
+class LibrarySnapshotTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='library-test')
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.books = [Book.objects.create(title=f'Book {i:02}', author=author, isbn=str(9780000000000 + i))
+                     for i in range(7)]
+        cls.collection = Collection.objects.create(creator=cls.user, Name='Classics')
+        cls.collection.books_for_collection.add(*reversed(cls.books))
+        cls.user.profile.books.add(*cls.books[:6])
+
+    def classics(self, data):
+        return next(collection for collection in data['collections'] if collection['id'] == self.collection.pk)
+
+    def test_snapshot_is_built_once(self):
+        data = snapshot(self.user)
+        classics = self.classics(data)
+        self.assertEqual(classics['books_count'], 7)
+        self.assertEqual([book['title'] for book in classics['books']], [f'Book {i:02}' for i in range(5)])
+        self.assertEqual(classics['books'][0]['author'], {'id': self.books[0].author_id, 'name': 'Ivan Franko'})
+        self.assertEqual(data['liked_count'], 6)
+        self.assertEqual(len(data['liked']), 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot(self.user), data)
+
+    def test_snapshot_is_built_again_after_a_change(self):
+        snapshot(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collection.books_for_collection.remove(self.books[0])
+        self.assertEqual(self.classics(snapshot(self.user))['books_count'], 6)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_batch(self.user, [{'op': 'unlike', 'book': self.books[0].pk}])
+        self.assertEqual(snapshot(self.user)['liked_count'], 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.status = 'Reading'
+            self.user.profile.save()
+        self.assertEqual(snapshot(self.user)['status'], 'Reading')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books[1].title = 'Moses'
+            self.books[1].save()
+        # the renamed book now sorts after the first books shown
+        titles = [book['title'] for book in self.classics(snapshot(self.user))['books']]
+        self.assertEqual(titles, [f'Book {i:02}' for i in range(2, 7)])
+
+    def test_snapshot_of_another_user_is_kept(self):
+        other = User.objects.create_user('other')
+        data = snapshot(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collection.books_for_collection.remove(self.books[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot(other), data)
+
+    def test_profile_page_shows_the_snapshot(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('user-detail'))
+        self.assertEqual(response.context['library'], snapshot(self.user))
+        self.assertContains(response, 'Classics')
+
+
+# the async pages under /async/, next to the pages ASYNC_VIEWS picked, see AsyncViewTests
+urlpatterns = [
+    path('async/', async_views.main),
+    path('async/<int:author_pk>/', async_views.author_detail),
+    path('async/authors/', async_views.authors),
+    path('async/books/', async_views.books),
+    path('async/book/<int:pk>/', async_views.book_detail),
+    path('async/search/', async_views.search),
+] + project_urlpatterns
+
+
+@override_settings(ROOT_URLCONF='lab1p.tests')
+class AsyncViewTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.genre = Genre.objects.create(Name='Drama')
+        cls.books = [Book.objects.create(title=f'Book {i:02}', author=cls.author, isbn=str(9780000000000 + i))
+                     for i in range(3)]
+        cls.books[0].genre.add(cls.genre)
+        cls.comments = [Comment.objects.create(book=cls.books[0], name='Reader', text=f'Comment {i}')
+                        for i in range(3)]
+
+    async def test_pages(self):
+        pages = [('/async/', 'num_books', 3, ':</strong> 3</li>'),
+                 (f'/async/{self.author.pk}/', 'author', self.author, 'Book 02'),
+                 ('/async/authors/', 'authors_obj', [self.author], 'Ivan Franko'),
+                 ('/async/books/', 'books_obj', self.books, 'Book 02'),
+                 (f'/async/books/?genre={self.genre.pk}', 'books_obj', self.books[:1], 'Book 00'),
+                 (f'/async/book/{self.books[0].pk}/', 'book', self.books[0], 'Comment 2')]
+        for url, name, value, text in pages:
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            context = response.context[name]
+            self.assertEqual(context if name in ('num_books', 'author', 'book') else list(context), value, url)
+            # the second time the page is rendered from the cached fragment, the rows aren't loaded
+            self.assertContains(await self.async_client.get(url), text, msg_prefix=url)
+
+    async def test_missing_rows_are_404(self):
+        for url in ('/async/0/', '/async/book/0/', reverse('book-comments', args=[0])):
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 404, url)
+
+    async def test_comments_are_loaded_after_a_cursor(self):
+        url = reverse('book-comments', args=[self.books[0].pk])
+        with patch('lab1p.async_views.COMMENT_PAGE_SIZE', 2):
+            first = (await self.async_client.get(url)).json()
+            second = (await self.async_client.get(url, {'after': first['next']})).json()
+        self.assertEqual([comment['text'] for comment in first['comments'] + second['comments']],
+                         ['Comment 0', 'Comment 1', 'Comment 2'])
+        self.assertIsNone(second['next'])
+
+    async def test_search(self):
+        response = await self.async_client.post('/async/search/', {'searched': 'book 01'})
+        self.assertEqual(response.context['books_names'], [self.books[1]])
+        response = await self.async_client.get('/async/search/')
+        self.assertEqual(response.status_code, 200)
+
+
+class LikeFormTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='library-test')
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.books = [Book.objects.create(title=f'Book {i}', author=author, isbn=str(9780000000000 + i))
+                     for i in range(3)]
+
+    def test_like_form_posts_without_javascript(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        for _ in range(2):
+            # the second page comes from the cached fragment, the token is outside of it
+            page = client.get(reverse('books'))
+            token = page.context['csrf_token']
+            self.assertContains(page, f'value="{token}"')
+            self.assertContains(page, f'form="like-form" name="book_pk" value="{self.books[0].pk}"')
+
+        response = client.post(reverse('books'), {'csrfmiddlewaretoken': str(token), 'book_pk': self.books[0].pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(self.user.profile.books.all()), [self.books[0]])
+
+    def test_fallback_post_likes_every_queued_book(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('books'), {'book_pk': [book.pk for book in self.books]})
+        self.assertEqual(set(self.user.profile.books.all()), set(self.books))
+
+
+class TypeaheadTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.book = Book.objects.create(title='Zakhar Berkut', author=author, isbn='9780000000001')
+
+    def save(self, obj, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.save(**kwargs)
+
+    def test_save_with_the_same_label_changes_nothing(self):
+        typeahead.index.ensure_loaded()
+        version = get_version(typeahead.NAMESPACE)
+        self.book.isbn = '9780000000002'
+        self.save(self.book)
+        self.save(self.book, update_fields=['isbn'])
+        self.assertEqual(get_version(typeahead.NAMESPACE), version)
+
+        self.book.title = 'Moses'
+        self.save(self.book)
+        self.assertEqual(get_version(typeahead.NAMESPACE), version + 1)
+
+    def test_other_processes_apply_the_published_changes(self):
+        other = typeahead.PrefixIndex()
+        other.ensure_loaded()
+        self.book.title = 'Moses'
+        self.save(self.book)
+        with self.captureOnCommitCallbacks(execute=True):
+            # the book goes with its author
+            Author.objects.get(Surname='Franko').delete()
+
+        other.checked = 0
+        with self.assertNumQueries(0):
+            self.assertEqual(other.suggest('zakh'), [])
+            self.assertEqual(other.suggest('mos'), [])
+            self.assertEqual(other.suggest('fran'), [])
+
+    def test_missing_changes_load_the_index_again(self):
+        other = typeahead.PrefixIndex()
+        other.ensure_loaded()
+        self.book.title = 'Moses'
+        self.save(self.book)
+        cache.clear()
+
+        other.checked = 0
+        self.assertEqual([suggestion['label'] for suggestion in other.suggest('mos')], ['Moses'])
+
+
+class JobTests(LibraryTestCase):
+    def test_jobs_are_claimed_once_while_their_lease_lasts(self):
+        job = Job.objects.create(kind=Job.EXPORT)
+        claimed = claim_next()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (job.pk, Job.RUNNING, 1))
+        self.assertGreater(claimed.lease_expires, timezone.now())
+        self.assertIsNone(claim_next())
+
+        lease = claimed.lease_expires
+        set_progress(claimed, 10)
+        self.assertGreaterEqual(Job.objects.get(pk=job.pk).lease_expires, lease)
+
+    def test_job_of_a_dead_worker_is_claimed_again(self):
+        job = Job.objects.create(kind=Job.EXPORT, status=Job.RUNNING, attempts=1, progress=10,
+                                 lease_expires=timezone.now() - timedelta(seconds=1))
+        claimed = claim_next()
+        self.assertEqual((claimed.pk, claimed.attempts, claimed.progress), (job.pk, 2, 0))
+
+    def test_result_of_a_worker_that_lost_its_lease_is_dropped(self):
+        Book.objects.create(title='Moses', author=Author.objects.create(Name='Ivan', Surname='Franko'),
+                            isbn='9780000000001')
+        job = Job.objects.create(kind=Job.EXPORT, format='csv')
+        slow = claim_next()
+        Job.objects.filter(pk=job.pk).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        other = claim_next()
+        self.assertEqual(other.attempts, 2)
+
+        self.assertFalse(run_job(slow))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result_file.name), (Job.RUNNING, ''))
+        self.assertTrue(run_job(other))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertIn('Moses', job.result_file.read().decode())
+        job.result_file.delete()
+
+    @override_settings(JOBS_MAX_ATTEMPTS=2)
+    def test_job_that_keeps_stopping_its_workers_fails(self):
+        job = Job.objects.create(kind=Job.EXPORT, status=Job.RUNNING, attempts=2,
+                                 lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(len(job.errors), 1)
+
+
+class RefusingConnection:
+    """ An email connection whose server refuses every message."""
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        raise OSError('refused')
+
+
+@override_settings(OUTBOX_RATE_LIMIT=0, OUTBOX_RETRY_DELAY=60, OUTBOX_MAX_RETRY_DELAY=100, OUTBOX_MAX_ATTEMPTS=3,
+                   OUTBOX_CLAIM_TIMEOUT=300)
+class OutboxTests(LibraryTestCase):
+    def test_emails_are_sent_once(self):
+        email = queue_email('Welcome', 'Hello', ['reader@example.com'])
+        connection = get_connection('django.core.mail.backends.locmem.EmailBackend')
+        self.assertEqual(send_batch(claim_batch(10), connection), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.SENT, 1))
+        self.assertEqual(claim_batch(10), [])
+
+    def test_failed_email_is_retried_later_with_a_growing_delay(self):
+        email = queue_email('Welcome', 'Hello', ['reader@example.com'])
+        delays = []
+        for _ in range(2):
+            OutboxEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now())
+            before = timezone.now()
+            self.assertEqual(send_batch(claim_batch(10), RefusingConnection()), 0)
+            email.refresh_from_db()
+            self.assertEqual(email.status, OutboxEmail.PENDING)
+            self.assertEqual(email.last_error, 'refused')
+            self.assertEqual(claim_batch(10), [])
+            delays.append(round((email.next_attempt - before).total_seconds()))
+        # 60 s, then doubled but not over OUTBOX_MAX_RETRY_DELAY
+        self.assertEqual(delays, [60, 100])
+
+        OutboxEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now())
+        send_batch(claim_batch(10), RefusingConnection())
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, 3))
+        self.assertEqual(claim_batch(10), [])
+
+    def test_emails_of_a_dead_sender_are_claimed_again(self):
+        email = queue_email('Welcome', 'Hello', ['reader@example.com'])
+        self.assertEqual(claim_batch(10), [email])
+        self.assertEqual(claim_batch(10), [])
+        OutboxEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(claim_batch(10), [email])
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 1)
+
+    def test_email_that_keeps_stopping_its_senders_fails(self):
+        email = queue_email('Welcome', 'Hello', ['reader@example.com'])
+        for _ in range(3):
+            self.assertEqual(len(claim_batch(10)), 1)
+            OutboxEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(claim_batch(10), [])
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, 3))
+
+
+class FacetTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.genre = Genre.objects.create(Name='Drama')
+        cls.book = Book.objects.create(title='Stolen Happiness', author=cls.author, isbn='9780000000001')
+        cls.book.genre.add(cls.genre)
+
+    def test_filtered_page_shows_books_added_to_the_genre(self):
+        url = f"{reverse('books')}?genre={self.genre.pk}"
+        self.assertContains(self.client.get(url), 'Stolen Happiness')
+        with self.captureOnCommitCallbacks(execute=True):
+            book = Book.objects.create(title='Moses', author=self.author, isbn='9780000000002')
+            book.genre.add(self.genre)
+
+        # within CHECK_INTERVAL the page comes from the snapshot loaded before the book
+        self.assertNotContains(self.client.get(url), 'Moses')
+        facets.index.checked = 0
+        response = self.client.get(url)
+        self.assertContains(response, 'Moses')
+        self.assertEqual(response.context['facets']['genres'][0]['count'], 2)
+
+    def test_version_is_bumped_after_the_commit(self):
+        facets.index.get()
+        with self.captureOnCommitCallbacks() as callbacks:
+            book = Book.objects.create(title='Moses', author=self.author, isbn='9780000000002')
+            book.genre.add(self.genre)
+            # another request before the commit keeps the snapshot it has
+            facets.index.checked = 0
+            self.assertNotIn(book.pk, facets.index.get().sort_keys)
+        for callback in callbacks:
+            callback()
+        facets.index.checked = 0
+        self.assertIn(book.pk, to_ids(facets.index.get().genres[self.genre.pk]))
+
+
+class FacetCountTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='library-test')
+        cls.franko = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.ukrainka = Author.objects.create(Name='Lesya', Surname='Ukrainka')
+        cls.drama = Genre.objects.create(Name='Drama')
+        cls.poetry = Genre.objects.create(Name='Poetry')
+        cls.moses = Book.objects.create(title='Moses', author=cls.franko, isbn='9780000000001')
+        cls.stolen = Book.objects.create(title='Stolen Happiness', author=cls.franko, isbn='9780000000002')
+        cls.forest = Book.objects.create(title='Forest Song', author=cls.ukrainka, isbn='9780000000003')
+        cls.letters = Book.objects.create(title='Letters', author=cls.ukrainka, isbn='9780000000004')
+        cls.moses.genre.add(cls.drama)
+        cls.stolen.genre.add(cls.drama, cls.poetry)
+        cls.forest.genre.add(cls.poetry)
+        cls.collection = Collection.objects.create(creator=cls.user, Name='Classics')
+        cls.collection.books_for_collection.add(cls.stolen, cls.forest)
+
+    def facets(self, **query):
+        return self.client.get(reverse('books'), query).context['facets']
+
+    def counts(self, options):
+        return {option['name']: option['count'] for option in options}
+
+    def titles(self, facets):
+        return [book.title for book in facets['page']]
+
+    def test_counts_keep_the_other_filters(self):
+        facets = self.facets()
+        self.assertIsNone(facets['page'])
+        self.assertEqual(self.counts(facets['genres']), {'Drama': 2, 'Poetry': 2})
+        self.assertEqual(self.counts(facets['authors']), {'Ivan Franko': 2, 'Lesya Ukrainka': 2})
+
+        facets = self.facets(genre=self.drama.pk)
+        self.assertEqual(self.titles(facets), ['Moses', 'Stolen Happiness'])
+        self.assertEqual(self.counts(facets['genres']), {'Drama': 2, 'Poetry': 2})
+        self.assertEqual(self.counts(facets['authors']), {'Ivan Franko': 2})
+
+        facets = self.facets(genre=self.poetry.pk, author=self.ukrainka.pk)
+        self.assertEqual(self.titles(facets), ['Forest Song'])
+        self.assertEqual(self.counts(facets['genres']), {'Poetry': 1})
+        self.assertEqual(self.counts(facets['authors']), {'Ivan Franko': 1, 'Lesya Ukrainka': 1})
+
+    def test_collections_are_filters_of_their_owner_only(self):
+        facets = self.facets(collection=self.collection.pk)
+        self.assertIsNone(facets['page'])
+        self.assertEqual(facets['collections'], [])
+
+        self.client.force_login(self.user)
+        facets = self.facets(collection=self.collection.pk, genre=self.drama.pk)
+        self.assertEqual(self.titles(facets), ['Stolen Happiness'])
+        self.assertEqual(self.counts(facets['collections'])['Classics'], 1)
+        self.assertEqual(facets['owner'], self.user.pk)
+
+    def test_filtered_pages_follow_the_cursor(self):
+        first = self.client.get(reverse('books'), {'genre': self.poetry.pk, 'size': 1}).context['page']
+        self.assertEqual([book.title for book in first], ['Forest Song'])
+        second = self.client.get(reverse('books'), {'genre': self.poetry.pk, 'size': 1,
+                                                    'after': first.next_cursor}).context['page']
+        self.assertEqual([book.title for book in second], ['Stolen Happiness'])
+        self.assertFalse(second.has_next)
+
+    def test_counts_follow_the_writes(self):
+        self.facets()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.moses.delete()
+            self.letters.genre.add(self.drama)
+            self.stolen.genre.remove(self.poetry)
+        facets.index.checked = 0
+        result = self.facets(genre=self.drama.pk)
+        self.assertEqual(self.titles(result), ['Letters', 'Stolen Happiness'])
+        self.assertEqual(self.counts(result['genres']), {'Drama': 2, 'Poetry': 1})
+        self.assertEqual(self.counts(result['authors']), {'Ivan Franko': 1, 'Lesya Ukrainka': 1})
+
+
+class RecommendTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        cls.a, cls.b, cls.c, cls.d = [Book.objects.create(title=title, author=author, isbn=str(9780000000000 + i))
+                                      for i, title in enumerate('ABCD')]
+        # the baskets: three like lists and a collection
+        for i, books in enumerate([(cls.a, cls.b), (cls.a, cls.b, cls.c), (cls.c, cls.d)]):
+            User.objects.create_user(f'reader{i}').profile.books.add(*books)
+        collection = Collection.objects.create(creator=User.objects.get(username='reader0'), Name='Classics')
+        collection.books_for_collection.add(cls.b, cls.d)
+
+    def stored(self):
+        return {(row.book.title, row.rank): (row.neighbour.title, round(row.score, 3))
+                for row in BookNeighbour.objects.select_related('book', 'neighbour')}
+
+    def test_neighbours_are_scored_by_cosine_similarity(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(recommend.build(), 10)
+        stored = self.stored()
+        self.assertEqual(stored[('A', 1)], ('B', 0.816))  # 2 shared / sqrt(2 * 3)
+        self.assertEqual(stored[('A', 2)], ('C', 0.5))
+        self.assertNotIn(('A', 3), stored)
+        # equal scores are ordered by id
+        self.assertEqual([stored[('B', rank)] for rank in (1, 2, 3)],
+                         [('A', 0.816), ('C', 0.408), ('D', 0.408)])
+        self.assertEqual([stored[('C', rank)][0] for rank in (1, 2, 3)], ['A', 'D', 'B'])
+        self.assertEqual([item.neighbour for item in recommended(self.d.pk)], [self.c, self.b])
+
+    def test_limits(self):
+        recommend.build(top_k=1)
+        self.assertEqual({key[1] for key in self.stored()}, {1})
+        recommend.build(min_common=2)
+        self.assertEqual(set(self.stored().values()), {('B', 0.816), ('A', 0.816)})
+
+    def test_blocks_give_the_same_neighbours(self):
+        recommend.build()
+        stored = self.stored()
+        recommend.build(block=1)
+        self.assertEqual(self.stored(), stored)
+
+    def test_book_page_shows_the_neighbours_after_a_build(self):
+        url = reverse('book-detail', args=[self.a.pk])
+        self.assertEqual(list(self.client.get(url).context['recommended']), [])
+        version = get_version(recommend.NAMESPACE)
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('build_recommendations', stdout=out)
+        self.assertIn('10 neighbours stored', out.getvalue())
+        self.assertGreater(get_version(recommend.NAMESPACE), version)
+        response = self.client.get(url)
+        self.assertEqual([item.neighbour for item in response.context['recommended']], [self.b, self.c])
+        self.assertContains(response, reverse('book-detail', args=[self.b.pk]))
+
+
+class ChartTests(LibraryTestCase):
+    def test_data_is_answered_from_the_cache_until_a_change(self):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        Author.objects.create(Name='Lesya', Surname='Ukrainka')
+        genre = Genre.objects.create(Name='Drama')
+        book = Book.objects.create(title='Moses', author=author, isbn='9780000000001')
+        book.genre.add(genre)
+        url = reverse('charts-data')
+        # a grouped query for the genres and one for the authors
+        with self.assertNumQueries(2):
+            data = self.client.get(url).json()
+        self.assertEqual(data['authors'], {'labels': ['Ivan Franko', 'Lesya Ukrainka'], 'counts': [1, 0]})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).json(), data)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            book.delete()
+        data = self.client.get(url).json()
+        self.assertEqual(data['genres'], {'labels': ['Drama'], 'counts': [0]})
+        self.assertEqual(data['authors']['counts'], [0, 0])
+
+    def test_counts_are_built_again_after_the_commit(self):
+        author = Author.objects.create(Name='Ivan', Surname='Franko')
+        genre = Genre.objects.create(Name='Drama')
+        version = get_version(charts.CACHE_NAMESPACE)
+        with self.captureOnCommitCallbacks() as callbacks:
+            book = Book.objects.create(title='Moses', author=author, isbn='9780000000001')
+            book.genre.add(genre)
+            # other requests build the data from the rows committed so far, under the old version
+            self.assertEqual(get_version(charts.CACHE_NAMESPACE), version)
+        for callback in callbacks:
+            callback()
+        self.assertGreater(get_version(charts.CACHE_NAMESPACE), version)
+        data = charts.chart_data()
+        self.assertEqual(data['genres'], {'labels': ['Drama'], 'counts': [1]})
+        self.assertEqual(data['authors'], {'labels': ['Ivan Franko'], 'counts': [1]})
@@ -0,0 +1,40 @@
+import re
+import unicodedata
+
+# Search keys: text in lower case, Cyrillic transliterated to Latin by the Ukrainian national
+# system (KMU 2010), accents and apostrophes dropped, words separated by single spaces.
+# "Пам’ять", "пам'ять" and "PAMIAT" all become "pamiat", "Émile Zola" becomes "emile zola".
+
+CYRILLIC = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'ie', 'ж': 'zh', 'з': 'z',
+    'и': 'y', 'і': 'i', 'ї': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ь': '', 'ю': 'iu', 'я': 'ia',
+    # letters found in Russian titles
+    'ё': 'e', 'ъ': '', 'ы': 'y', 'э': 'e',
+}
+# at the start of a word
+CYRILLIC_INITIAL = {'є': 'ye', 'ї': 'yi', 'й': 'y', 'ю': 'yu', 'я': 'ya'}
+
+APOSTROPHES = re.compile("['’ʼ`´]")
+WORD = re.compile(r'\w+')
+
+
+def transliterate(word):
+    letters = []
+    for i, char in enumerate(word):
+        if i == 0 and char in CYRILLIC_INITIAL:
+            letters.append(CYRILLIC_INITIAL[char])
+        elif char == 'г' and i > 0 and word[i - 1] == 'з':
+            letters.append('gh')  # зг is zgh, so it doesn't read as ж
+        else:
+            letters.append(CYRILLIC.get(char, char))
+    return ''.join(letters)
+
+
+def normalize(text):
+    """ The search key of text, see above."""
+    text = unicodedata.normalize('NFC', APOSTROPHES.sub('', text.casefold()))
+    text = WORD.sub(lambda match: transliterate(match.group()), text)
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return ' '.join(WORD.findall(text))
@@ -0,0 +1,204 @@
+import bisect
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.urls import reverse
+
+from .cache import bump, get_version
+from .models import Author, Book, Genre
+from .text import normalize
+
+# Prefix index for the typeahead of the search box, held in memory by every worker process.
+#
+# Every book title, author name and genre name is stored once per word, as (key, kind, id)
+# where key is the normalized text (text.py) from that word on, so "lord" finds "The Lord of
+# the Rings" and "shevch" or "шевч" finds "Тарас Шевченко".
+# The entries are a sorted list and the suggestions for a prefix are the entries from
+# bisect_left(prefix) for as long as their key starts with it. No query is made after the
+# index is loaded.
+#
+# The index is loaded on first use. The receivers in signals.py change it in the process that
+# saved the object, bump the 'typeahead' version and store the change in the cache under the
+# new version. The other processes see the new version at most CHECK_INTERVAL seconds later
+# and apply the changes they missed one by one. They load the whole index again only when a
+# change is gone from the cache or was never stored, as after a bulk insert.
+# A save that leaves the label as it was changes nothing.
+
+NAMESPACE = 'typeahead'
+LIMIT = 10
+MIN_LENGTH = 1
+CHECK_INTERVAL = 1.0  # seconds between looks at the version in the cache
+MAX_CHANGES = 100  # changes applied one by one, with more missed the index is loaded again
+CHANGE_TIMEOUT = 60 * 60
+
+KINDS = {'book': Book, 'author': Author, 'genre': Genre}
+URLS = {'book': 'book-detail', 'author': 'author_detail'}
+LABEL_FIELDS = {'book': {'title'}, 'author': {'Name', 'Surname'}, 'genre': {'Name'}}
+
+
+def label(kind, obj):
+    if kind == 'book':
+        return obj.title
+    return str(obj)
+
+
+def change_key(version):
+    return f'lab1p:{NAMESPACE}:change:{version}'
+
+
+def keys(key):
+    # the key from every word on
+    words = key.split(' ')
+    return {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = None  # sorted [(key, kind, id)]
+        self.labels = {}  # {(kind, id): label}
+        self.version = None
+        self.checked = 0
+
+    def load(self):
+        labels, entries = {}, []
+        # the keys come normalized from the database
+        rows = [('book', Book.objects.values_list('id', 'title', 'title_normalized')),
+                ('author', ((pk, f'{name} {surname}', key) for pk, name, surname, key in
+                            Author.objects.values_list('id', 'Name', 'Surname', 'name_normalized'))),
+                ('genre', Genre.objects.values_list('id', 'Name', 'name_normalized'))]
+        for kind, objects in rows:
+            for pk, text, normalized in objects:
+                labels[(kind, pk)] = text
+                entries += [(key, kind, pk) for key in keys(normalized)]
+        entries.sort()
+        self.entries, self.labels = entries, labels
+
+    def ensure_loaded(self):
+        now = time.monotonic()
+        if self.entries is not None and now - self.checked < CHECK_INTERVAL:
+            return
+        with self.lock:
+            self.sync()
+            self.checked = now
+
+    def sync(self):
+        """ Brings the index to the version in the cache, with the changes stored since or by loading it."""
+        version = get_version(NAMESPACE)
+        if self.entries is not None and version == self.version:
+            return
+        changes = self.changes_until(version) if self.entries is not None else None
+        if changes is None:
+            self.load()
+        else:
+            for kind, pk, text in changes:
+                self.apply(kind, pk, text)
+        self.version = version
+
+    def changes_until(self, version):
+        # None when a change is missing, the index has to be loaded then
+        if self.version is None or not 0 < version - self.version <= MAX_CHANGES:
+            return None
+        change_keys = [change_key(v) for v in range(self.version + 1, version + 1)]
+        found = cache.get_many(change_keys)
+        if len(found) != len(change_keys):
+            return None
+        return [found[key] for key in change_keys]
+
+    def suggest(self, query, limit=LIMIT):
+        """ Up to limit {"kind", "id", "label"} whose title or name has a word starting with query."""
+        prefix = normalize(query)
+        if len(prefix) < MIN_LENGTH:
+            return []
+        self.ensure_loaded()
+        found = []
+        seen = set()
+        with self.lock:
+            entries = self.entries
+            i = bisect.bisect_left(entries, (prefix,))
+            while i < len(entries) and len(found) < limit and entries[i][0].startswith(prefix):
+                _, kind, pk = entries[i]
+                if (kind, pk) not in seen:
+                    seen.add((kind, pk))
+                    found.append({'kind': kind, 'id': pk, 'label': self.labels[(kind, pk)]})
+                i += 1
+        return found
+
+    def remove(self, kind, pk):
+        text = self.labels.pop((kind, pk), None)
+        if text is None:
+            return
+        for key in keys(normalize(text)):
+            i = bisect.bisect_left(self.entries, (key, kind, pk))
+            if i < len(self.entries) and self.entries[i] == (key, kind, pk):
+                del self.entries[i]
+
+    def add(self, kind, pk, text):
+        self.labels[(kind, pk)] = text
+        for key in keys(normalize(text)):
+            bisect.insort(self.entries, (key, kind, pk))
+
+    def apply(self, kind, pk, text):
+        self.remove(kind, pk)
+        if text is not None:
+            self.add(kind, pk, text)
+
+    def changed(self, kind, pk, text=None):
+        """ Puts the new text of the object in the index, or takes it out when text is None,
+        and publishes the change to the other processes."""
+        with self.lock:
+            if self.entries is not None:
+                self.sync()
+                if self.labels.get((kind, pk)) == text:
+                    return
+                self.apply(kind, pk, text)
+            version = bump(NAMESPACE)
+            cache.set(change_key(version), (kind, pk, text), CHANGE_TIMEOUT)
+            # changes of other processes in between are applied by the next sync
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def invalidate(self):
+        # no change is stored for the version, every process loads the index again
+        with self.lock:
+            self.entries = None
+            bump(NAMESPACE)
+
+
+index = PrefixIndex()
+
+
+def suggest(query, limit=LIMIT):
+    suggestions = index.suggest(query, limit)
+    for suggestion in suggestions:
+        name = URLS.get(suggestion['kind'])
+        suggestion['url'] = reverse(name, args=[suggestion['id']]) if name else None
+    return suggestions
+
+
+def kind_of(model):
+    for kind, kind_model in KINDS.items():
+        if kind_model is model:
+            return kind
+    return None
+
+
+# the index is changed once the transaction is committed, a rolled back save leaves it alone
+
+def object_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    kind = kind_of(sender)
+    if not raw and (update_fields is None or LABEL_FIELDS[kind] & set(update_fields)):
+        pk, text = instance.pk, label(kind, instance)
+        transaction.on_commit(lambda: index.changed(kind, pk, text))
+
+
+def object_deleted(sender, instance, **kwargs):
+    kind, pk = kind_of(sender), instance.pk
+    transaction.on_commit(lambda: index.changed(kind, pk))
+
+
+def bulk_saved(sender, objs, **kwargs):
+    if kind_of(sender) is not None:
+        transaction.on_commit(index.invalidate)
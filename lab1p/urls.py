@@ -1,20 +1,27 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, async_views, views
+
+# the read-only pages are served by async views when ASYNC_VIEWS is on (under an ASGI server)
+pages = async_views if settings.ASYNC_VIEWS else views
+book_detail = async_views.book_detail if settings.ASYNC_VIEWS else views.BookDetailView.as_view()
 
 urlpatterns = [
     # main
-    path('', views.main, name='main'),
+    path('', pages.main, name='main'),
 
     # authors
-    path('<int:author_pk>/', views.author_detail, name='author_detail'),
-    path('authors/', views.authors, name='authors'),
+    path('<int:author_pk>/', pages.author_detail, name='author_detail'),
+    path('authors/', pages.authors, name='authors'),
 
     # books
-    path('books/', views.books, name='books'),
+    path('books/', pages.books, name='books'),
     path('mybooks/', views.AddedBooksByUserListView, name='my-added'),
     path('book/<int:pk>/add/', views.addBookToCollections.as_view(), name='add-book'),  # to collection
-    path('book/<int:pk>/', views.BookDetailView.as_view(), name='book-detail'),
+    path('book/<int:pk>/', book_detail, name='book-detail'),
+    path('library/batch/', views.library_batch, name='library-batch'),  # likes and collections, json
     path('book/<int:pk>/comment/', views.AddComment.as_view(), name='add-comment'),  # add comment for book
+    path('book/<int:pk>/comments/', async_views.book_comments, name='book-comments'),  # load more, json
 
     # profile
     path('profile/', views.profile, name='user-detail'),
@@ -36,7 +43,22 @@ urlpatterns = [
     # features
     path('newcollection/', views.addCollection, name='add-collection'),  # user adds new collection
     path('charts/', views.charts, name='charts'),
-    path('search/', views.search, name='search'),
+    path('charts/data/', views.charts_data, name='charts-data'),
+    path('search/', pages.search, name='search'),
+    path('search/suggest/', views.search_suggest, name='search-suggest'),  # typeahead, json
     path('import/', views.importExcel, name='import'),
     path('export/', views.export_users_excel, name='export'),
+    path('jobs/<int:pk>/', views.job_status, name='job-status'),
+    path('jobs/<int:pk>/download/', views.job_download, name='job-download'),
+    path('metrics/', views.metrics, name='metrics'),
+
+    # json api
+    path('api/v1/books/', api.books, name='api-books'),
+    path('api/v1/books/<int:pk>/', api.book, name='api-book'),
+    path('api/v1/books/<int:pk>/comments/', api.book_comments, name='api-book-comments'),
+    path('api/v1/authors/', api.authors, name='api-authors'),
+    path('api/v1/authors/<int:pk>/', api.author, name='api-author'),
+    path('api/v1/genres/', api.genres, name='api-genres'),
+    path('api/v1/collections/', api.collections, name='api-collections'),
+    path('api/v1/collections/<int:pk>/', api.collection, name='api-collection'),
 ]
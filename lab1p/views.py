@@ -1,31 +1,41 @@
-from zipfile import BadZipFile
+import json
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse, HttpRequest, FileResponse
+from django.http import HttpResponse, HttpRequest, FileResponse, StreamingHttpResponse, JsonResponse, Http404
 from django.shortcuts import render, get_object_or_404, redirect
-from django.urls import reverse_lazy
-from django.views.decorators.cache import cache_control
-from django.views.decorators.http import require_GET
+from django.urls import reverse, reverse_lazy
+from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import CreateView, DeleteView, UpdateView
 from django.contrib import messages
 
-from .models import Author, Book, Genre, UserProfile, Collection, Comment
+from .models import Author, Book, Collection, Comment, Job
 from django.views import generic
 from django.contrib.auth import get_user_model, authenticate
 from django.contrib.auth import logout, login
-from tablib import Dataset
-import xlwt
 from lab1p.forms import EditProfileForm, EditUserProfileForm, CollectionAddForm, CommentForm, \
     UserRegisterForm, AddBForm, UserLoginForm, UserUpdateForm, StPasswordForm, PasswordReset, RegistrationForm
 from .tokens import account_activation_token
+from .charts import chart_data
+from .stats import counters
+from .pagecache import page_cache, page_key
+from .exporter import export_rows, stream_csv, stream_xlsx
+from .search import search_books
+from .typeahead import suggest
+from .facets import browse
+from .recommend import recommended
+from .pagination import paginate, first_page, page_size, BOOK_ORDERING, AUTHOR_ORDERING, COMMENT_ORDERING, COMMENT_PAGE_SIZE
+from .instrumentation import registry, prometheus_text
+from .jobs import enqueue_import, enqueue_export, jobs_for, can_access
+from .library import apply_batch, snapshot, BatchError
+from .outbox import queue_email
 
 from django.template.loader import render_to_string
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_str
-from django.core.mail import EmailMessage
 
 
 # main
@@ -35,21 +45,16 @@ def main(request):
     num_visits = request.session.get('num_visits', 0)
     request.session['num_visits'] = num_visits + 1
 
-    num_books = Book.objects.all().count()
-    num_authors = Author.objects.all().count()
-    num_genres = Genre.objects.all().count()
-
-    user = get_user_model()
-    num_users = user.objects.all().count()
+    totals = counters()
 
     latest_author_list = Author.objects.order_by('-Name')[:5]
 
     context = {
-        'num_authors': num_authors,
+        'num_authors': totals['authors'],
         'latest_author_list': latest_author_list,
-        'num_books': num_books,
-        'num_genres': num_genres,
-        'num_users': num_users,
+        'num_books': totals['books'],
+        'num_genres': totals['genres'],
+        'num_users': totals['users'],
         'num_visits': num_visits,
     }
     return render(request, 'lab1p/../templates/main.html', context)
@@ -60,19 +65,21 @@ def main(request):
 
 def author_detail(request, author_pk):
     author = get_object_or_404(Author, pk=author_pk)
-    authBooks = Book.objects.filter(author=author)
+    authBooks = Book.objects.filter(author=author).for_cards()
 
     context = {
         'author': author,
         'books': authBooks,
+        **page_cache(f'author:{author_pk}', 'genres', key=page_key(request)),
     }
 
     return render(request, 'lab1p/../templates/author.html', context)
 
 
 def authors(request):
-    all_authors = Author.objects.all()
-    return render(request=request, template_name="templates/authors.html", context={"authors_obj": all_authors})
+    page = paginate(request, Author.objects.all(), AUTHOR_ORDERING)
+    return render(request=request, template_name="templates/authors.html",
+                  context={"authors_obj": page, "page": page, **page_cache('authors', key=page_key(request, page))})
 
 
 # books
@@ -80,21 +87,34 @@ def authors(request):
 
 def books(request):  # all-books page + adding to LIKED
     if request.method == "POST":
-        book_pk = request.POST.get("book_pk")
-        book = Book.objects.get(id=book_pk)
-        request.user.profile.books.add(book)
-        messages.success(request, f'{book} added to liked')
-        return redirect('books')
-    all_books = Book.objects.all()
-    return render(request=request, template_name="templates/books.html", context={"books_obj": all_books})
+        # one book from the like button, or every book the page queued when sending the batch failed
+        if not request.user.is_authenticated:
+            return redirect('login')
+        book_pks = [int(pk) for pk in request.POST.getlist("book_pk") if pk.isdigit()]
+        try:
+            apply_batch(request.user, [{'op': 'like', 'book': pk} for pk in book_pks])
+        except BatchError as error:
+            messages.warning(request, '; '.join(error.errors))
+        else:
+            titles = Book.objects.filter(pk__in=book_pks).values_list('title', flat=True)
+            messages.success(request, f'{", ".join(titles)} added to liked')
+        return redirect(request.get_full_path())
+    facets = browse(request, page_size(request))
+    page = facets['page']
+    if page is None:
+        page = paginate(request, Book.objects.for_cards(), BOOK_ORDERING)
+    namespaces = ['books', 'genres'] + ([f'collections:{request.user.pk}'] if facets['owner'] else [])
+    key = page_key(request, page, facets)
+    return render(request=request, template_name="templates/books.html",
+                  context={"books_obj": page, "page": page, "facets": facets, **page_cache(*namespaces, key=key)})
 
 
 def AddedBooksByUserListView(request):  # my LIKED - rename
-    user_profile = UserProfile.objects.get(user=request.user)
-    all_books = user_profile.books.all()
+    page = paginate(request, Book.objects.filter(profile_f_books__user=request.user).for_cards(), BOOK_ORDERING)
 
     context = {
-        'book_list': all_books,
+        'book_list': page,
+        'page': page,
     }
     return render(request, 'lab1p/book_list_added_user.html', context)
 
@@ -113,10 +133,31 @@ class addBookToCollections(UpdateView):
         kwargs['request'] = self.request
         return kwargs
 
+    def form_valid(self, form):
+        # saving the form would set book.collections to this user's choice, dropping the book
+        # from everyone else's collections, so only this user's collections are changed
+        chosen = {collection.pk for collection in form.cleaned_data['collections']}
+        operations = [{'op': 'add' if collection.pk in chosen else 'remove', 'book': self.object.pk,
+                       'collection': collection.pk} for collection in form.fields['collections'].queryset]
+        if operations:
+            apply_batch(self.request.user, operations)
+        return redirect(self.get_success_url())
+
 
 class BookDetailView(generic.DetailView):
     model = Book
 
+    def get_queryset(self):
+        return Book.objects.for_detail()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(page_cache(f'book:{self.object.pk}', 'genres', 'recommendations', key=page_key(self.request)))
+        # the rest is loaded by the page from book_comments
+        context['comments'] = first_page(self.object.comments.all(), COMMENT_ORDERING, COMMENT_PAGE_SIZE)
+        context['recommended'] = recommended(self.object.pk)
+        return context
+
 
 class AddComment(CreateView):
     model = Comment
@@ -126,7 +167,9 @@ class AddComment(CreateView):
     def form_valid(self, form):
         form.instance.book_id = self.kwargs['pk']
         form.instance.user_id = self.request.user.id
-        return super().form_valid(form)
+        # the comment and the book's comment_count are written together
+        with transaction.atomic():
+            return super().form_valid(form)
 
     success_url = reverse_lazy('main')
 
@@ -136,17 +179,15 @@ class AddComment(CreateView):
 
 def profile(request):
     creator = request.user
-    collections = creator.collections.all()
     context = {
         'user': creator,
-        'collection': collections
+        'library': snapshot(creator),
     }
     return render(request, 'templates/profile.html', context)
 
 
 def edit_full_profile(request):  # EDIT PROFILE FUNC - not login info
     creator = request.user
-    collections = creator.collections.all()
     form = EditProfileForm(request.POST or None, instance=creator.profile)
     if request.method == 'POST':
         form = EditProfileForm(request.POST, instance=creator.profile)
@@ -155,7 +196,7 @@ def edit_full_profile(request):  # EDIT PROFILE FUNC - not login info
             form.save()
     context = {
         'form': form,
-        'collections': collections,
+        'library': snapshot(creator),
     }
     return render(request, 'templates/edit_profile.html', context=context)
 
@@ -172,7 +213,7 @@ class UserLoginIfoEdit(generic.UpdateView):
 
 def edit_collection(request, pk):
     collection = Collection.objects.get(pk=pk)
-    books_obj = Book.objects.filter(collections=collection)
+    books_obj = Book.objects.filter(collections=collection).for_cards()
     context = {
         'collection': collection,
         'books_obj': books_obj,
@@ -188,11 +229,12 @@ class DeleteCollection(DeleteView):
 
 def books_for_collection(request, collection_id):
     collection = Collection.objects.get(id=collection_id)
-    all_books = Book.objects.filter(collections=collection)
+    page = paginate(request, Book.objects.filter(collections=collection).for_cards(), BOOK_ORDERING)
 
     context = {
         'collection': collection,
-        'book_list': all_books,
+        'book_list': page,
+        'page': page,
     }
     return render(request, 'lab1p/book_list_for_collection.html', context)
 
@@ -260,12 +302,9 @@ def activateEmail(request, user, to_email):
         'token': account_activation_token.make_token(user),
         "protocol": 'https' if request.is_secure() else 'http'
     })
-    email = EmailMessage(mail_subject, message, to=[to_email])
-    if email.send():
-        messages.success(request, f'Dear {user}, please go to you email {to_email} inbox and click on \
-                received activation link to confirm and complete the registration.')
-    else:
-        messages.error(request, f'Problem sending email to {to_email}, check if you typed it correctly.')
+    queue_email(mail_subject, message, [to_email])
+    messages.success(request, f'Dear {user}, please go to you email {to_email} inbox and click on \
+            received activation link to confirm and complete the registration.')
 
 
 # commented GET_OBJECT -- if works - delete
@@ -377,20 +416,17 @@ def password_reset_request(request):
                     'token': account_activation_token.make_token(associated_user),
                     "protocol": 'https' if request.is_secure() else 'http'
                 })
-                email = EmailMessage(subject, message, to=[associated_user.email])
-                if email.send():
-                    messages.success(request,
-                        """
-                        <h2>Password reset sent</h2><hr>
-                        <p>
-                            We've emailed you instructions for setting your password, if an account exists with the email you entered. 
-                            You should receive them shortly.<br>If you don't receive an email, please make sure you've entered the address 
-                            you registered with, and check your spam folder.
-                        </p>
-                        """
-                    )
-                else:
-                    messages.error(request, "Problem sending reset password email, SERVER PROBLEM")
+                queue_email(subject, message, [associated_user.email])
+                messages.success(request,
+                    """
+                    <h2>Password reset sent</h2><hr>
+                    <p>
+                        We've emailed you instructions for setting your password, if an account exists with the email you entered. 
+                        You should receive them shortly.<br>If you don't receive an email, please make sure you've entered the address 
+                        you registered with, and check your spam folder.
+                    </p>
+                    """
+                )
 
             return redirect('main')
 
@@ -448,182 +484,113 @@ def addCollection(request):
 
 
 def charts(request):
-    genres = Genre.objects.all()
-    al_genres = Genre.objects.all()
-    all_authors = Author.objects.all()
-    nums_f_genres = []
-    nums_f_authors = []
-    for genre in al_genres:
-        nums_f_genres.append(genre.books.count())
-    for author in all_authors:
-        nums_f_authors.append(author.auth_books.count())
-    context = {
-        'genres': genres,
-        'authors': all_authors,
-        'nums': nums_f_genres,
-        'auth_nums': nums_f_authors,
-    }
-    return render(request, 'templates/charts.html', context)
+    return render(request, 'templates/charts.html')
+
+
+@require_GET
+def charts_data(request):
+    return JsonResponse(chart_data())
 
 
 def search(request):
     if request.method == 'POST':
         searched = request.POST['searched']
-        genres = Genre.objects.filter(Name__contains=searched)
-        searched_books_names = (Book.objects.filter(title__contains=searched) |
-                                Book.objects.filter(genre__Name__contains=searched) |
-                                Book.objects.filter(author__Name__contains=searched) |
-                                Book.objects.filter(author__Surname__contains=searched)).distinct()
-
-        print(searched_books_names)
         context = {
             'search': searched,
-            'books_names': searched_books_names,
+            'books_names': search_books(searched),
         }
         return render(request, 'templates/search_page.html', context)
     else:
         return render(request, 'templates/search_page.html')
 
 
-# commented some unused vars -- if works - delete
+@require_GET
+def search_suggest(request):
+    # answered from the in-memory prefix index, no query is made
+    return JsonResponse({'suggestions': suggest(request.GET.get('q', ''))})
+
+
 def importExcel(request):
     if request.method == 'POST':
-        # author_res = AuthorResource()
-        # book_res = BookResource()
-        # genre_res = GenreResource
-        dataset = Dataset()
-        new_authors = request.FILES['file']
-        # new_books = request.FILES['file']
-        imported_data = ''
-        try:
-            imported_data = dataset.load(new_authors.read(), format='xls')
-        except Exception as e:
-            messages.warning(request, f"Error {e} for the book with id {e}")
-            print(f"exception {e}")
-            # finish def
-        error_messages = []
-        for index, data in enumerate(imported_data):
-            latest_id = Author.objects.all().values_list('id', flat=True).order_by('-id').first()
-            if latest_id is None:
-                latest_id = 0
-            # latest_id_genre = Genre.objects.all().values_list('id', flat=True).order_by('-id').first()
-
-            if not Author.objects.filter(Name=data[1], Surname=data[2]):
-                value = Author(
-                    latest_id + 1,
-                    data[1],
-                    data[2],
-                    data[3],
-                )
-                try:
-                    value.clean()
-                    value.save()
-                except Exception as e:
-                    messages.warning(request, f"Error {e} for the book with id ")
+        if 'file' not in request.FILES:
+            messages.warning(request, "Choose a file to import")
+            return redirect('import')
+        job = enqueue_import(request, request.FILES['file'], request.POST.get('mode', Job.ADD))
+        messages.success(request, f"Import #{job.pk} is queued, progress is shown below")
+        return redirect('import')
 
-            try:
-                author = Author.objects.get(Name=data[1], Surname=data[2])
-                author.clean()
-            except Exception as e:
-                messages.warning(request, f"Error {e} for the author with id {data[0]}. Data of "
-                                          f"this row was ignored. ")
-
-            import_books = Book.objects.all()
-            unique = True
-            print(data[6])
-            for book in import_books:
-                if book.isbn == data[6]:
-                    unique = False
-            if not unique:
-                book = Book.objects.get(isbn=data[6])
-                if book.title == data[5] and book.author == author:
-                    genres = Genre.objects.all()
-                    for i in range(7, 10):
-                        if data[i] != '':
-                            unique_two = True
-                            for genre in genres:
-                                if genre.Name == data[i]:
-                                    unique_two = False
-                            genre_new = None
-                            if unique_two:
-                                try:
-                                    genre_new = Genre.create(Name=data[i])
-                                    genre_new.save()
-                                except Exception as e:
-                                    messages.warning(request, f"Error {e} for the book with id {data[4]}")
-                            else:
-                                genre_new = Genre.objects.get(Name=data[i])
-                            book.genre.add(genre_new)
-                else:
-                    messages.warning(request, f"There is another book with the same isbn as the book with "
-                                              f"id {data[4]}. Data was ignored.")
-
-            else:
-                if not Book.objects.filter(title=data[5], author=author):
-                    try:
-                        book = Book.create(data[5], author, data[6])
-                        book.save()
-                    except Exception as e:
-                        messages.warning(request, f"Error {e} for the book with id {data[4]}")
-                    genres = Genre.objects.all()
-                    for i in range(7, 10):
-                        if data[i] != '':
-                            unique_two = True
-                            for genre in genres:
-                                if genre.Name == data[i]:
-                                    unique_two = False
-                            if unique_two:
-                                try:
-                                    genre_new = Genre.create(Name=data[i])
-                                    genre_new.save()
-                                except Exception as e:
-                                    messages.warning(request, f"Error {e} for the book with id {data[4]}")
-                            else:
-                                genre_new = Genre.objects.get(Name=data[i])
-                            book.genre.add(genre_new)
-                    book.save()
-                else:
-                    messages.warning(request, f"There is already a book with the the same name and author as book "
-                                              f"with id {data[4]}. Data was ignored.")
-
-    return render(request, 'templates/import.html')
+    return render(request, 'templates/import.html', {'jobs': jobs_for(request, Job.IMPORT),
+                                                     'modes': Job.MODE_CHOICES})
 
 
 def export_users_excel(request):
     if request.method == 'POST':
-        response = HttpResponse(content_type='application/vnd.ms-excel')
-        response['Content-Disposition'] = 'attachment; filename="Data.xls"'
-
-        wb = xlwt.Workbook(encoding='utf-8')
-        ws = wb.add_sheet('Data')
-        row_num = 0
-        font_style = xlwt.XFStyle()
-        font_style.font.bold = True
+        job = enqueue_export(request, request.POST.get('format', 'xlsx'))
+        messages.success(request, f"Export #{job.pk} is queued, the file can be downloaded below when it is ready")
+        return redirect('export')
+
+    export_format = request.GET.get('format')
+    if export_format == 'csv':
+        response = StreamingHttpResponse(stream_csv(export_rows()), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="Data.csv"'
+        return response
+    if export_format == 'xlsx':
+        response = StreamingHttpResponse(
+            stream_xlsx(export_rows()),
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response['Content-Disposition'] = 'attachment; filename="Data.xlsx"'
+        return response
 
-        columns = ['id_author', 'Name', 'Surname', 'Bio', 'id_book', 'title', 'isbn', 'genre1',
-                   'genre2', 'genre3']
+    return render(request, 'templates/export.html', {'jobs': jobs_for(request, Job.EXPORT)})
+
+
+@require_GET
+def job_status(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    if not can_access(request, job):
+        raise Http404
+    return JsonResponse({
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'percent': job.percent,
+        'errors': job.errors,
+        'mode': job.mode,
+        'diff': job.diff,
+        'download': reverse('job-download', args=[job.pk]) if job.result_file else None,
+    })
 
-        for col_num in range(len(columns)):
-            ws.write(row_num, col_num, columns[col_num], font_style)
 
-        font_style = xlwt.XFStyle()
+@require_GET
+def job_download(request, pk):
+    job = get_object_or_404(Job, pk=pk, status=Job.DONE)
+    if not can_access(request, job) or not job.result_file:
+        raise Http404
+    return FileResponse(job.result_file.open('rb'), as_attachment=True, filename=f'Data.{job.format}')
 
-        books_export = Book.objects.all()
 
-        for book in books_export:
-            row_num += 1
-            info = [book.author_id, book.author.Name, book.author.Surname, book.author.Bio, book.id, book.title,
-                    book.isbn]
-            genres = book.genre.all()[:3]
-            for genre in genres:
-                info.append(genre.Name)
-            for col_num in range(len(info)):
-                ws.write(row_num, col_num, str(info[col_num]), font_style)
-        wb.save(response)
+@require_POST
+def library_batch(request):
+    # {"operations": [...]}, see library.py
+    if not request.user.is_authenticated:
+        return JsonResponse({'errors': ['Log in to like books or change collections']}, status=403)
+    try:
+        operations = json.loads(request.body).get('operations')
+    except (ValueError, AttributeError):
+        return JsonResponse({'errors': ['The body must be a JSON object']}, status=400)
+    try:
+        return JsonResponse(apply_batch(request.user, operations))
+    except BatchError as error:
+        return JsonResponse({'errors': error.errors}, status=400)
 
-        return response
 
-    return render(request, 'templates/export.html')
+@require_GET
+def metrics(request):
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS):
+        raise Http404
+    return HttpResponse(prometheus_text(registry.snapshot()), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 ''' profile editing - if works - delete (only status)
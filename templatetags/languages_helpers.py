@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from django import template
 from django.utils import translation
 from django.conf import settings
@@ -9,6 +11,12 @@ register = template.Library()
 
 @register.filter
 def get_language_info_list_ex(request):
+    # the list only depends on the active language, the flags are built once per language
+    return language_info_list(translation.get_language())
+
+
+@lru_cache(maxsize=None)
+def language_info_list(current_language):
 
     data = []
 
@@ -27,14 +35,12 @@ def get_language_info_list_ex(request):
         'uk': 'ua',
     }
 
-    # Es: 'es'
-    current_language = translation.get_language()
-
     # Es: [('en', 'Inglés'), ('it', 'Italiano'), ('es', 'Español')]
     #languages = [(k, translation.gettext(v)) for k, v in settings.LANGUAGES]
     for language in settings.LANGUAGES:
         # Es: {'bidi': False, 'code': 'es', 'name': 'Spanish', 'name_local': 'español', 'name_translated': 'Español'}
-        info = get_language_info(language)
+        # a copy, the dict returned is Django's own LANG_INFO entry
+        info = dict(get_language_info(language))
 
         code = info['code']
         info['is_current'] = (code == current_language)
@@ -43,4 +49,4 @@ def get_language_info_list_ex(request):
         info['flag'] = flag.flag(flag_map.get(code, code))
         data.append(info)
 
-    return data
\ No newline at end of file
+    return tuple(data)